@@ -1,18 +1,28 @@
 from tokens import TOKEN
 from info import *
 from parse import Parser
+from nodes import *
+from fold import fold_constants
+from peephole import optimize
 from config import *
 
 
-def cg_block(f, block):
-    for stat in block['stats']:
-        cg_stat(f, stat)
-    if block['ret_exps'] is not None:
-        cg_ret_exps(f, block['ret_exps'])
+# comparison -> (compare and branch instruction, swap operands, negate)
+test_ops = {
+    TOKEN.OP_EQ: ('test_eq', False, 0),
+    TOKEN.OP_NE: ('test_eq', False, 1),
+    TOKEN.OP_LT: ('test_lt', False, 0),
+    TOKEN.OP_LE: ('test_le', False, 0),
+    TOKEN.OP_GT: ('test_lt', True, 0),
+    TOKEN.OP_GE: ('test_le', True, 0),
+}
 
 
-def is_vararg_or_call(exp):
-    return type(exp) is dict and (exp.get('exp_type', None) == TOKEN.VARARG or exp.get('op', None) == 'call')
+def cg_block(f, block):
+    for stat in block.stats:
+        cg_stat(f, stat)
+    if block.ret_exps is not None:
+        cg_ret_exps(f, block.ret_exps)
 
 
 def cg_ret_exps(f, ret_exps):
@@ -22,7 +32,9 @@ def cg_ret_exps(f, ret_exps):
     flag = is_vararg_or_call(ret_exps[-1])
     for i in range(n):
         r = f.alloc_reg()
-        if i == n - 1 and flag:
+        if n == 1 and type(ret_exps[i]) is CallExp:
+            cg_func_call_exp(f, ret_exps[i], r, -1, tail=True)
+        elif i == n - 1 and flag:
             cg_exp(f, ret_exps[i], r, -1)
         else:
             cg_exp(f, ret_exps[i], r, 1)
@@ -35,42 +47,21 @@ def cg_ret_exps(f, ret_exps):
 
 
 def cg_stat(f, stat):
-    t = stat.get('type', stat.get('op'))
-    if t == 'call':
-        cg_func_call_stat(f, stat)
-    elif t == 'break':
-        cg_break_stat(f, stat)
-    elif t == 'do':
-        cg_do_stat(f, stat)
-    elif t == 'repeat':
-        cg_repeat_stat(f, stat)
-    elif t == 'while':
-        cg_while_stat(f, stat)
-    elif t == 'if':
-        cg_if_stat(f, stat)
-    elif t == 'for':
-        if stat['num']:
-            cg_for_num_stat(f, stat)
-        else:
-            cg_for_in_stat(f, stat)
-    elif t == 'assign':
-        cg_assign_stat(f, stat)
-    elif t == 'func':
-        if stat.get('local', False):
-            cg_local_func_def_stat(f, stat)
-    elif t == 'var':
-        if stat.get('local', False):
-            cg_local_var_stat(f, stat)
-    elif t == 'empty':
-        pass
-    # TODO: support goto label
+    cg = stat_handlers.get(type(stat), None)
+    if cg is None:
+        # TODO: support goto label
+        print('not support stat %s' % type(stat).__name__)
     else:
-        print('not support stat %s' % t)
-        
+        cg(f, stat)
+
+
+def cg_empty_stat(f, stat):
+    pass
+
 
 def cg_local_func_def_stat(f, stat):
-    r = f.add_local_var(stat['name'])
-    cg_func_def_exp(f, stat['exp'], r)
+    r = f.add_local_var(stat.name)
+    cg_func_def_exp(f, stat.exp, r)
 
 
 def cg_func_call_stat(f, stat):
@@ -87,20 +78,17 @@ def cg_break_stat(f, stat):
 
 def cg_do_stat(f, stat):
     f.enter_scope(False)
-    cg_block(f, stat['block'])
+    cg_block(f, stat.block)
     f.close_open_up_values()
     f.exit_scope()
 
 
 def cg_while_stat(f, stat):
     pc_before = f.pc()
-    r = f.alloc_reg()
-    cg_exp(f, stat['exp'], r, 1)
-    f.free_reg()
-    f.emit('test', r, 0)
+    cg_test(f, stat.exp, 0)
     pc_jump_to_end = f.emit('jump', 0, 0)
     f.enter_scope(True)
-    cg_block(f, stat['block'])
+    cg_block(f, stat.block)
     f.close_open_up_values()
     f.emit('jump', 0, pc_before - f.pc() - 1)
     f.exit_scope()
@@ -110,32 +98,48 @@ def cg_while_stat(f, stat):
 def cg_repeat_stat(f, stat):
     f.enter_scope(True)
     pc_before = f.pc()
-    cg_block(f, stat['block'])
-    r = f.alloc_reg()
-    cg_exp(f, stat['exp'], r, 1)
-    f.free_reg()
-    f.emit('test', r, 0)
+    cg_block(f, stat.block)
+    cg_test(f, stat.exp, 0)
     f.emit('jump', f.get_jump_arg(), pc_before - f.pc() - 1)
     f.exit_scope()
 
 
+def cg_test(f, exp, flag):
+    # emits the test before a jump that is taken when the truth of exp is flag,
+    # a comparison is tested directly with its operands swapped for > and >=
+    t = type(exp)
+    if t is UnopExp and exp.op == TOKEN.OP_NOT:
+        cg_test(f, exp.exp, 1 - flag)
+    elif t is BinopExp and exp.op in test_ops:
+        name, swap, negate = test_ops[exp.op]
+        old_regs = f.used_regs
+        b = cg_rk(f, exp.exp1)
+        c = cg_rk(f, exp.exp2)
+        if swap:
+            b, c = c, b
+        f.emit(name, flag ^ negate, b, c)
+        f.used_regs = old_regs
+    else:
+        r = f.alloc_reg()
+        cg_exp(f, exp, r, 1)
+        f.free_reg()
+        f.emit('test', r, flag)
+
+
 def cg_if_stat(f, stat):
     pc_jumps_to_ends = []
     pc_jump_to_next = -1
-    for i in range(len(stat['exps'])):
-        exp = stat['exps'][i]
+    for i in range(len(stat.exps)):
+        exp = stat.exps[i]
         if pc_jump_to_next >= 0:
             f.fix_b(pc_jump_to_next, f.pc() - pc_jump_to_next)
-        r = f.alloc_reg()
-        cg_exp(f, exp, r, 1)
-        f.free_reg()
-        f.emit('test', r, 0)
+        cg_test(f, exp, 0)
         pc_jump_to_next = f.emit('jump', 0, 0)
         f.enter_scope(False)
-        cg_block(f, stat['blocks'][i])
+        cg_block(f, stat.blocks[i])
         f.close_open_up_values()
         f.exit_scope()
-        if i < len(stat['exps']) - 1:
+        if i < len(stat.exps) - 1:
             pc_jumps_to_ends.append(f.emit('jump', 0, 0))
         else:
             pc_jumps_to_ends.append(pc_jump_to_next)
@@ -145,11 +149,11 @@ def cg_if_stat(f, stat):
 
 def cg_for_num_stat(f, stat):
     f.enter_scope(True)
-    cg_local_var_stat(f, {'names': ['(for idx)', '(for limit)', '(for step)'], 'exps': stat['exps']})
-    f.add_local_var(stat['name'])
+    cg_local_var_stat(f, LocalVarStat(['(for idx)', '(for limit)', '(for step)'], stat.exps, -1))
+    f.add_local_var(stat.name)
     a = f.used_regs - 4
     pc_for_prep = f.emit('for_prep', a, 0)
-    cg_block(f, stat['block'])
+    cg_block(f, stat.block)
     f.close_open_up_values()
     pc_for_loop = f.emit('for_loop', a, 0)
     f.fix_b(pc_for_prep, pc_for_loop - pc_for_prep - 1)
@@ -159,22 +163,22 @@ def cg_for_num_stat(f, stat):
 
 def cg_for_in_stat(f, stat):
     f.enter_scope(True)
-    cg_local_var_stat(f, {'names': ['(for gen)', '(for state)', '(for ctrl)'], 'exps': stat['exps']})
-    for name in stat['names']:
+    cg_local_var_stat(f, LocalVarStat(['(for gen)', '(for state)', '(for ctrl)'], stat.exps, -1))
+    for name in stat.names:
         f.add_local_var(name)
     pc_jump_to_tfc = f.emit('jump', 0, 0)
-    cg_block(f, stat['block'])
+    cg_block(f, stat.block)
     f.close_open_up_values()
     f.fix_b(pc_jump_to_tfc, f.pc() - pc_jump_to_tfc)
     r_gen = f.slot_of_local_var('(for gen)')
-    f.emit('t_for_call', r_gen, len(stat['names']))
+    f.emit('t_for_call', r_gen, len(stat.names))
     f.emit('t_for_loop', r_gen + 2, pc_jump_to_tfc - f.pc() - 1)
     f.exit_scope()
 
 
 def cg_local_var_stat(f, stat):
-    exps = stat['exps']
-    names = stat['names']
+    exps = stat.exps
+    names = stat.names
     n_exps = len(exps)
     n_names = len(names)
     old_regs = f.used_regs
@@ -205,30 +209,37 @@ def cg_local_var_stat(f, stat):
             a = f.alloc_regs(n)
             f.emit('load_nil', a, n - 1)
     f.used_regs = old_regs
-    for name in stat['names']:
+    for name in names:
         f.add_local_var(name)
 
 
 def cg_assign_stat(f, stat):
-    n_exps = len(stat['exps'])
-    n_vars = len(stat['vars'])
+    n_exps = len(stat.exps)
+    n_vars = len(stat.vars)
     old_regs = f.used_regs
+    if n_vars == 1 and n_exps == 1 and cg_single_assign(f, stat.vars[0], stat.exps[0]):
+        f.used_regs = old_regs
+        return
     table_regs = [-1] * n_vars
     k_regs = [-1] * n_vars
     v_regs = [-1] * n_vars
     for i in range(n_vars):
-        var = stat['vars'][i]
-        if type(var) is dict and var.get('op', None) is 'access':
+        var = stat.vars[i]
+        if type(var) is AccessExp:
             table_regs[i] = f.alloc_reg()
-            cg_exp(f, var['1'], table_regs[i], 1)
-            k_regs[i] = f.alloc_reg()
-            cg_exp(f, var['2'], k_regs[i], 1)
+            cg_exp(f, var.table, table_regs[i], 1)
+            if type(var.key) is str:
+                # a local key is copied, it may be assigned before set_table
+                k_regs[i] = f.alloc_reg()
+                cg_exp(f, var.key, k_regs[i], 1)
+            else:
+                k_regs[i] = cg_rk(f, var.key)
     for i in range(n_vars):
         v_regs[i] = f.used_regs + i
 
     if n_exps >= n_vars:
         for i in range(n_exps):
-            exp = stat['exps'][i]
+            exp = stat.exps[i]
             a = f.alloc_reg()
             if i >= n_vars and i == n_exps - 1 and is_vararg_or_call(exp):
                 cg_exp(f, exp, a, 0)
@@ -237,7 +248,7 @@ def cg_assign_stat(f, stat):
     else:
         multi_ret = False
         for i in range(n_exps):
-            exp = stat['exps'][i]
+            exp = stat.exps[i]
             a = f.alloc_reg()
             if i == n_exps - 1 and is_vararg_or_call(exp):
                 multi_ret = True
@@ -252,7 +263,7 @@ def cg_assign_stat(f, stat):
             f.emit('load_nil', a, n - 1)
 
     for i in range(n_vars):
-        var = stat['vars'][i]
+        var = stat.vars[i]
         if type(var) is str:
             a = f.slot_of_local_var(var)
             if a >= 0:
@@ -271,57 +282,72 @@ def cg_assign_stat(f, stat):
     f.used_regs = old_regs
 
 
+def cg_single_assign(f, var, exp):
+    # a table field or global assigned from RK operands, False for other variables
+    if type(var) is not str:
+        a = cg_reg(f, var.table)
+        b = cg_rk(f, var.key)
+        c = cg_rk(f, exp)
+        f.emit('set_table', a, b, c)
+        return True
+    if f.slot_of_local_var(var) < 0 and f.index_of_up_value(var) < 0:
+        c = cg_rk(f, exp)
+        a = f.index_of_up_value('_ENV')
+        b = 0x100 + f.index_of_constant(var)
+        f.emit('set_tab_up', a, b, c)
+        return True
+    return False
+
+
 def cg_exp(f, exp, r, n):
-    if type(exp) is str:
-        cg_name(f, exp, r)
-        return
-    op = exp.get('op', exp.get('exp_type', None))
-    if op == TOKEN.NIL:
-        f.emit('load_nil', r, n - 1)
-    elif op == TOKEN.FALSE:
-        f.emit('load_bool', r, 0, 0)
-    elif op == TOKEN.TRUE:
-        f.emit('load_bool', r, 1, 0)
-    elif op == TOKEN.NUMBER or op == TOKEN.STRING:
-        f.emit('load_k', r, exp['content'])
-    elif op == 'parenthesis':
-        cg_exp(f, exp['1'], r, 1)
-    elif op == TOKEN.VARARG:
-        assert f.is_vararg
-        f.emit('vararg', r, n)
-    elif op == 'def':
-        cg_func_def_exp(f, exp, r)
-    elif op == 'table':
-        cg_table_exp(f, exp, r)
-    elif op == 'call':
-        cg_func_call_exp(f, exp, r, n)
-    elif op == 'access':
-        cg_table_access_exp(f, exp, r)
-    elif op == TOKEN.OP_CONCAT:
-        cg_concat_exp(f, exp, r)
-    elif '2' in exp:
-        cg_2op_exp(f, exp, r)
-    elif '1' in exp:
-        cg_1op_exp(f, exp, r)
+    # n is the number of results of a call or vararg, -1 for all
+    cg = exp_handlers.get(type(exp), None)
+    if cg is None:
+        print('not support exp', type(exp).__name__)
     else:
-        print('not support op', op)
+        cg(f, exp, r, n)
+
+
+def cg_nil_exp(f, exp, r, n):
+    f.emit('load_nil', r, n - 1)
+
+
+def cg_false_exp(f, exp, r, n):
+    f.emit('load_bool', r, 0, 0)
+
+
+def cg_true_exp(f, exp, r, n):
+    f.emit('load_bool', r, 1, 0)
+
+
+def cg_const_exp(f, exp, r, n):
+    f.emit('load_k', r, exp.content)
+
+
+def cg_paren_exp(f, exp, r, n):
+    cg_exp(f, exp.exp, r, 1)
+
+
+def cg_vararg_exp(f, exp, r, n):
+    assert f.is_vararg
+    f.emit('vararg', r, n)
 
 
 def new_func_info(parent, fd):
     info = FuncInfo()
     info.breaks.append([])
     info.parent = parent
-    info.is_vararg = fd['params']['var']
-    info.param_num = len(fd['params']['params'])
+    info.is_vararg = fd.is_vararg
+    info.param_num = len(fd.params)
     return info
 
 
 def cg_func_def_exp(f, exp, a):
     sub = new_func_info(f, exp)
     f.sub_funcs.append(sub)
-    for name in exp['params']['params']:
+    for name in exp.params:
         sub.add_local_var(name)
-    cg_block(sub, exp['block'])
+    cg_block(sub, exp.block)
     sub.exit_scope()
     sub.emit('return', 0, 0)
     bx = len(f.sub_funcs) - 1
@@ -331,17 +357,17 @@ def cg_func_def_exp(f, exp, a):
 def cg_table_exp(f, exp, a):
 
     n_arr = 0
-    for k in exp['keys']:
+    for k in exp.keys:
         if k is None:
             n_arr += 1
-    n_exp = len(exp['keys'])
-    multi_ret = n_exp > 0 and is_vararg_or_call(exp['values'][-1])
+    n_exp = len(exp.keys)
+    multi_ret = n_exp > 0 and is_vararg_or_call(exp.values[-1])
     f.emit('new_table', a, n_arr, n_exp - n_arr)
     idx = 0
 
     for i in range(n_exp):
-        k = exp['keys'][i]
-        v = exp['values'][i]
+        k = exp.keys[i]
+        v = exp.values[i]
         if k is None:
             idx += 1
             tmp = f.alloc_reg()
@@ -361,51 +387,49 @@ def cg_table_exp(f, exp, a):
                     f.emit('set_list', a, n, c)
 
         else:
-            b = f.alloc_reg()
-            cg_exp(f, k, b, 1)
-            c = f.alloc_reg()
-            cg_exp(f, v, c, 1)
-            f.free_regs(2)
+            old_regs = f.used_regs
+            b = cg_rk(f, k)
+            c = cg_rk(f, v)
+            f.used_regs = old_regs
             f.emit('set_table', a, b, c)
 
 
 def cg_1op_exp(f, exp, a):
-    b = f.alloc_reg()
-    cg_exp(f, exp['1'], b, 1)
-    f.emit(exp['op'], a, b)
-    f.free_reg()
+    old_regs = f.used_regs
+    b = cg_reg(f, exp.exp)
+    f.emit(exp.op, a, b)
+    f.used_regs = old_regs
 
 
 def cg_2op_exp(f, exp, a):
-    if exp['op'] in [TOKEN.OP_AND, TOKEN.OP_OR]:
+    if exp.op in [TOKEN.OP_AND, TOKEN.OP_OR]:
         b = f.alloc_reg()
-        cg_exp(f, exp['1'], b, 1)
+        cg_exp(f, exp.exp1, b, 1)
         f.free_reg()
-        if exp['op'] == TOKEN.OP_AND:
+        if exp.op == TOKEN.OP_AND:
             f.emit('test_set', a, b, 0)
         else:
             f.emit('test_set', a, b, 1)
         pc_jump = f.emit('jump', 0, 0)
         b = f.alloc_reg()
-        cg_exp(f, exp['2'], b, 1)
+        cg_exp(f, exp.exp2, b, 1)
         f.free_reg()
         f.emit('move', a, b)
         f.fix_b(pc_jump, f.pc() - pc_jump)
     else:
-        b = f.alloc_reg()
-        cg_exp(f, exp['1'], b, 1)
-        c = f.alloc_reg()
-        cg_exp(f, exp['2'], c, 1)
-        f.emit(exp['op'], a, b, c)
-        f.free_regs(2)
+        old_regs = f.used_regs
+        b = cg_rk(f, exp.exp1)
+        c = cg_rk(f, exp.exp2)
+        f.emit(exp.op, a, b, c)
+        f.used_regs = old_regs
 
 
 def cg_concat_exp(f, exp, a):
-    for sub in exp['1']:
+    for sub in exp.exps:
         r = f.alloc_reg()
         cg_exp(f, sub, r, 1)
     c = f.used_regs - 1
-    b = c - len(exp['1']) + 1
+    b = c - len(exp.exps) + 1
     f.free_regs(c - b + 1)
     f.emit(TOKEN.OP_CONCAT, a, b, c)
 
@@ -419,31 +443,55 @@ def cg_name(f, name, a):
         if idx >= 0:
             f.emit('get_up_val', a, idx)
         else:
-            cg_table_access_exp(f, {'op': 'access', '1': '_ENV',
-                                    '2': {'exp_type': TOKEN.STRING, 'content': name, 'line': -1}}, a)
+            b = f.index_of_up_value('_ENV')
+            c = 0x100 + f.index_of_constant(name)
+            f.emit('get_tab_up', a, b, c)
 
 
 def cg_table_access_exp(f, exp, a):
-    b = f.alloc_reg()
-    cg_exp(f, exp['1'], b, 1)
-    c = f.alloc_reg()
-    cg_exp(f, exp['2'], c, 1)
+    old_regs = f.used_regs
+    b = cg_reg(f, exp.table)
+    c = cg_rk(f, exp.key)
     f.emit('get_table', a, b, c)
-    f.free_regs(2)
+    f.used_regs = old_regs
 
 
-def cg_func_call_exp(f, exp, a, n):
-    n_args = len(exp['args'])
+def cg_reg(f, exp):
+    # the slot of a local variable, or a new register holding the value of exp
+    if type(exp) is str:
+        r = f.slot_of_local_var(exp)
+        if r >= 0:
+            return r
+    r = f.alloc_reg()
+    cg_exp(f, exp, r, 1)
+    return r
+
+
+def cg_rk(f, exp):
+    # like cg_reg, but a number or string literal is 0x100 + its index in the constants
+    t = type(exp)
+    if t is NumberExp or t is StringExp:
+        idx = f.index_of_constant(exp.content)
+        if idx <= 0xff:
+            return 0x100 + idx
+    return cg_reg(f, exp)
+
+
+def cg_func_call_exp(f, exp, a, n, tail=False):
+    n_args = len(exp.args)
     last_vararg_or_call = False
-    cg_exp(f, exp['exp'], a, 1)
+    b = f.slot_of_local_var(exp.exp) if type(exp.exp) is str else -1
+    if exp.name is None or b < 0:
+        cg_exp(f, exp.exp, a, 1)
+        b = a
 
-    if exp['name'] is not None:
-        c = 0x100 + f.index_of_constant(exp['name'])
-        f.emit('self', a, a, c)
+    if exp.name is not None:
+        c = 0x100 + f.index_of_constant(exp.name)
+        f.emit('self', a, b, c)
 
     for i in range(n_args):
         tmp = f.alloc_reg()
-        arg = exp['args'][i]
+        arg = exp.args[i]
         if i == n_args - 1 and is_vararg_or_call(arg):
             last_vararg_or_call = True
             cg_exp(f, arg, tmp, -1)
@@ -451,22 +499,61 @@ def cg_func_call_exp(f, exp, a, n):
             cg_exp(f, arg, tmp, 1)
 
     f.free_regs(n_args)
-    if exp['name'] is not None:
+    if exp.name is not None:
         n_args += 1
     if last_vararg_or_call:
         n_args = -1
 
-    f.emit('call', a, n_args, n)
-
-
-def intermediate(code):
+    if tail:
+        f.emit('tail_call', a, n_args, n)
+    else:
+        f.emit('call', a, n_args, n)
+
+
+stat_handlers = {
+    CallExp: cg_func_call_stat,
+    BreakStat: cg_break_stat,
+    DoStat: cg_do_stat,
+    RepeatStat: cg_repeat_stat,
+    WhileStat: cg_while_stat,
+    IfStat: cg_if_stat,
+    ForNumStat: cg_for_num_stat,
+    ForInStat: cg_for_in_stat,
+    AssignStat: cg_assign_stat,
+    LocalFuncStat: cg_local_func_def_stat,
+    LocalVarStat: cg_local_var_stat,
+    EmptyStat: cg_empty_stat,
+}
+
+exp_handlers = {
+    str: lambda f, exp, r, n: cg_name(f, exp, r),
+    NilExp: cg_nil_exp,
+    FalseExp: cg_false_exp,
+    TrueExp: cg_true_exp,
+    NumberExp: cg_const_exp,
+    StringExp: cg_const_exp,
+    ParenExp: cg_paren_exp,
+    VarargExp: cg_vararg_exp,
+    FuncDefExp: lambda f, exp, r, n: cg_func_def_exp(f, exp, r),
+    TableExp: lambda f, exp, r, n: cg_table_exp(f, exp, r),
+    CallExp: cg_func_call_exp,
+    AccessExp: lambda f, exp, r, n: cg_table_access_exp(f, exp, r),
+    ConcatExp: lambda f, exp, r, n: cg_concat_exp(f, exp, r),
+    BinopExp: lambda f, exp, r, n: cg_2op_exp(f, exp, r),
+    UnopExp: lambda f, exp, r, n: cg_1op_exp(f, exp, r),
+}
+
+
+def intermediate(code, thread_jumps=True):
+    # thread_jumps is False for the transpiler, it rebuilds if statements from the jumps
     parser = Parser(code)
-    block = parser.parse()
+    block = fold_constants(parser.parse())
     # print(block)
-    fd = {'params': {'var': True, 'params': []}, 'block': block}
+    fd = FuncDefExp([], True, block)
     info = new_func_info(None, fd)
     info.add_local_var('_ENV')
     cg_func_def_exp(info, fd, 0)
+    optimize(info, thread_jumps)
     # print(info.sub_funcs[0].ins)
     return info
 
@@ -0,0 +1,693 @@
+import operator
+from functools import partial
+from parse import Parser
+from fold import fold_constants
+from nodes import *
+from lua_stack import Closure, UpVal
+from lua_table import Table, KeyCache, FieldCache, is_map_key
+from tokens import TOKEN
+from transpiler import adjust, index, length, concat, lua_for, open_up_value
+from config import FIELDS_PER_FLUSH, LUA_GLOBALS
+
+# a frame is a list, the locals start after the up values, the varargs and
+# the up values opened by the closures made in the frame
+UP_VALUES = 0
+VARARGS = 1
+OPEN_UVS = 2
+LOCALS = 3
+
+# returned by a statement to leave the innermost loop, a return statement
+# returns the list of results
+BREAK = object()
+
+# Python operators used when both operands are integers
+int_ops = {
+    TOKEN.OP_ADD: operator.add,
+    TOKEN.OP_MINUS: operator.sub,
+    TOKEN.OP_MUL: operator.mul,
+    TOKEN.OP_MOD: operator.mod,
+    TOKEN.OP_IDIV: operator.floordiv,
+    TOKEN.OP_BAND: operator.and_,
+    TOKEN.OP_BOR: operator.or_,
+    TOKEN.OP_WAVE: operator.xor,
+}
+
+compare_ops = {
+    TOKEN.OP_EQ: operator.eq,
+    TOKEN.OP_NE: operator.ne,
+    TOKEN.OP_LT: operator.lt,
+    TOKEN.OP_LE: operator.le,
+    TOKEN.OP_GT: operator.gt,
+    TOKEN.OP_GE: operator.ge,
+}
+
+
+def constant_of(exp):
+    # (value, True) for a number or string literal
+    if type(exp) is NumberExp or type(exp) is StringExp:
+        return exp.content, True
+    return None, False
+
+
+class Scope:
+    # local variables of a function being compiled, slots are allocated like
+    # the registers of FuncInfo so closures capture the same way as on the VM
+
+    def __init__(self, parent):
+        self.parent = parent
+        self.names = {}
+        self.blocks = []
+        self.n_locals = 0
+        self.size = 0
+        self.up_values = {}
+        # (in_stack, idx) of every up value, see ProtoUpValue
+        self.up_infos = []
+
+    def enter(self):
+        self.blocks.append((dict(self.names), self.n_locals))
+
+    def exit(self):
+        self.names, self.n_locals = self.blocks.pop()
+
+    def declare(self, name):
+        slot = self.n_locals
+        self.n_locals += 1
+        self.size = max(self.size, self.n_locals)
+        self.names[name] = slot
+        return slot
+
+    def up_value(self, name):
+        if name in self.up_values:
+            return self.up_values[name]
+        if self.parent is None:
+            return -1
+        if name in self.parent.names:
+            info = (True, self.parent.names[name])
+        else:
+            idx = self.parent.up_value(name)
+            if idx < 0:
+                return -1
+            info = (False, idx)
+        self.up_values[name] = len(self.up_infos)
+        self.up_infos.append(info)
+        return self.up_values[name]
+
+
+class Compiler:
+    # turns every node of the syntax tree into a Python closure taking the frame,
+    # expressions return their value, statements return None, BREAK or results
+
+    def __init__(self, vm):
+        self.vm = vm
+        self.stack = vm.stack
+        self.globals = vm.registry.get(LUA_GLOBALS)
+        self.scope = None
+
+    def compile(self, block):
+        # returns the closure of the main chunk
+        make = self.function(FuncDefExp([], True, block))
+        return make(None)
+
+    def function(self, exp):
+        parent = self.scope
+        scope = self.scope = Scope(parent)
+        for name in exp.params:
+            scope.declare(name)
+        body = self.block(exp.block)
+        self.scope = parent
+        n_params = len(exp.params)
+        is_vararg = exp.is_vararg
+        size = LOCALS + scope.size
+        up_infos = scope.up_infos
+
+        def make(f):
+            up_values = []
+            for in_stack, idx in up_infos:
+                if in_stack:
+                    open_uvs = f[OPEN_UVS]
+                    if open_uvs is None:
+                        open_uvs = f[OPEN_UVS] = {}
+                    up_values.append(open_up_value(open_uvs, idx, f[LOCALS + idx]))
+                else:
+                    up_values.append(f[UP_VALUES][idx])
+
+            def native(*args):
+                fr = [None] * size
+                fr[UP_VALUES] = up_values
+                n = len(args)
+                if n <= n_params:
+                    fr[LOCALS: LOCALS + n] = args
+                    fr[VARARGS] = ()
+                else:
+                    fr[LOCALS: LOCALS + n_params] = args[:n_params]
+                    fr[VARARGS] = args[n_params:] if is_vararg else ()
+                r = body(fr)
+                return () if r is None else r
+
+            c = Closure(None)
+            c.up_values = up_values
+            c.native = native
+            return c
+        return make
+
+    def block(self, block):
+        stats = [self.stat(stat) for stat in block.stats]
+        ret = None
+        if block.ret_exps is not None:
+            ret = self.exp_list(block.ret_exps, -1)
+
+        def run(f):
+            for s in stats:
+                r = s(f)
+                if r is not None:
+                    return r
+            if ret is not None:
+                return ret(f)
+        return run
+
+    def scoped_block(self, block):
+        self.scope.enter()
+        run = self.block(block)
+        self.scope.exit()
+        return run
+
+    def stat(self, stat):
+        t = type(stat)
+        if t is CallExp:
+            return self.call_stat(stat)
+        elif t is BreakStat:
+            return lambda f: BREAK
+        elif t is DoStat:
+            return self.scoped_block(stat.block)
+        elif t is RepeatStat:
+            return self.repeat_stat(stat)
+        elif t is WhileStat:
+            return self.while_stat(stat)
+        elif t is IfStat:
+            return self.if_stat(stat)
+        elif t is ForNumStat:
+            return self.for_num_stat(stat)
+        elif t is ForInStat:
+            return self.for_in_stat(stat)
+        elif t is AssignStat:
+            return self.assign_stat(stat)
+        elif t is LocalFuncStat:
+            return self.local_func_def_stat(stat)
+        elif t is LocalVarStat:
+            return self.local_var_stat(stat)
+        elif t is not EmptyStat:
+            print('not support stat %s' % t.__name__)
+        return lambda f: None
+
+    def call_stat(self, stat):
+        call = self.call(stat)
+
+        def run(f):
+            call(f)
+        return run
+
+    def while_stat(self, stat):
+        cond = self.exp(stat.exp)
+        body = self.scoped_block(stat.block)
+
+        def run(f):
+            while 1:
+                v = cond(f)
+                if v is None or v is False:
+                    return None
+                r = body(f)
+                if r is not None:
+                    return None if r is BREAK else r
+        return run
+
+    def repeat_stat(self, stat):
+        # the condition sees the locals of the block
+        self.scope.enter()
+        body = self.block(stat.block)
+        cond = self.exp(stat.exp)
+        self.scope.exit()
+
+        def run(f):
+            while 1:
+                r = body(f)
+                if r is not None:
+                    return None if r is BREAK else r
+                v = cond(f)
+                if v is not None and v is not False:
+                    return None
+        return run
+
+    def if_stat(self, stat):
+        branches = []
+        for exp, block in zip(stat.exps, stat.blocks):
+            branches.append((self.exp(exp), self.scoped_block(block)))
+
+        def run(f):
+            for cond, body in branches:
+                v = cond(f)
+                if v is not None and v is not False:
+                    return body(f)
+        return run
+
+    def for_num_stat(self, stat):
+        init, limit, step = [self.exp(exp) for exp in stat.exps]
+        scope = self.scope
+        scope.enter()
+        for name in ['(for idx)', '(for limit)', '(for step)']:
+            scope.declare(name)
+        i = LOCALS + scope.declare(stat.name)
+        body = self.block(stat.block)
+        scope.exit()
+        values = partial(lua_for, self.stack)
+
+        def run(f):
+            for v in values(init(f), limit(f), step(f)):
+                f[i] = v
+                r = body(f)
+                if r is not None:
+                    return None if r is BREAK else r
+        return run
+
+    def for_in_stat(self, stat):
+        exps = self.exp_list(stat.exps, 3)
+        scope = self.scope
+        scope.enter()
+        for name in ['(for gen)', '(for state)', '(for ctrl)']:
+            scope.declare(name)
+        n = len(stat.names)
+        first = LOCALS + scope.declare(stat.names[0])
+        for name in stat.names[1:]:
+            scope.declare(name)
+        body = self.block(stat.block)
+        scope.exit()
+        call_value = self.vm.call_value
+
+        def run(f):
+            gen, state, ctrl = exps(f)
+            while 1:
+                if type(gen) is Closure and gen.native is not None:
+                    results = gen.native(state, ctrl)
+                else:
+                    results = call_value(gen, (state, ctrl))
+                f[first: first + n] = adjust(results, n)
+                ctrl = f[first]
+                if ctrl is None:
+                    return None
+                r = body(f)
+                if r is not None:
+                    return None if r is BREAK else r
+        return run
+
+    def local_func_def_stat(self, stat):
+        i = LOCALS + self.scope.declare(stat.name)
+        make = self.function(stat.exp)
+
+        def run(f):
+            f[i] = make(f)
+        return run
+
+    def local_var_stat(self, stat):
+        names = stat.names
+        n = len(names)
+        if n == 1 and len(stat.exps) == 1:
+            exp = self.exp(stat.exps[0])
+            i = LOCALS + self.scope.declare(names[0])
+
+            def run(f):
+                f[i] = exp(f)
+            return run
+        exps = self.exp_list(stat.exps, n)
+        first = LOCALS + self.scope.declare(names[0])
+        for name in names[1:]:
+            self.scope.declare(name)
+
+        def run(f):
+            f[first: first + n] = exps(f)
+        return run
+
+    def assign_stat(self, stat):
+        # tables and keys are evaluated before the values, as in cg_assign_stat
+        targets = [self.target(var) for var in stat.vars]
+        if len(targets) == 1 and len(stat.exps) == 1:
+            (t, k, store), = targets
+            exp = self.exp(stat.exps[0])
+            if t is None:
+                def run(f):
+                    store(f, exp(f))
+            else:
+                def run(f):
+                    tv = t(f)
+                    kv = k(f)
+                    store(tv, kv, exp(f))
+            return run
+        exps = self.exp_list(stat.exps, len(targets))
+
+        def run(f):
+            keys = [(t(f), k(f)) if t is not None else None for t, k, store in targets]
+            values = exps(f)
+            for i in range(len(targets)):
+                store = targets[i][2]
+                if keys[i] is None:
+                    store(f, values[i])
+                else:
+                    store(keys[i][0], keys[i][1], values[i])
+        return run
+
+    def target(self, var):
+        # (table, key, store) of an assigned variable, table is None for a name
+        if type(var) is not str:
+            return self.exp(var.table), self.exp(var.key), self.set_table
+        scope = self.scope
+        if var in scope.names:
+            i = LOCALS + scope.names[var]
+
+            def store(f, v):
+                f[i] = v
+            return None, None, store
+        idx = scope.up_value(var)
+        if idx >= 0:
+            def store(f, v):
+                f[UP_VALUES][idx] = UpVal(v)
+            return None, None, store
+        g = self.globals
+        put = g.put_key if is_map_key(var) else g.put
+
+        def store(f, v):
+            put(var, v)
+        return None, None, store
+
+    def set_table(self, t, k, v):
+        if type(t) is Table:
+            t.put(k, v)
+        else:
+            self.stack._set_table(t, k, v)
+
+    def exp_list(self, exps, n):
+        # evaluates exps to n values, all values of the last one when n is -1
+        exps = list(exps)
+        if not exps:
+            return lambda f: [None] * max(n, 0)
+        multi = None
+        if is_vararg_or_call(exps[-1]) and (n < 0 or len(exps) < n):
+            multi = self.multi_exp(exps.pop())
+        singles = [self.exp(exp) for exp in exps]
+        if multi is None:
+            if n < 0 or len(singles) == n:
+                return lambda f: [e(f) for e in singles]
+            if len(singles) > n:
+                return lambda f: [e(f) for e in singles][:n]
+            pad = [None] * (n - len(singles))
+            return lambda f: [e(f) for e in singles] + pad
+        if n < 0:
+            def values(f):
+                vs = [e(f) for e in singles]
+                vs.extend(multi(f))
+                return vs
+        else:
+            rest = n - len(singles)
+
+            def values(f):
+                vs = [e(f) for e in singles]
+                vs.extend(adjust(multi(f), rest))
+                return vs
+        return values
+
+    def multi_exp(self, exp):
+        # closure returning all values of a call or vararg
+        if type(exp) is CallExp:
+            return self.call(exp)
+        return lambda f: f[VARARGS]
+
+    def exp(self, exp):
+        if type(exp) is str:
+            return self.name(exp)
+        t = type(exp)
+        if t is NilExp:
+            return lambda f: None
+        elif t is FalseExp:
+            return lambda f: False
+        elif t is TrueExp:
+            return lambda f: True
+        elif t is NumberExp or t is StringExp:
+            v = exp.content
+            return lambda f: v
+        elif t is ParenExp:
+            return self.exp(exp.exp)
+        elif t is VarargExp:
+            return lambda f: f[VARARGS][0] if f[VARARGS] else None
+        elif t is FuncDefExp:
+            return self.function(exp)
+        elif t is TableExp:
+            return self.table(exp)
+        elif t is CallExp:
+            call = self.call(exp)
+
+            def first(f):
+                r = call(f)
+                return r[0] if r else None
+            return first
+        elif t is AccessExp:
+            return self.access(exp)
+        elif t is ConcatExp:
+            exps = [self.exp(e) for e in exp.exps]
+            cat = partial(concat, self.stack)
+            return lambda f: cat(*[e(f) for e in exps])
+        elif t is BinopExp:
+            op = exp.op
+            if op == TOKEN.OP_AND or op == TOKEN.OP_OR:
+                return self.logic(op, self.exp(exp.exp1), self.exp(exp.exp2))
+            if op in compare_ops:
+                return self.compare(op, self.exp(exp.exp1), self.exp(exp.exp2))
+            return self.arith(op, exp.exp1, exp.exp2)
+        elif t is UnopExp:
+            return self.unary(exp.op, self.exp(exp.exp))
+        print('not support exp', t.__name__)
+        return lambda f: None
+
+    def name(self, name):
+        scope = self.scope
+        if name in scope.names:
+            i = LOCALS + scope.names[name]
+            return lambda f: f[i]
+        idx = scope.up_value(name)
+        if idx >= 0:
+            return lambda f: f[UP_VALUES][idx].val
+        g = self.globals
+        if name == '_ENV':
+            return lambda f: g
+        if not is_map_key(name):
+            return lambda f: g.get(name)
+        cache = KeyCache(name)
+
+        def value(f):
+            if g.version == cache.version:
+                return cache.value
+            return cache.get(g)
+        return value
+
+    def access(self, exp):
+        t = self.exp(exp.table)
+        key, is_const = constant_of(exp.key)
+        get = partial(index, self.stack)
+        if is_const and is_map_key(key):
+            cache = FieldCache(key)
+
+            def value(f):
+                tv = t(f)
+                if type(tv) is not Table:
+                    return get(tv, key)
+                if tv.shape is cache.shape:
+                    return tv.values[cache.index]
+                return cache.get(tv)
+            return value
+        if is_const:
+            def value(f):
+                tv = t(f)
+                return tv.get(key) if type(tv) is Table else get(tv, key)
+            return value
+        k = self.exp(exp.key)
+
+        def value(f):
+            tv = t(f)
+            kv = k(f)
+            return tv.get(kv) if type(tv) is Table else get(tv, kv)
+        return value
+
+    def logic(self, op, x, y):
+        if op == TOKEN.OP_AND:
+            def value(f):
+                v = x(f)
+                if v is None or v is False:
+                    return v
+                return y(f)
+        else:
+            def value(f):
+                v = x(f)
+                if v is None or v is False:
+                    return y(f)
+                return v
+        return value
+
+    def compare(self, op, x, y):
+        fast = compare_ops[op]
+        compare = self.stack.compare_v
+
+        def value(f):
+            a = x(f)
+            b = y(f)
+            if type(a) is type(b) is int:
+                return fast(a, b)
+            return compare(a, b, op)
+        return value
+
+    def arith(self, op, exp1, exp2):
+        arith = self.stack.arith_v
+        x = self.exp(exp1)
+        fast = int_ops.get(op, None)
+        k, is_const = constant_of(exp2)
+        if fast is not None and is_const and type(k) is int:
+            # the common i + 1 or n % 2
+            def value(f):
+                a = x(f)
+                if type(a) is int:
+                    return fast(a, k)
+                return arith(op, a, k)
+            return value
+        y = self.exp(exp2)
+        if fast is None:
+            return lambda f: arith(op, x(f), y(f))
+
+        def value(f):
+            a = x(f)
+            b = y(f)
+            if type(a) is int and type(b) is int:
+                return fast(a, b)
+            return arith(op, a, b)
+        return value
+
+    def unary(self, op, x):
+        arith = self.stack.arith_v
+        if op == TOKEN.OP_NOT:
+            def value(f):
+                v = x(f)
+                return v is None or v is False
+        elif op == TOKEN.OP_LEN:
+            get_len = partial(length, self.stack)
+            return lambda f: get_len(x(f))
+        elif op == TOKEN.OP_MINUS:
+            def value(f):
+                v = x(f)
+                return -v if type(v) is int else arith(op, v, v, True)
+        else:
+            def value(f):
+                v = x(f)
+                return ~v if type(v) is int else arith(op, v, v, True)
+        return value
+
+    def table(self, exp):
+        keys = exp.keys
+        values = exp.values
+        if not keys:
+            return lambda f: Table()
+        n_arr = len([k for k in keys if k is None])
+        multi_ret = is_vararg_or_call(values[-1])
+        # (key, value, flush), array items are stored in batches like set_list
+        fields = []
+        idx = 0
+        for i in range(len(keys)):
+            if keys[i] is None:
+                idx += 1
+                last_multi = i == len(keys) - 1 and multi_ret
+                v = self.multi_exp(values[i]) if last_multi else self.exp(values[i])
+                flush = idx % FIELDS_PER_FLUSH == 0 or idx == n_arr
+                fields.append((None, v, 2 if last_multi else int(flush)))
+            else:
+                fields.append((self.exp(keys[i]), self.exp(values[i]), 0))
+        set_table = self.set_table
+
+        def value(f):
+            t = Table()
+            items = []
+            idx = 0
+            for k, v, flush in fields:
+                if k is not None:
+                    set_table(t, k(f), v(f))
+                    continue
+                if flush == 2:
+                    items.extend(v(f))
+                else:
+                    items.append(v(f))
+                if flush:
+                    for item in items:
+                        idx += 1
+                        t.put(idx, item)
+                    items = []
+            return t
+        return value
+
+    def call(self, exp):
+        # closure returning all results of the call
+        func = self.exp(exp.exp)
+        args = self.exp_list(exp.args, -1)
+        call_value = self.vm.call_value
+        name = exp.name
+        if name is not None:
+            get = partial(index, self.stack)
+
+            def results(f):
+                obj = func(f)
+                fn = obj.get(name) if type(obj) is Table else get(obj, name)
+                a = args(f)
+                if type(fn) is Closure and fn.native is not None:
+                    return fn.native(obj, *a)
+                return call_value(fn, [obj] + a)
+            return results
+        n = len(exp.args)
+        if n > 3 or n > 0 and is_vararg_or_call(exp.args[-1]):
+            def results(f):
+                fn = func(f)
+                a = args(f)
+                if type(fn) is Closure and fn.native is not None:
+                    return fn.native(*a)
+                return call_value(fn, a)
+            return results
+        # plain calls for a few arguments, a call with *args nests the C stack
+        a1, a2, a3 = [self.exp(arg) for arg in exp.args] + [None] * (3 - n)
+        if n == 0:
+            def results(f):
+                fn = func(f)
+                if type(fn) is Closure and fn.native is not None:
+                    return fn.native()
+                return call_value(fn, ())
+        elif n == 1:
+            def results(f):
+                fn = func(f)
+                x = a1(f)
+                if type(fn) is Closure and fn.native is not None:
+                    return fn.native(x)
+                return call_value(fn, (x,))
+        elif n == 2:
+            def results(f):
+                fn = func(f)
+                x = a1(f)
+                y = a2(f)
+                if type(fn) is Closure and fn.native is not None:
+                    return fn.native(x, y)
+                return call_value(fn, (x, y))
+        else:
+            def results(f):
+                fn = func(f)
+                x = a1(f)
+                y = a2(f)
+                z = a3(f)
+                if type(fn) is Closure and fn.native is not None:
+                    return fn.native(x, y, z)
+                return call_value(fn, (x, y, z))
+        return results
+
+
+def compile_chunk(code, vm):
+    # returns the closure of the chunk, its functions share tables, closures
+    # and builtins with the VM
+    block = fold_constants(Parser(code).parse())
+    return Compiler(vm).compile(block)
@@ -0,0 +1,253 @@
+import sys
+import time
+import tracemalloc
+from vm import run
+from lua_table import Table
+from lexer import Lexer
+from parse import Parser
+from analyzer import intermediate
+from tokens import TOKEN
+
+# a loop that touches moves, constants, arithmetic, comparisons, tests,
+# jumps, table reads/writes, concat, upvalues and calls in roughly equal measure
+opcode_mix = '''
+local t = {}
+local s, f = 0, 0.5
+local str = ''
+local up = 1
+local function g(x) return x + up end
+for i = 1, 20000 do
+  local j = i % 7
+  s = s + i * 2 - j // 3
+  f = f / 2 + i
+  if j < 3 then
+    t[j] = s
+  elseif j == 5 then
+    s = s - (t[1] or 0) % 5
+  else
+    s = s ~ 1
+  end
+  if i % 1000 == 0 then str = str .. j end
+  s = g(s) & 0xffff
+end
+'''
+
+# integer and float arithmetic over the array part of tables
+array_kernel = '''
+local n = 2000
+local a, b = {}, {}
+for i = 1, n do
+  a[i] = i + 0.25
+  b[i] = n - i
+end
+local dot, sum = 0.0, 0
+for r = 1, 10 do
+  for i = 1, n do
+    dot = dot + a[i] * b[i]
+    sum = (sum + b[i] * 3) % 65536
+    b[i] = sum
+  end
+end
+'''
+
+# arrays filled backwards and in two interleaved passes, then read in order
+table_fill = '''
+local n = 20000
+local sum = 0
+for r = 1, 5 do
+  local a, b = {}, {}
+  for i = n, 1, -1 do a[i] = i end
+  for i = 2, n, 2 do b[i] = i end
+  for i = 1, n, 2 do b[i] = i end
+  for i = 1, n do sum = sum + a[i] + b[i] end
+end
+'''
+
+# traversal of a 100k entry table, half array part and half hash part
+table_pairs = '''
+local t = {}
+for i = 1, 50000 do t[i] = i end
+for i = 1, 50000 do t['k' .. i] = i end
+local n, sum = 0, 0
+for k, v in pairs(t) do
+  n = n + 1
+  sum = sum + v
+end
+'''
+
+# a stack grown with t[#t + 1] and shrunk with t[#t] = nil, after a hole
+table_length = '''
+local t = {}
+t[2] = 0
+for r = 1, 5 do
+  for i = 1, 20000 do t[#t + 1] = i end
+  for i = 1, 20000 do t[#t] = nil end
+end
+'''
+
+# small tables with the same string keys, made by constructors and read and
+# written by constant keys
+records = '''
+local ps = {}
+for i = 1, 20000 do
+  ps[i] = {x = i, y = i * 0.5, name = 'p'}
+end
+local sum = 0
+for r = 1, 5 do
+  for i = 1, 20000 do
+    local p = ps[i]
+    sum = sum + p["x"] + p["y"]
+    p["x"] = p["x"] + 1
+  end
+end
+'''
+
+# call heavy recursion
+fibonacci = '''
+function fib(n)
+  if n < 2 then return n end
+  return fib(n - 1) + fib(n - 2)
+end
+fib(20)
+'''
+
+# arithmetic, logic and string expressions with few statements, for the parser
+expressions = '''
+local a, b, c, d = 3, 4.5, 7, 2
+local s = 'x'
+local v = a * b + c / d - (a + b) * (c - d) % 5 ^ 2 ^ 0.5
+local w = -a ^ 2 + #s * 3 // 2 - ~c & 0xff | d << 2 ~ a >> 1
+local ok = a < b and b <= c or not (c > d) and d >= a or a == b and b ~= c
+local t = s .. a .. b .. (c + d) .. s .. -a .. (a < b and 'lt' or 'ge')
+local u = ((a + 1) * (b + 2) - (c + 3) / (d + 4)) * ((a - b) * (c - d) + 1)
+local r = (v > w) == (w > v) or #{a, b, c, d} + a * (b + c * (d + a * (b + c)))
+'''
+
+
+def bench(name, code, repeat=3, **options):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run(code, **options)
+        cost = time.perf_counter() - start
+        if best is None or cost < best:
+            best = cost
+    print('%-20s %8.3f s' % (name, best))
+    return best
+
+
+benchmarks = {
+    'opcode_mix': opcode_mix,
+    'array_kernel': array_kernel,
+    'table_fill': table_fill,
+    'table_pairs': table_pairs,
+    'table_length': table_length,
+    'records': records,
+    'fibonacci': fibonacci,
+}
+
+def bench_lexer(size=4 * 1024 * 1024, repeat=3):
+    # tokens per second over a chunk of about size characters, once as many
+    # short lines and once as a single long line
+    code = '\n'.join(benchmarks.values())
+    code = code * (size // len(code) + 1)
+    for name, chunk in [('lines', code), ('one_line', code.replace('\n', ' '))]:
+        best = None
+        for _ in range(repeat):
+            lexer = Lexer(chunk)
+            n = 0
+            start = time.perf_counter()
+            while lexer.next_token()[0] != TOKEN.EOF:
+                n += 1
+            cost = time.perf_counter() - start
+            if best is None or cost < best:
+                best = cost
+        print('%-20s %8.3f s %6.2f MB/s %9d tokens/s' % ('lexer/' + name, best, len(chunk) / best / 1e6, n / best))
+
+
+def bench_compile(size=2 * 1024 * 1024):
+    # memory of the syntax tree and time of the parser and of the whole
+    # compilation for a chunk of about size characters
+    body = 'do\n' + '\nend\ndo\n'.join(benchmarks.values()) + '\nend\n'
+    code = body * (size // len(body) + 1)
+    tracemalloc.start()
+    block = Parser(code).parse()
+    tree = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del block
+    start = time.perf_counter()
+    Parser(code).parse()
+    parse = time.perf_counter() - start
+    start = time.perf_counter()
+    intermediate(code)
+    total = time.perf_counter() - start
+    print('%-20s %8.3f s %8.1f MB tree' % ('compile/parse', parse, tree / 1e6))
+    print('%-20s %8.3f s' % ('compile/all', total))
+
+
+def bench_parser(size=2 * 1024 * 1024, repeat=3):
+    # parse time of a chunk of about size characters made of the expressions program
+    body = 'do' + expressions + 'end\n'
+    code = body * (size // len(body) + 1)
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        Parser(code).parse()
+        cost = time.perf_counter() - start
+        if best is None or cost < best:
+            best = cost
+    print('%-20s %8.3f s %6.2f MB/s' % ('parser/expressions', best, len(code) / best / 1e6))
+
+
+def bench_memory(n=1000000):
+    # bytes per element of the array part of tables of n integers and of n floats
+    for name, value in [('int', 1), ('float', 0.5)]:
+        tracemalloc.start()
+        t = Table()
+        for i in range(1, n + 1):
+            t.put(i, value * i)
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del t
+        print('%-20s %8.1f bytes/element' % ('memory/' + name, size / n))
+    # bytes per table of n records with the fields x, y and z
+    tracemalloc.start()
+    records = []
+    for i in range(n):
+        t = Table()
+        t.put('x', i)
+        t.put('y', 0.5)
+        t.put('z', 'z')
+        records.append(t)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del records
+    print('%-20s %8.1f bytes/table' % ('memory/records', size / n))
+
+
+# options of vm.run to compare
+engines = {
+    'threaded': {'threaded': True},
+    'dispatch': {'threaded': False},
+    'python': {'engine': 'python'},
+    'ast': {'engine': 'ast'},
+}
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(benchmarks) + ['lexer', 'parser', 'compile', 'memory']
+    for n in names:
+        if n == 'lexer':
+            bench_lexer()
+            continue
+        if n == 'parser':
+            bench_parser()
+            continue
+        if n == 'compile':
+            bench_compile()
+            continue
+        if n == 'memory':
+            bench_memory()
+            continue
+        for e, options in engines.items():
+            bench(n + '/' + e, benchmarks[n], **options)
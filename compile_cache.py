@@ -0,0 +1,123 @@
+import hashlib
+import mmap
+import os
+import tempfile
+from luac import VERSION, ChunkError, dump, undump
+from config import COMPILER_VERSION, CACHE_MAX_SIZE, READ_SIZE
+
+# binary chunks of compiled sources kept in a directory, a chunk is named by the
+# hash of its source and the versions of the compiler and of the chunk format,
+# and follows the sha256 digest of its bytes, a file that does not match its
+# digest is damaged and counts as a miss
+
+SUFFIX = '.luac'
+DIGEST_SIZE = hashlib.sha256().digest_size
+
+# the cache used by vm.run, None when caching is off
+active = None
+
+
+class CompileCache:
+
+    def __init__(self, directory, max_size=CACHE_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + SUFFIX)
+
+    def load(self, key, threaded=True):
+        # the cached Prototype of the source of key, None on a miss
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    with memoryview(data) as view:
+                        digest = hashlib.sha256(view[DIGEST_SIZE:]).digest()
+                    if digest != data[:DIGEST_SIZE]:
+                        raise ChunkError('damaged chunk')
+                    proto = undump(data, threaded, DIGEST_SIZE)
+            # recently used chunks are evicted last
+            os.utime(path)
+        except (OSError, ValueError, ChunkError):
+            # missing, empty or damaged
+            self.misses += 1
+            return None
+        self.hits += 1
+        return proto
+
+    def store(self, key, proto):
+        # writes a temporary file and renames it, so readers and concurrent
+        # writers of the same chunk never see it partly written
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            chunk = dump(proto)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(hashlib.sha256(chunk).digest())
+                f.write(chunk)
+            os.replace(tmp, self.path(key))
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return
+        self.evict()
+
+    def evict(self):
+        # removes the least recently used chunks until the directory fits in max_size
+        chunks = []
+        total = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.name.endswith(SUFFIX):
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                chunks.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+        chunks.sort()
+        for _, size, path in chunks:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # already removed by another process
+                pass
+            total -= size
+            self.evictions += 1
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+def source_key(code):
+    # the key of a source str, or of a file that is read in blocks and rewound
+    h = hashlib.sha256(b'%d.%d\0' % (COMPILER_VERSION, VERSION))
+    if type(code) is str:
+        h.update(code.encode('utf-8', 'surrogatepass'))
+        return h.hexdigest()
+    while True:
+        block = code.read(READ_SIZE)
+        if not block:
+            break
+        h.update(block.encode('utf-8', 'surrogatepass') if type(block) is str else block)
+    code.seek(0)
+    return h.hexdigest()
+
+
+def enable(directory, max_size=CACHE_MAX_SIZE):
+    # makes vm.run look up and store compiled chunks in directory
+    global active
+    active = CompileCache(directory, max_size)
+    return active
+
+
+def disable():
+    global active
+    active = None
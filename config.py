@@ -2,7 +2,18 @@
 REG_LIMIT = 255
 FIELDS_PER_FLUSH = 50
 MAX_STACK = 1000000
+# C stack of the thread running transpiled or compiled code
+THREAD_STACK_SIZE = 256 * 1024 * 1024
 REGISTRY_INDEX = - MAX_STACK - 1000
+# characters or bytes read from a source file at a time
+READ_SIZE = 64 * 1024
+# executions of an adaptive instruction before it is quickened, and after a failed guard
+QUICKEN_WARMUP = 8
+QUICKEN_BACKOFF = 64
+# bumped when the analyzer generates different code for the same source
+COMPILER_VERSION = 2
+# bytes kept in a compile cache directory
+CACHE_MAX_SIZE = 64 * 1024 * 1024
 
 # consts
 LUA_GLOBALS = 2
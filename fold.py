@@ -0,0 +1,159 @@
+import math
+from tokens import TOKEN
+from lua_stack import Stack
+from nodes import *
+
+# folds the constant expressions of the syntax tree made by Parser, a folded
+# expression is computed by the same Stack functions as at run time
+
+arith_ops = [TOKEN.OP_ADD, TOKEN.OP_MINUS, TOKEN.OP_MUL, TOKEN.OP_DIV, TOKEN.OP_IDIV, TOKEN.OP_MOD,
+             TOKEN.OP_POW, TOKEN.OP_BAND, TOKEN.OP_BOR, TOKEN.OP_BXOR, TOKEN.OP_SHL, TOKEN.OP_SHR]
+bitwise_ops = [TOKEN.OP_BAND, TOKEN.OP_BOR, TOKEN.OP_BXOR, TOKEN.OP_SHL, TOKEN.OP_SHR]
+compare_ops = [TOKEN.OP_LT, TOKEN.OP_LE, TOKEN.OP_GT, TOKEN.OP_GE, TOKEN.OP_EQ, TOKEN.OP_NE]
+unary_ops = [TOKEN.OP_NOT, TOKEN.OP_LEN, TOKEN.OP_MINUS, TOKEN.OP_WAVE]
+
+stack = Stack()
+
+
+def fold_constants(node):
+    # folds node and everything below it, returns the new node
+    if type(node) is list:
+        return [fold_constants(n) for n in node]
+    if type(node) is tuple:
+        return tuple(fold_constants(n) for n in node)
+    if not isinstance(node, Node):
+        return node
+    for k in node.__slots__:
+        v = getattr(node, k)
+        if type(v) in [list, tuple] or isinstance(v, Node):
+            setattr(node, k, fold_constants(v))
+    t = type(node)
+    if t is ConcatExp:
+        return fold_concat(node)
+    if t is BinopExp:
+        op = node.op
+        if op in [TOKEN.OP_AND, TOKEN.OP_OR]:
+            return fold_logic(node)
+        if op in arith_ops:
+            return fold_arith(node, op, node.exp1, node.exp2)
+        if op in compare_ops:
+            return fold_compare(node, op, node.exp1, node.exp2)
+    if t is UnopExp and node.op in unary_ops:
+        return fold_unary(node, node.op, node.exp)
+    if t is ParenExp and is_literal(node.exp):
+        return node.exp
+    return node
+
+
+def number_of(exp):
+    if type(exp) is NumberExp:
+        return exp.content
+    return None
+
+
+def string_of(exp):
+    if type(exp) is StringExp:
+        return exp.content
+    return None
+
+
+def constant(v, line):
+    if v is None:
+        return NilExp(line)
+    if v is True:
+        return TrueExp(line)
+    if v is False:
+        return FalseExp(line)
+    if type(v) is str:
+        return StringExp(v)
+    return NumberExp(v)
+
+
+def truthy(exp):
+    return type(exp) not in [NilExp, FalseExp]
+
+
+def fold_arith(node, op, exp1, exp2):
+    a = number_of(exp1)
+    b = number_of(exp2)
+    if a is None or b is None:
+        return node
+    if op in bitwise_ops:
+        if not (stack.convert_to_integer(a)[1] and stack.convert_to_integer(b)[1]):
+            return node
+        # keep huge shifts for run time
+        if op in [TOKEN.OP_SHL, TOKEN.OP_SHR] and abs(b) >= 64:
+            return node
+    try:
+        v = stack.arith_v(op, a, b)
+    except (ZeroDivisionError, OverflowError):
+        return node
+    # a negative base with a fractional power is complex in Python
+    if type(v) not in [int, float] or type(v) is float and math.isnan(v):
+        return node
+    return constant(v, node.line)
+
+
+def fold_compare(node, op, exp1, exp2):
+    a, b = number_of(exp1), number_of(exp2)
+    if a is None or b is None:
+        a, b = string_of(exp1), string_of(exp2)
+        if a is None or b is None:
+            return node
+    return constant(stack.compare_v(a, b, op), node.line)
+
+
+def fold_unary(node, op, exp):
+    line = node.line
+    if op == TOKEN.OP_NOT:
+        if is_literal(exp):
+            return constant(not truthy(exp), line)
+        # not (a == b) is a ~= b
+        if type(exp) is BinopExp and exp.op in [TOKEN.OP_EQ, TOKEN.OP_NE]:
+            exp.op = TOKEN.OP_NE if exp.op == TOKEN.OP_EQ else TOKEN.OP_EQ
+            return exp
+        return node
+    if op == TOKEN.OP_LEN:
+        s = string_of(exp)
+        return node if s is None else constant(len(s), line)
+    b = number_of(exp)
+    if b is None:
+        return node
+    if op == TOKEN.OP_WAVE and not stack.convert_to_integer(b)[1]:
+        return node
+    return constant(stack.arith_v(op, b, b, True), line)
+
+
+def fold_logic(node):
+    exp1 = node.exp1
+    if not is_literal(exp1):
+        return node
+    if truthy(exp1) == (node.op == TOKEN.OP_OR):
+        return exp1
+    exp2 = node.exp2
+    # the operand of and / or is truncated to one value
+    if is_vararg_or_call(exp2):
+        return ParenExp(exp2, node.line)
+    return exp2
+
+
+def fold_concat(node):
+    # joins the runs of adjacent string and number literals
+    exps = []
+    run = None
+    for exp in node.exps:
+        v = string_of(exp)
+        if v is None:
+            v = number_of(exp)
+        if v is None:
+            exps.append(exp)
+            run = None
+        elif run is None:
+            run = constant(str(v), -1)
+            exps.append(run)
+        else:
+            run.content += str(v)
+    if len(exps) == 1 and string_of(exps[0]) is not None:
+        return exps[0]
+    node.exps = exps
+    return node
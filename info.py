@@ -37,17 +37,21 @@ class FuncInfo:
         self.is_vararg = False
 
         self.ins = []
+        # instructions removed by peephole.optimize
+        self.removed = 0
 
     @staticmethod
     def error(s=""):
         print(s)
 
     def index_of_constant(self, c):
-        if c in self.constants:
-            return self.constants[c]
+        # keyed by type too, 5 and 5.0 or 1 and true are different constants
+        key = (type(c), c)
+        if key in self.constants:
+            return self.constants[key]
         else:
-            self.constants[c] = len(self.constants)
-            return self.constants[c]
+            self.constants[key] = len(self.constants)
+            return self.constants[key]
 
     def alloc_reg(self):
         self.used_regs += 1
@@ -1,124 +1,149 @@
 import re
+import codecs
 from tokens import *
+from config import READ_SIZE
 
 
-class Lexer:
+# blanks and comments, then one token in the group of its kind
+token_pattern = re.compile(
+    r"(?:[ \t\r\n\v\f]+|--[^\r\n]*)*"
+    r"(?:(0[xX](?:[0-9a-fA-F]+\.?[0-9a-fA-F]*|\.[0-9a-fA-F]+)(?:[pP][+\-]?[0-9]+)?"
+    r"|(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][+\-]?[0-9]+)?)"
+    r"|([^\W\d]\w*)"
+    r"|('(?:\\.|[^'\\\r\n])*'|\"(?:\\.|[^\"\\\r\n])*\")"
+    r"|(\.\.\.|\.\.|::|//|~=|==|<=|<<|>=|>>|[;,()\]{}+\-*^%&|#:/~=<>.])"
+    r"|(\[=*\[|\[)"
+    r"|(['\"]))?")
+NUMBER, NAME, STRING, OPERATOR, BRACKET, QUOTE = range(1, 7)
+# characters after a match that may still change it, as in 0x1 or 1e+5
+LOOKAHEAD = 16
+
+punctuations = dict(token_map)
+punctuations.update({'...': TOKEN.VARARG, '..': TOKEN.OP_CONCAT, '.': TOKEN.SEP_DOT})
 
-    number_pattern = re.compile(r"^0[xX]([0-9a-fA-F]+(\.)?[0-9a-fA-F]*|\.[0-9a-fA-F]+)([pP][+\-]?[0-9]+)?|"
-                                r"^([0-9]+(\.)?[0-9]*|\.[0-9]+)([eE][+\-]?[0-9]+)?")
-    var_pattern = re.compile(r"[_a-zA-z][\w]*")
+
+class Lexer:
 
     def __init__(self, chunk, chunk_name="", line=0, col=0):
-        self.chunk = [line.strip() for line in chunk.splitlines()]
+        # chunk is a str, or a file object or mmap that is read in blocks as the
+        # tokens are taken, self.chunk holds the text from the current token on
+        # and pos is the offset of the next token in it
+        if type(chunk) is str:
+            self.chunk = chunk
+            self.reader = None
+        else:
+            self.chunk = ''
+            self.reader = chunk
+        self.decoder = None
         self.chunk_name = chunk_name
-        self.line = line
-        self.col = col
+        self.line = 0
+        self.line_start = 0
+        self.pos = 0
+        while self.line < line and self.chunk.find('\n', self.pos) >= 0:
+            self.next_line(self.chunk.find('\n', self.pos))
+        self.pos += col
+
+    @property
+    def col(self):
+        return self.pos - self.line_start
+
+    def line_text(self):
+        # the part of the current line still in the buffer
+        start = max(self.line_start, 0)
+        end = self.chunk.find('\n', start)
+        return self.chunk[start: end if end >= 0 else len(self.chunk)].strip()
 
     def error(self, s=""):
-        print("Lexer Error: %s at line %d:%d %s" % (s, self.line + 1, self.col + 1, self.chunk[self.line]))
+        print("Lexer Error: %s at line %d:%d %s" % (s, self.line + 1, self.col + 1, self.line_text()))
 
-    def next_token(self):
-        self.skip_whitespace()
-        if self.line == len(self.chunk):
-            return TOKEN.EOF, "EOF"
-        if self.peek() in token_map:
-            token = self.peek()
-            self.next_char(len(token))
-            return token_map[token], token
-        elif self.cur_char() in token_map:
-            token = self.cur_char()
-            self.next_char()
-            return token_map[token], token
-        elif self.cur_char() == '.' and \
-                (self.col == len(self.chunk[self.line]) - 1 or not self.chunk[self.line][self.col + 1].isdigit()):
-            if self.test('...'):
-                self.next_char(3)
-                return TOKEN.VARARG, '...'
-            if self.test('..'):
-                self.next_char(2)
-                return TOKEN.OP_CONCAT, '..'
-            self.next_char()
-            return TOKEN.SEP_DOT, '.'
-        elif self.cur_char() == '[':
-            if self.test('[[') or self.test('[='):
-                return TOKEN.STRING, self.scan_long_string()
-            else:
-                self.next_char()
-                return TOKEN.SEP_LBRACK, '['
-        elif self.cur_char() == "'" or self.cur_char() == '"':
-            return TOKEN.STRING, self.scan_short_string()
-        elif self.cur_char() in '.1234567890':
-            match = re.match(self.number_pattern, self.chunk[self.line][self.col:])
-            if match is None:
-                self.error('incorrect number representation')
-            res = match.string[:match.span()[1]]
-            self.next_char(len(res))
-            return TOKEN.NUMBER, res
-        elif self.cur_char() is '_' or self.cur_char().isalpha():
-            match = re.match(self.var_pattern, self.chunk[self.line][self.col:])
-            res = match.string[:match.span()[1]]
-            self.next_char(len(res))
-            if res in keywords:
-                return keywords[res], res
-            else:
-                return TOKEN.IDENTIFIER, res
+    def next_line(self, newline):
+        # moves to the line after the line break at newline
+        self.line += 1
+        self.line_start = self.pos = newline + 1
+
+    def fill(self):
+        # appends the next block of the file to the buffer and drops the text
+        # before pos, False at the end of the file
+        if self.reader is None:
+            return False
+        data = self.reader.read(READ_SIZE)
+        if type(data) is not str:
+            if self.decoder is None:
+                self.decoder = codecs.getincrementaldecoder('utf-8')()
+            text = self.decoder.decode(data, not data)
         else:
-            self.error("illegal character %s" % self.cur_char())
+            text = data
+        if not data:
+            self.reader = None
+        drop = self.pos
+        self.chunk = self.chunk[drop:] + text
+        self.pos = 0
+        self.line_start -= drop
+        return True
 
-    def gen_next_token(self):
-        yield self.next_token()
-
-    def skip_whitespace(self):
-        while self.line < len(self.chunk):
-            if self.col == len(self.chunk[self.line]):
-                self.next_line()
-            elif self.test('--'):
-                self.skip_comment()
-            elif self.cur_char() in ['\t', '\r', '\v', '\f', ' ']:
-                self.next_char()
-            else:
+    def next_token(self):
+        chunk = self.chunk
+        while True:
+            m = token_pattern.match(chunk, self.pos)
+            kind = m.lastindex
+            start = m.start(kind) if kind else m.end()
+            # a match near the end of the buffer may go on in the next block,
+            # as may a quote without an end on the line
+            if self.reader is not None and (len(chunk) - m.end() < LOOKAHEAD or
+                                            kind == QUOTE and chunk.find('\n', start) < 0):
+                self.fill()
+                chunk = self.chunk
+                continue
+            n = chunk.count('\n', self.pos, start)
+            if n:
+                self.line += n
+                self.line_start = chunk.rfind('\n', self.pos, start) + 1
+            self.pos = m.end()
+            if kind is not None:
                 break
+            if start == len(chunk):
+                # the line after the last one, as in a list of lines
+                if start > self.line_start:
+                    self.line += 1
+                    self.line_start = start
+                return TOKEN.EOF, "EOF"
+            self.error("illegal character %s" % chunk[start])
+            self.pos = start + 1
+        token = m.group(kind)
+        if kind == NAME:
+            if token in keywords:
+                return keywords[token], token
+            return TOKEN.IDENTIFIER, token
+        if kind == OPERATOR:
+            return punctuations[token], token
+        if kind == NUMBER:
+            return TOKEN.NUMBER, token
+        if kind == STRING:
+            return TOKEN.STRING, self.process_string(token[1:-1])
+        if kind == BRACKET:
+            if token == '[':
+                return TOKEN.SEP_LBRACK, '['
+            return TOKEN.STRING, self.scan_long_string()
+        # a quote without an end takes the rest of the line
+        self.error('string without an end')
+        end = chunk.find('\n', start)
+        self.pos = end if end >= 0 else len(chunk)
+        return TOKEN.STRING, self.process_string(chunk[start + 1: self.pos].rstrip('\r'))
 
-    def cur_char(self):
-        if self.col < len(self.chunk[self.line]):
-            return self.chunk[self.line][self.col]
-        else:
-            return '\n'
-
-    def peek(self, n=1):
-        return self.chunk[self.line][self.col: self.col + n + 1]
-
-    def test(self, s):
-        return self.chunk[self.line][self.col:].startswith(s)
-
-    def next_line(self):
-        self.line += 1
-        self.col = 0
-
-    def next_char(self, n=1):
-        self.col += n
-
-    def skip_comment(self):
-        self.next_char(2)
-        if self.cur_char == '[':
-            self.scan_long_string()
-        else:
-            self.next_line()
+    def gen_next_token(self):
+        # the tokens up to the EOF one
+        while True:
+            token = self.next_token()
+            yield token
+            if token[0] == TOKEN.EOF:
+                return
 
     def scan_long_string(self):  # TODO: extract long strings P268
         self.error('not support long string')
 
-    def scan_short_string(self):
-        sep = self.cur_char()
-        end = self.chunk[self.line][self.col+1:].find(sep)
-        if end == -1:
-            self.error('string without an end')
-        s = self.chunk[self.line][self.col + 1: self.col + 1 + end]
-        res = self.process_string(s)
-        self.next_char(len(s) + 2)
-        return res
-
     def process_string(self, s):  # TODO: support numeral escape
+        if '\\' not in s:
+            return s
         res = ""
         i = 0
         while i < len(s):
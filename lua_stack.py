@@ -25,40 +25,49 @@ class Closure:
         if prototype is not None:
             up_len = len(prototype.up_values)
         self.up_values = [None] * up_len
+        # Python function made by the transpiler, takes the arguments and returns the results
+        self.native = None
 
 
 class Stack:
+    # a call frame over the register file shared by all frames of a VM,
+    # index 1 of the frame is slots[base]
 
-    def __init__(self, closure=None, prev=None, state=None):
-        self.slots = []
+    def __init__(self, slots=None, base=0, closure=None, prev=None, state=None):
+        self.slots = [] if slots is None else slots
+        self.base = base
         self.prev = prev
         self.state = state
         self.closure = closure
-        self.varargs = []
+        self.varargs = ()
         self.pc = 0
         self.open_uvs = {}
+        # number of results expected by the calling instruction, None when called by VM.call
+        self.n_results = None
 
     def error(self, s=""):
         print('Lua Core error: %s' % s)
         print('current stack:')
-        print(self.slots)
+        print(self.slots[self.base:])
 
     def push(self, v):
         self.slots.append(v)
-        if len(self) > MAX_STACK:
+        if len(self.slots) > MAX_STACK:
             self.error('lua stack overflow')
 
     def push_n(self, args, n):
         if n < 0:
             n = len(args)
-        for i in range(n):
-            if i >= len(args):
-                self.push(None)
-            else:
-                self.push(args[i])
+        if n <= len(args):
+            self.slots.extend(args[:n])
+        else:
+            self.slots.extend(args)
+            self.slots.extend([None] * (n - len(args)))
+        if len(self.slots) > MAX_STACK:
+            self.error('lua stack overflow')
 
     def pop(self, n=1):
-        if len(self.slots) < n:
+        if len(self) < n:
             self.error('illegal pop: empty stack')
             return None
         else:
@@ -68,10 +77,10 @@ class Stack:
             return res
 
     def pop_n(self, n):
-        res = []
-        for _ in range(n):
-            res.append(self.slots.pop())
-        res.reverse()
+        if n == 0:
+            return []
+        res = self.slots[-n:]
+        del self.slots[-n:]
         return res
 
     def is_valid(self, idx):
@@ -81,7 +90,7 @@ class Stack:
         if idx == REGISTRY_INDEX:
             return True
         idx = self.abs_index(idx)
-        return 0 <= idx - 1 < len(self.slots)
+        return 0 <= idx - 1 < len(self)
 
     def get(self, idx):
         if idx < REGISTRY_INDEX:
@@ -92,9 +101,11 @@ class Stack:
                 return None
         if idx == REGISTRY_INDEX:
             return self.state.registry
-        idx = self.abs_index(idx)
-        if self.is_valid(idx):
-            return self.slots[idx - 1]
+        n = len(self.slots) - self.base
+        if idx < 0:
+            idx += n + 1
+        if 0 < idx <= n:
+            return self.slots[self.base + idx - 1]
         return None
 
     def set(self, idx, val):
@@ -106,15 +117,14 @@ class Stack:
         if idx == REGISTRY_INDEX:
             self.state.registry = val
             return
-        idx = self.abs_index(idx)
-        if idx > MAX_STACK:
-            self.error('lua stack overflow')
-        if self.is_valid(idx):
-            self.slots[idx - 1] = val
-        elif idx > len(self.slots):
-            while idx > len(self.slots):
-                self.slots.append(None)
-            self.slots[idx - 1] = val
+        n = len(self.slots) - self.base
+        if idx < 0:
+            idx += n + 1
+        if 0 < idx <= n:
+            self.slots[self.base + idx - 1] = val
+        elif idx > n:
+            self.set_top(idx)
+            self.slots[self.base + idx - 1] = val
 
     def get_top(self):
         return self.slots[-1]
@@ -139,24 +149,28 @@ class Stack:
         if idx >= 0 or idx <= REGISTRY_INDEX:
             return idx
         else:
-            return len(self.slots) + idx + 1
+            return len(self) + idx + 1
 
     def rotate(self, idx, step):
         t = len(self.slots) - 1
-        p = self.abs_index(idx) - 1
+        p = self.base + self.abs_index(idx) - 1
         if t - p + 1 == 0:
             return
         step = (-step) % (t - p + 1)
-        self.slots = self.slots[:p] + self.slots[p + step:] + self.slots[p: p + step]
+        self.slots[p:] = self.slots[p + step:] + self.slots[p: p + step]
 
     def set_top(self, idx):
         idx = self.abs_index(idx)
         if idx < 0:
             self.error('stack underflow')
-        while len(self.slots) > idx:
-            self.pop()
-        while len(self.slots) < idx:
-            self.push(None)
+        top = self.base + idx
+        n = len(self.slots)
+        if n > top:
+            del self.slots[top:]
+        elif n < top:
+            if top > MAX_STACK:
+                self.error('lua stack overflow')
+            self.slots.extend([None] * (top - n))
 
     def type(self, idx):
         if not self.is_valid(idx):
@@ -238,10 +252,10 @@ class Stack:
         return "", False
 
     def __repr__(self):
-        return self.slots.__repr__()
+        return self.slots[self.base:].__repr__()
 
     def __len__(self):
-        return len(self.slots)
+        return len(self.slots) - self.base
 
     def arith(self, op, uni_op=False):
         b = self.pop()
@@ -249,29 +263,34 @@ class Stack:
             a = b
         else:
             a = self.pop()
+        v = self.arith_v(op, a, b, uni_op)
+        if v is not None:
+            self.push(v)
+
+    def arith_v(self, op, a, b, uni_op=False):
         if op in [TOKEN.OP_BAND, TOKEN.OP_BOR, TOKEN.OP_BXOR, TOKEN.OP_SHL, TOKEN.OP_SHR]:
             b, bf = self.convert_to_integer(b)
             a, af = self.convert_to_integer(a)
             if af and bf:
                 if op == TOKEN.OP_BAND:
-                    self.push(a & b)
+                    return a & b
                 elif op == TOKEN.OP_BOR:
-                    self.push(a | b)
+                    return a | b
                 elif op == TOKEN.OP_BXOR:
                     if uni_op:
-                        self.push(~b)
+                        return ~b
                     else:
-                        self.push(a ^ b)
+                        return a ^ b
                 elif op == TOKEN.OP_SHL:
                     if b >= 0:
-                        self.push(a << b)
+                        return a << b
                     else:
-                        self.push(a >> (-b))
+                        return a >> (-b)
                 elif op == TOKEN.OP_SHR:
                     if b >= 0:
-                        self.push(a >> b)
+                        return a >> b
                     else:
-                        self.push(a << -b)
+                        return a << -b
             else:
                 self.error('illegal bitwise computation ' + op)
         elif op in [TOKEN.OP_DIV, TOKEN.OP_POW]:
@@ -279,9 +298,9 @@ class Stack:
             a, af = self.convert_to_float(a)
             if af and bf:
                 if op == TOKEN.OP_DIV:
-                    self.push(a / b)
+                    return a / b
                 elif op == TOKEN.OP_POW:
-                    self.push(a ** b)
+                    return a ** b
             else:
                 self.error('illegal computation ' + op)
         else:
@@ -295,18 +314,18 @@ class Stack:
                 a, af = self.convert_to_float(a)
             if bf and af:
                 if op == TOKEN.OP_ADD:
-                    self.push(a + b)
+                    return a + b
                 elif op == TOKEN.OP_MINUS:
                     if uni_op:
-                        self.push(-b)
+                        return -b
                     else:
-                        self.push(a - b)
+                        return a - b
                 elif op == TOKEN.OP_MUL:
-                    self.push(a * b)
+                    return a * b
                 elif op == TOKEN.OP_IDIV:
-                    self.push(a // b)
+                    return a // b
                 elif op == TOKEN.OP_MOD:
-                    self.push(a % b)
+                    return a % b
                 else:
                     self.error(op + 'not support')
             else:
@@ -356,20 +375,21 @@ class Stack:
         self.error('illegal comparison')
 
     def compare(self, idx1, idx2, op):
-        if op == TOKEN.OP_GT:
-            return self.compare(idx2, idx1, TOKEN.OP_LT)
-        if op == TOKEN.OP_GE:
-            return self.compare(idx2, idx1, TOKEN.OP_LE)
-        if op == TOKEN.OP_NE:
-            return not self.compare(idx1, idx2, TOKEN.OP_EQ)
-        a = self.get(idx1)
-        b = self.get(idx2)
-        if op == TOKEN.OP_EQ:
-            return self._eq(a, b)
+        return self.compare_v(self.get(idx1), self.get(idx2), op)
+
+    def compare_v(self, a, b, op):
         if op == TOKEN.OP_LT:
             return self._lt(a, b)
         if op == TOKEN.OP_LE:
             return self._le(a, b)
+        if op == TOKEN.OP_EQ:
+            return self._eq(a, b)
+        if op == TOKEN.OP_NE:
+            return not self._eq(a, b)
+        if op == TOKEN.OP_GT:
+            return self._lt(b, a)
+        if op == TOKEN.OP_GE:
+            return self._le(b, a)
         self.error('invalid compare op ' + str(op))
 
     def create_table(self):
@@ -1,57 +1,452 @@
-from lua_utils import convert_to_integer
+from array import array
+from collections import Counter
+from weakref import WeakValueDictionary
+
+
+def is_map_key(key):
+    # a string key, strings are never converted to integer keys
+    return type(key) is str
+
+
+def integer_key(key):
+    # (the int, True) for an int and for a float with an integral value, which
+    # are stored as int so 2.0 and 2 are the same key, (key, False) otherwise
+    if type(key) is float and key % 1 == 0:
+        return int(key), True
+    return key, type(key) is int
+
+
+# size of map that first triggers a rehash
+MIN_REHASH = 4
+# length of arr at which it is first checked for a typed array
+MIN_PACK = 16
+# limits of the string keys of a shape, of the shapes made from one shape other
+# than the empty one, of the shapes of one first key and of the first keys in
+# use, a table adding a key past them keeps its string keys in map
+MAX_SHAPE_KEYS = 32
+MAX_TRANSITIONS = 16
+MAX_TREE_SHAPES = 4096
+MAX_FIRST_KEYS = 1024
+
+# the arr and the map of a table that has not written to them yet, replaced on
+# the first write so tables with only shaped keys share them
+EMPTY_ARR = []
+EMPTY_MAP = {}
+
+
+class Shape:
+    # the string keys of a table in the order they were added, tables that add
+    # the same keys in the same order share one shape and keep the value of
+    # keys[i] in their values[i]
+    __slots__ = ('keys', 'index', 'transitions', 'tree', 'parent', '__weakref__')
+
+    def __init__(self, keys, tree=None, parent=None):
+        self.keys = keys
+        self.index = {k: i for i, k in enumerate(keys)}
+        # the shape after adding each key
+        self.transitions = {}
+        # [the number of shapes] shared by the shapes of the same first key,
+        # None for the empty shape
+        self.tree = tree
+        # keeps the shapes before this one alive
+        self.parent = parent
+
+    def add(self, key):
+        # the shape with key added, None past the limits
+        s = self.transitions.get(key)
+        if s is None:
+            tree = self.tree
+            if tree is None:
+                # every record type gets its own tree
+                if len(self.transitions) >= MAX_FIRST_KEYS:
+                    return None
+                tree = [0]
+            elif (len(self.keys) >= MAX_SHAPE_KEYS or len(self.transitions) >= MAX_TRANSITIONS
+                    or tree[0] >= MAX_TREE_SHAPES):
+                return None
+            s = Shape(self.keys + (key,), tree, self)
+            self.transitions[key] = s
+            tree[0] += 1
+        return s
+
+
+EMPTY_SHAPE = Shape(())
+# the empty shape holds the shapes of one key weakly, the tree of a first key
+# is freed with the last table or cache using one of its shapes
+EMPTY_SHAPE.transitions = WeakValueDictionary()
+# the shape of no table, for empty caches
+NO_SHAPE = Shape(())
 
 
 class Table:
+    # the array part arr holds the keys 1..len(arr), its last item is never nil
+    # and the key len(arr) + 1 is never in map, so len(arr) is a border, arr is a
+    # list or an array('q') or array('d') while all its items are int or float,
+    # string keys are laid out by shape in values until the shape is full, then
+    # shape and values are None and they go to map with the other keys
+    __slots__ = ('arr', 'kind', 'pack_at', 'map', 'shape', 'values', 'iter_keys', 'iter_pos',
+                 'iter_key', 'iter_at', 'version', 'rehash_at')
 
     def __init__(self):
-        self.arr = []
-        self.map = {}
-        self.keys = {}
-        self.modified = True
+        self.arr = EMPTY_ARR
+        # the type of the items of a typed arr, None for a list
+        self.kind = None
+        # appending to arr up to this length checks it for a typed array
+        self.pack_at = MIN_PACK
+        self.map = EMPTY_MAP
+        # a cleared field keeps its slot with a nil value
+        self.shape = EMPTY_SHAPE
+        self.values = []
+        # keys of map in traversal order made by next_key, and the position of
+        # each one, dropped when a key is added to map
+        self.iter_keys = None
+        self.iter_pos = None
+        # the last key of map returned by next_key and its position
+        self.iter_key = None
+        self.iter_at = 0
+        # bumped on every write to map, checked by KeyCache
+        self.version = 0
+        # inserting an integer key in a map this large resizes arr
+        self.rehash_at = MIN_REHASH
 
     def get(self, key):
-        idx, int_flag = convert_to_integer(key)
-        if int_flag and 1 <= idx <= len(self.arr):
+        if type(key) is int:
+            idx = key
+        else:
+            idx, int_flag = integer_key(key)
+            if not int_flag:
+                return self.get_key(key)
+        if 0 < idx <= len(self.arr):
             return self.arr[idx - 1]
+        return self.map.get(idx, None)
+
+    def get_key(self, key):
+        # get for a key that is not an integer
+        shape = self.shape
+        if shape is not None:
+            i = shape.index.get(key)
+            if i is not None:
+                return self.values[i]
         return self.map.get(key, None)
 
     def put(self, key, val):
         assert key is not None
-        self.modified = True
-        idx, int_flag = convert_to_integer(key)
-        if int_flag and idx >= 1:
-            if idx <= len(self.arr):
-                self.arr[idx - 1] = val
-                if idx == len(self.arr) and val is None:
-                    self.arr.pop()
-                return
-            if idx == len(self.arr) + 1:
-                self.map.pop(idx, 0)
+        if type(key) is int:
+            idx = key
+        else:
+            idx, int_flag = integer_key(key)
+            if not int_flag:
+                self.put_key(key, val)
+                return
+        arr = self.arr
+        n = len(arr)
+        if 0 < idx <= n:
+            if self.kind is not None:
+                if type(val) is self.kind:
+                    try:
+                        arr[idx - 1] = val
+                        return
+                    except OverflowError:
+                        pass
+                elif val is None and idx == n:
+                    arr.pop()
+                    return
+                arr = self.unpack()
+            arr[idx - 1] = val
+            if idx == n and val is None:
+                while arr and arr[-1] is None:
+                    arr.pop()
+            return
+        if idx == n + 1 and val is not None:
+            if self.kind is not None and type(val) is not self.kind or arr is EMPTY_ARR:
+                arr = self.unpack()
+            try:
+                arr.append(val)
+            except OverflowError:
+                arr = self.unpack()
+                arr.append(val)
+            m = self.map
+            if m:
+                # the keys following arr move over from map
+                val = m.pop(idx + 1, None)
                 if val is not None:
-                    self.arr.append(val)
+                    if self.kind is not None:
+                        arr = self.unpack()
+                    while val is not None:
+                        arr.append(val)
+                        idx += 1
+                        val = m.pop(idx + 1, None)
+                    self.version += 1
+            if len(arr) >= self.pack_at:
+                self.pack()
+            return
+        # integer keys are stored as int, 2.0 and 2 are the same key
+        m = self.map
+        if val is None:
+            if m.pop(idx, None) is not None:
+                self.version += 1
+            return
+        if m is EMPTY_MAP:
+            m = self.map = {}
+        if (self.iter_keys is not None or len(m) >= self.rehash_at) and idx not in m:
+            self.end_traversal()
+            if len(m) >= self.rehash_at and idx > 0:
+                m[idx] = val
+                self.version += 1
+                self.rehash()
+                return
+        m[idx] = val
+        self.version += 1
+
+    def put_key(self, key, val):
+        # put for a key that is not an integer
+        shape = self.shape
+        if shape is not None and type(key) is str:
+            i = shape.index.get(key)
+            if i is not None:
+                self.values[i] = val
+                self.version += 1
+                return
+            if val is None:
+                return
+            shape = shape.add(key)
+            if shape is not None:
+                if self.iter_keys is not None:
+                    self.end_traversal()
+                self.shape = shape
+                self.values.append(val)
+                self.version += 1
                 return
+            self.unshape()
+        m = self.map
         if val is not None:
-            self.map[key] = val
+            if m is EMPTY_MAP:
+                m = self.map = {}
+            if self.iter_keys is not None and key not in m:
+                self.end_traversal()
+            m[key] = val
+            self.version += 1
+        elif m.pop(key, None) is not None:
+            self.version += 1
 
-    def next_key(self, key):
-        if key is None or self.modified:
-            self.init_keys()
-            self.modified = True
-        return self.keys.get(key, None)
-
-    def init_keys(self):
-        key = None
-        for i in range(len(self.arr)):
-            if self.arr[i] is not None:
-                self.keys[key] = i + 1
-                key = i + 1
-        for k, v in self.map.items():
+    def unshape(self):
+        # moves the string keys from values to map
+        m = self.map
+        if m is EMPTY_MAP:
+            m = self.map = {}
+        for k, v in zip(self.shape.keys, self.values):
             if v is not None:
-                self.keys[key] = k
-                key = k
+                m[k] = v
+        self.shape = self.values = None
+
+    def map_keys(self):
+        # the keys outside arr in traversal order
+        keys = list(self.map)
+        if self.shape is not None:
+            keys.extend(self.shape.keys)
+        return keys
+
+    def end_traversal(self):
+        # a key added to map during a traversal makes next undefined as in Lua
+        self.iter_keys = self.iter_pos = self.iter_key = None
+
+    def pack(self):
+        # makes arr a typed array if its items are all int or all float, the
+        # next check is at twice the length
+        arr = self.arr
+        self.pack_at = 2 * len(arr)
+        if self.kind is not None:
+            return
+        kinds = set(map(type, arr))
+        if len(kinds) != 1:
+            return
+        kind = kinds.pop()
+        if kind is int:
+            try:
+                self.arr = array('q', arr)
+            except OverflowError:
+                return
+            self.kind = int
+        elif kind is float:
+            self.arr = array('d', arr)
+            self.kind = float
+
+    def unpack(self):
+        # makes arr a list of its own again before a write of another type or
+        # the first write
+        self.arr = list(self.arr)
+        self.kind = None
+        return self.arr
+
+    def migrate(self):
+        # moves the keys following arr from map
+        arr = self.arr
+        m = self.map
+        v = m.pop(len(arr) + 1, None)
+        if v is None:
+            return
+        while v is not None:
+            arr.append(v)
+            v = m.pop(len(arr) + 1, None)
+        self.version += 1
+
+    def rehash(self):
+        # resizes arr to the largest power of two n for which more than n / 2 of
+        # the keys 1..n are used, as computesizes in ltable.c, the slots of arr count
+        # as used so arr only grows and a rehash only scans map
+        arr = self.arr
+        m = self.map
+        n_arr = len(arr)
+        keys = [k - 1 for k in m if type(k) is int and k > n_arr]
+        # the keys in (2 ** (i - 1), 2 ** i] for each i
+        nums = Counter(map(int.bit_length, keys))
+        total = n_arr + len(keys)
+        used = 0
+        size = 0
+        i = 0
+        two_to_i = 1
+        while total > two_to_i // 2:
+            used += nums[i] + max(0, min(n_arr, two_to_i) - two_to_i // 2)
+            if used > two_to_i // 2:
+                size = two_to_i
+            i += 1
+            two_to_i *= 2
+        if size > n_arr:
+            if self.kind is not None or arr is EMPTY_ARR:
+                arr = self.unpack()
+            arr.extend([None] * (size - n_arr))
+            for k in keys:
+                if k < size:
+                    arr[k] = m.pop(k + 1)
+            while arr[-1] is None:
+                arr.pop()
+            self.version += 1
+            self.migrate()
+        self.rehash_at = max(MIN_REHASH, 2 * len(m))
+
+    def next_key(self, key):
+        # the key after key in a traversal, the first key for None and None after
+        # the last one, arr is walked by index and map by the positions of iter_keys,
+        # a field cleared during the traversal keeps its position
+        arr = self.arr
+        if key is None:
+            i = 0
+        else:
+            if type(key) is int:
+                idx, int_flag = key, True
+            else:
+                idx, int_flag = integer_key(key)
+                if int_flag:
+                    key = idx
+            if int_flag and 0 < idx <= len(arr):
+                i = idx
+            elif key == self.iter_key:
+                return self.next_map_key(self.iter_at + 1)
+            else:
+                if self.iter_pos is None:
+                    if self.iter_keys is None:
+                        self.iter_keys = self.map_keys()
+                    self.iter_pos = {k: p for p, k in enumerate(self.iter_keys)}
+                p = self.iter_pos.get(key, None)
+                if p is not None:
+                    return self.next_map_key(p + 1)
+                if not int_flag or idx <= 0:
+                    return None
+                # the end of arr was cleared during the traversal
+                i = len(arr)
+        n = len(arr)
+        while i < n:
+            if arr[i] is not None:
+                return i + 1
+            i += 1
+        return self.next_map_key(0)
+
+    def next_map_key(self, p):
+        # the first key outside arr at position p of iter_keys or after it
+        keys = self.iter_keys
+        if keys is None:
+            keys = self.iter_keys = self.map_keys()
+        n = len(keys)
+        while p < n:
+            k = keys[p]
+            if self.get_key(k) is not None:
+                self.iter_key = k
+                self.iter_at = p
+                return k
+            p += 1
+        return None
 
     def __len__(self):
+        # the border that luaH_getn finds, put keeps len(arr) a border so the
+        # binary searches of arr and of map are never needed
         return len(self.arr)
 
     def __repr__(self):
-        return '-arr: ' + repr(self.arr) + ' -map: ' + repr(self.map)
+        m = dict(self.map)
+        if self.shape is not None:
+            m.update((k, v) for k, v in zip(self.shape.keys, self.values) if v is not None)
+        return '-arr: ' + repr(list(self.arr)) + ' -map: ' + repr(m)
+
+
+class KeyCache:
+    # inline cache of the lookup of one constant key,
+    # valid while the table and its version are unchanged
+    __slots__ = ['key', 'table', 'version', 'value']
+
+    def __init__(self, key):
+        self.key = key
+        self.table = None
+        self.version = -1
+        self.value = None
+
+    def get(self, t):
+        if t is not self.table or t.version != self.version:
+            self.table = t
+            self.version = t.version
+            self.value = t.get_key(self.key)
+        return self.value
+
+
+class FieldCache:
+    # inline cache of the slot of one constant string key, valid for every table
+    # of shape, a store that added the key caches the shape before it and the
+    # shape after it in next_shape
+    __slots__ = ['key', 'shape', 'index', 'next_shape']
+
+    def __init__(self, key):
+        self.key = key
+        self.shape = NO_SHAPE
+        self.index = 0
+        self.next_shape = None
+
+    def get(self, t):
+        shape = t.shape
+        if shape is not None:
+            i = shape.index.get(self.key)
+            if i is not None:
+                self.shape = shape
+                self.index = i
+                self.next_shape = None
+                return t.values[i]
+        return t.get_key(self.key)
+
+    def put(self, t, val):
+        if t.shape is self.shape:
+            if self.next_shape is None:
+                t.values[self.index] = val
+                t.version += 1
+                return
+            if val is not None and t.iter_keys is None:
+                t.shape = self.next_shape
+                t.values.append(val)
+                t.version += 1
+                return
+        shape = t.shape
+        t.put_key(self.key, val)
+        if t.shape is None:
+            return
+        i = t.shape.index.get(self.key)
+        if i is not None:
+            self.shape = shape
+            self.index = i
+            self.next_shape = None if t.shape is shape else t.shape
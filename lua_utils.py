@@ -1,3 +1,6 @@
+import math
+
+
 # type conversion
 def convert_to_integer(v):
     if type(v) is int:
@@ -30,4 +33,23 @@ def convert_to_float(v):
 
 
 def convert_to_boolean(v):
-    return not (v is None or v is False)
\ No newline at end of file
+    return not (v is None or v is False)
+
+
+def for_count(i, limit, step):
+    # iterations of a numeric for with an integer start and a non zero integer step,
+    # a float limit is rounded toward the start and clipped to 64 bits as in Lua 5.4
+    if type(limit) is float:
+        if limit != limit:
+            return 0
+        if limit >= 2 ** 63:
+            limit = 2 ** 63 - 1
+        elif limit < -2 ** 63:
+            limit = -2 ** 63
+        else:
+            limit = math.floor(limit) if step > 0 else math.ceil(limit)
+    elif type(limit) is not int:
+        return 0
+    if step > 0:
+        return (limit - i) // step + 1 if i <= limit else 0
+    return (i - limit) // -step + 1 if i >= limit else 0
@@ -0,0 +1,151 @@
+import struct
+import sys
+from vm import Prototype, ProtoUpValue
+
+# binary chunks of Prototype trees, loading one needs neither the lexer, the
+# parser nor the analyzer, VERSION changes with the format or the opcodes
+SIGNATURE = b'\x1bLuaPy'
+VERSION = 1
+
+# constant tags
+NIL = b'n'
+BOOL = b'b'
+INT = b'i'
+BIG_INT = b'I'
+FLOAT = b'f'
+STRING = b's'
+
+INST = struct.Struct('<Biii')
+
+
+class ChunkError(Exception):
+    pass
+
+
+def dump(proto):
+    # bytes of the prototype of a main chunk and its nested prototypes
+    out = [SIGNATURE, struct.pack('<B', VERSION)]
+    dump_proto(out, proto)
+    return b''.join(out)
+
+
+def dump_proto(out, proto):
+    out.append(struct.pack('<BBI', proto.num_params, proto.is_vararg, proto.max_stack))
+    out.append(struct.pack('<I', len(proto.code)))
+    out.extend(INST.pack(*inst) for inst in proto.code)
+    out.append(struct.pack('<I', len(proto.constants)))
+    for k in proto.constants:
+        dump_constant(out, k)
+    out.append(struct.pack('<I', len(proto.up_values)))
+    for uv in proto.up_values:
+        out.append(struct.pack('<BI', uv.in_stack, uv.idx))
+    out.append(struct.pack('<I', len(proto.prototypes)))
+    for sub in proto.prototypes:
+        dump_proto(out, sub)
+
+
+def dump_constant(out, k):
+    if k is None:
+        out.append(NIL)
+    elif type(k) is bool:
+        out.append(BOOL + struct.pack('<B', k))
+    elif type(k) is int:
+        if -2 ** 63 <= k < 2 ** 63:
+            out.append(INT + struct.pack('<q', k))
+        else:
+            # integers are not bounded in the vm
+            s = str(k).encode()
+            out.append(BIG_INT + struct.pack('<I', len(s)) + s)
+    elif type(k) is float:
+        out.append(FLOAT + struct.pack('<d', k))
+    elif type(k) is str:
+        s = k.encode('utf-8', 'surrogatepass')
+        out.append(STRING + struct.pack('<I', len(s)) + s)
+    else:
+        raise ChunkError('can not dump constant %r' % (k,))
+
+
+class ChunkReader:
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def read(self, fmt):
+        try:
+            values = struct.unpack_from(fmt, self.data, self.pos)
+        except struct.error:
+            raise ChunkError('truncated chunk')
+        self.pos += struct.calcsize(fmt)
+        return values
+
+    def read_bytes(self, n):
+        if self.pos + n > len(self.data):
+            raise ChunkError('truncated chunk')
+        b = self.data[self.pos: self.pos + n]
+        self.pos += n
+        return b
+
+
+def undump(data, threaded=True, start=0):
+    # the Prototype of the main chunk made by dump in data from start on, data
+    # is any buffer such as bytes or an mmap
+    if data[start:start + len(SIGNATURE)] != SIGNATURE:
+        raise ChunkError('not a binary chunk')
+    r = ChunkReader(data)
+    r.pos = start + len(SIGNATURE)
+    version, = r.read('<B')
+    if version != VERSION:
+        raise ChunkError('chunk version %d, expected %d' % (version, VERSION))
+    proto = undump_proto(r, threaded)
+    if r.pos != len(data):
+        raise ChunkError('trailing bytes after chunk')
+    return proto
+
+
+def undump_proto(r, threaded):
+    proto = Prototype.__new__(Prototype)
+    proto.info = None
+    proto.num_params, is_vararg, proto.max_stack = r.read('<BBI')
+    proto.is_vararg = bool(is_vararg)
+    n, = r.read('<I')
+    proto.code = list(INST.iter_unpack(r.read_bytes(n * INST.size)))
+    n, = r.read('<I')
+    proto.constants = [undump_constant(r) for _ in range(n)]
+    n, = r.read('<I')
+    proto.up_values = [ProtoUpValue(*r.read('<BI')) for _ in range(n)]
+    n, = r.read('<I')
+    proto.prototypes = [undump_proto(r, threaded) for _ in range(n)]
+    proto.load(threaded)
+    return proto
+
+
+def undump_constant(r):
+    tag = r.read_bytes(1)
+    if tag == NIL:
+        return None
+    if tag == BOOL:
+        return bool(r.read('<B')[0])
+    if tag == INT:
+        return r.read('<q')[0]
+    if tag == BIG_INT:
+        return int(r.read_bytes(r.read('<I')[0]))
+    if tag == FLOAT:
+        return r.read('<d')[0]
+    if tag == STRING:
+        return r.read_bytes(r.read('<I')[0]).decode('utf-8', 'surrogatepass')
+    raise ChunkError('bad constant tag %r' % tag)
+
+
+def compile_file(src, dst):
+    # writes the binary chunk of the Lua source file src to dst
+    from analyzer import intermediate
+    with open(src, 'r') as f:
+        proto = Prototype(intermediate(f), threaded=False).prototypes[0]
+    with open(dst, 'wb') as f:
+        f.write(dump(proto))
+
+
+if __name__ == '__main__':
+    # python luac.py input.lua output.luac
+    compile_file(sys.argv[1], sys.argv[2])
@@ -0,0 +1,265 @@
+from tokens import TOKEN
+
+# nodes of the syntax tree made by Parser, names are plain str, the other
+# nodes have __slots__ and no __dict__ to keep big trees small
+
+
+class Node:
+    __slots__ = ()
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join(repr(getattr(self, k)) for k in self.__slots__))
+
+
+class Block(Node):
+    __slots__ = ('stats', 'ret_exps', 'line')
+
+    def __init__(self, stats, ret_exps, line):
+        self.stats = stats
+        # None without a return statement
+        self.ret_exps = ret_exps
+        self.line = line
+
+
+# statements, a function call statement is a CallExp
+
+class EmptyStat(Node):
+    __slots__ = ()
+
+
+class BreakStat(Node):
+    __slots__ = ('line',)
+
+    def __init__(self, line):
+        self.line = line
+
+
+class LabelStat(Node):
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+
+class GotoStat(Node):
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+
+class DoStat(Node):
+    __slots__ = ('block',)
+
+    def __init__(self, block):
+        self.block = block
+
+
+class WhileStat(Node):
+    __slots__ = ('exp', 'block')
+
+    def __init__(self, exp, block):
+        self.exp = exp
+        self.block = block
+
+
+class RepeatStat(Node):
+    __slots__ = ('exp', 'block')
+
+    def __init__(self, exp, block):
+        self.exp = exp
+        self.block = block
+
+
+class IfStat(Node):
+    # an else block has a TrueExp condition
+    __slots__ = ('exps', 'blocks')
+
+    def __init__(self, exps, blocks):
+        self.exps = exps
+        self.blocks = blocks
+
+
+class ForNumStat(Node):
+    # exps are the initial value, the limit and the step
+    __slots__ = ('name', 'exps', 'block')
+
+    def __init__(self, name, exps, block):
+        self.name = name
+        self.exps = exps
+        self.block = block
+
+
+class ForInStat(Node):
+    __slots__ = ('names', 'exps', 'block', 'line')
+
+    def __init__(self, names, exps, block, line):
+        self.names = names
+        self.exps = exps
+        self.block = block
+        self.line = line
+
+
+class LocalFuncStat(Node):
+    __slots__ = ('name', 'exp')
+
+    def __init__(self, name, exp):
+        self.name = name
+        self.exp = exp
+
+
+class LocalVarStat(Node):
+    __slots__ = ('names', 'exps', 'line')
+
+    def __init__(self, names, exps, line):
+        self.names = names
+        self.exps = exps
+        self.line = line
+
+
+class AssignStat(Node):
+    # vars are names and AccessExp, a function statement assigns a FuncDefExp
+    __slots__ = ('vars', 'exps', 'line')
+
+    def __init__(self, vars, exps, line):
+        self.vars = vars
+        self.exps = exps
+        self.line = line
+
+
+# expressions
+
+class NilExp(Node):
+    __slots__ = ('line',)
+
+    def __init__(self, line):
+        self.line = line
+
+
+class TrueExp(Node):
+    __slots__ = ('line',)
+
+    def __init__(self, line):
+        self.line = line
+
+
+class FalseExp(Node):
+    __slots__ = ('line',)
+
+    def __init__(self, line):
+        self.line = line
+
+
+class VarargExp(Node):
+    __slots__ = ('line',)
+
+    def __init__(self, line):
+        self.line = line
+
+
+class NumberExp(Node):
+    __slots__ = ('content',)
+
+    def __init__(self, content):
+        self.content = content
+
+
+class StringExp(Node):
+    __slots__ = ('content',)
+
+    def __init__(self, content):
+        self.content = content
+
+
+class ParenExp(Node):
+    __slots__ = ('exp', 'line')
+
+    def __init__(self, exp, line):
+        self.exp = exp
+        self.line = line
+
+
+class FuncDefExp(Node):
+    __slots__ = ('params', 'is_vararg', 'block')
+
+    def __init__(self, params, is_vararg, block):
+        self.params = params
+        self.is_vararg = is_vararg
+        self.block = block
+
+
+class TableExp(Node):
+    # the key of a positional field is None
+    __slots__ = ('keys', 'values')
+
+    def __init__(self, keys, values):
+        self.keys = keys
+        self.values = values
+
+
+class CallExp(Node):
+    # name is the method name of obj:name(args), None for other calls
+    __slots__ = ('exp', 'name', 'args')
+
+    def __init__(self, exp, name, args):
+        self.exp = exp
+        self.name = name
+        self.args = args
+
+
+class AccessExp(Node):
+    __slots__ = ('table', 'key', 'line')
+
+    def __init__(self, table, key, line):
+        self.table = table
+        self.key = key
+        self.line = line
+
+
+class BinopExp(Node):
+    # op is the TOKEN of the operator
+    __slots__ = ('op', 'exp1', 'exp2', 'line')
+
+    def __init__(self, op, exp1, exp2, line):
+        self.op = op
+        self.exp1 = exp1
+        self.exp2 = exp2
+        self.line = line
+
+
+class UnopExp(Node):
+    __slots__ = ('op', 'exp', 'line')
+
+    def __init__(self, op, exp, line):
+        self.op = op
+        self.exp = exp
+        self.line = line
+
+
+class ConcatExp(Node):
+    # a chain of .. is one node
+    __slots__ = ('exps', 'line')
+
+    def __init__(self, exps, line):
+        self.exps = exps
+        self.line = line
+
+
+literal_types = (NilExp, FalseExp, TrueExp, NumberExp, StringExp)
+
+# the literal node of the nil, false, true and vararg tokens
+token_literals = {
+    TOKEN.NIL: NilExp,
+    TOKEN.FALSE: FalseExp,
+    TOKEN.TRUE: TrueExp,
+    TOKEN.VARARG: VarargExp,
+}
+
+
+def is_vararg_or_call(exp):
+    t = type(exp)
+    return t is VarargExp or t is CallExp
+
+
+def is_literal(exp):
+    return type(exp) in literal_types
@@ -0,0 +1,165 @@
+from enum import IntEnum
+from tokens import TOKEN
+
+
+class OP(IntEnum):
+    MOVE = 0
+    LOAD_K = 1
+    LOAD_NIL = 2
+    LOAD_BOOL = 3
+    GET_UP_VAL = 4
+    GET_TAB_UP = 5
+    GET_TABLE = 6
+    SET_TAB_UP = 7
+    SET_UP_VAL = 8
+    SET_TABLE = 9
+    NEW_TABLE = 10
+    SELF = 11
+    ADD = 12
+    SUB = 13
+    MUL = 14
+    MOD = 15
+    POW = 16
+    DIV = 17
+    IDIV = 18
+    BAND = 19
+    BOR = 20
+    BXOR = 21
+    SHL = 22
+    SHR = 23
+    UNM = 24
+    BNOT = 25
+    NOT = 26
+    LEN = 27
+    CONCAT = 28
+    JUMP = 29
+    EQ = 30
+    NE = 31
+    LT = 32
+    LE = 33
+    GT = 34
+    GE = 35
+    TEST = 36
+    TEST_SET = 37
+    CALL = 38
+    RETURN = 39
+    FOR_LOOP = 40
+    FOR_PREP = 41
+    T_FOR_CALL = 42
+    T_FOR_LOOP = 43
+    SET_LIST = 44
+    CLOSURE = 45
+    VARARG = 46
+    TAIL_CALL = 47
+    TEST_EQ = 48
+    TEST_LT = 49
+    TEST_LE = 50
+
+
+# instruction names emitted by the analyzer
+op_map = {
+    'move': OP.MOVE,
+    'load_k': OP.LOAD_K,
+    'load_nil': OP.LOAD_NIL,
+    'load_bool': OP.LOAD_BOOL,
+    'get_up_val': OP.GET_UP_VAL,
+    'get_tab_up': OP.GET_TAB_UP,
+    'get_table': OP.GET_TABLE,
+    'set_tab_up': OP.SET_TAB_UP,
+    'set_up_val': OP.SET_UP_VAL,
+    'set_table': OP.SET_TABLE,
+    'new_table': OP.NEW_TABLE,
+    'self': OP.SELF,
+    'jump': OP.JUMP,
+    'test': OP.TEST,
+    'test_set': OP.TEST_SET,
+    'call': OP.CALL,
+    'return': OP.RETURN,
+    'for_loop': OP.FOR_LOOP,
+    'for_prep': OP.FOR_PREP,
+    't_for_call': OP.T_FOR_CALL,
+    't_for_loop': OP.T_FOR_LOOP,
+    'set_list': OP.SET_LIST,
+    'closure': OP.CLOSURE,
+    'vararg': OP.VARARG,
+    'tail_call': OP.TAIL_CALL,
+    'test_eq': OP.TEST_EQ,
+    'test_lt': OP.TEST_LT,
+    'test_le': OP.TEST_LE,
+    TOKEN.OP_ADD: OP.ADD,
+    TOKEN.OP_MINUS: OP.SUB,
+    TOKEN.OP_MUL: OP.MUL,
+    TOKEN.OP_MOD: OP.MOD,
+    TOKEN.OP_POW: OP.POW,
+    TOKEN.OP_DIV: OP.DIV,
+    TOKEN.OP_IDIV: OP.IDIV,
+    TOKEN.OP_BAND: OP.BAND,
+    TOKEN.OP_BOR: OP.BOR,
+    TOKEN.OP_WAVE: OP.BXOR,
+    TOKEN.OP_SHL: OP.SHL,
+    TOKEN.OP_SHR: OP.SHR,
+    TOKEN.OP_NOT: OP.NOT,
+    TOKEN.OP_LEN: OP.LEN,
+    TOKEN.OP_CONCAT: OP.CONCAT,
+    TOKEN.OP_EQ: OP.EQ,
+    TOKEN.OP_NE: OP.NE,
+    TOKEN.OP_LT: OP.LT,
+    TOKEN.OP_LE: OP.LE,
+    TOKEN.OP_GT: OP.GT,
+    TOKEN.OP_GE: OP.GE,
+}
+
+# '-' and '~' are emitted with two operands when they are unary
+unary_map = {
+    TOKEN.OP_MINUS: OP.UNM,
+    TOKEN.OP_WAVE: OP.BNOT,
+}
+
+# opcode -> token used by Stack.arith and Stack.compare
+arith_tokens = {
+    OP.ADD: TOKEN.OP_ADD,
+    OP.SUB: TOKEN.OP_MINUS,
+    OP.MUL: TOKEN.OP_MUL,
+    OP.MOD: TOKEN.OP_MOD,
+    OP.POW: TOKEN.OP_POW,
+    OP.DIV: TOKEN.OP_DIV,
+    OP.IDIV: TOKEN.OP_IDIV,
+    OP.BAND: TOKEN.OP_BAND,
+    OP.BOR: TOKEN.OP_BOR,
+    OP.BXOR: TOKEN.OP_WAVE,
+    OP.SHL: TOKEN.OP_SHL,
+    OP.SHR: TOKEN.OP_SHR,
+    OP.UNM: TOKEN.OP_MINUS,
+    OP.BNOT: TOKEN.OP_WAVE,
+}
+
+compare_tokens = {
+    OP.EQ: TOKEN.OP_EQ,
+    OP.NE: TOKEN.OP_NE,
+    OP.LT: TOKEN.OP_LT,
+    OP.LE: TOKEN.OP_LE,
+    OP.GT: TOKEN.OP_GT,
+    OP.GE: TOKEN.OP_GE,
+}
+
+# compare and branch opcode -> token, the next instruction is skipped
+# when the result of the comparison is not a
+test_tokens = {
+    OP.TEST_EQ: TOKEN.OP_EQ,
+    OP.TEST_LT: TOKEN.OP_LT,
+    OP.TEST_LE: TOKEN.OP_LE,
+}
+
+
+def encode(inst):
+    # [name, a, b(, c)] -> (opcode, a, b, c)
+    if len(inst) == 3:
+        name, a, b = inst
+        c = 0
+        op = unary_map.get(name, None)
+        if op is None:
+            op = op_map[name]
+    else:
+        name, a, b, c = inst
+        op = op_map[name]
+    return int(op), a, b, c
@@ -1,15 +1,39 @@
 from lexer import Lexer, TOKEN
+from nodes import *
+
+# binary operator -> (left priority, right priority), a right priority below
+# the left one makes the operator right associative
+binary_priority = {
+    TOKEN.OP_OR: (1, 1),
+    TOKEN.OP_AND: (2, 2),
+    TOKEN.OP_LT: (3, 3), TOKEN.OP_LE: (3, 3), TOKEN.OP_GT: (3, 3),
+    TOKEN.OP_GE: (3, 3), TOKEN.OP_EQ: (3, 3), TOKEN.OP_NE: (3, 3),
+    TOKEN.OP_BOR: (4, 4),
+    TOKEN.OP_BXOR: (5, 5),
+    TOKEN.OP_BAND: (6, 6),
+    TOKEN.OP_SHL: (7, 7), TOKEN.OP_SHR: (7, 7),
+    TOKEN.OP_CONCAT: (9, 8),
+    TOKEN.OP_ADD: (10, 10), TOKEN.OP_MINUS: (10, 10),
+    TOKEN.OP_MUL: (11, 11), TOKEN.OP_DIV: (11, 11), TOKEN.OP_IDIV: (11, 11), TOKEN.OP_MOD: (11, 11),
+    TOKEN.OP_POW: (14, 13),
+}
+
+unary_ops = [TOKEN.OP_NOT, TOKEN.OP_LEN, TOKEN.OP_MINUS, TOKEN.OP_WAVE]
+# binds tighter than every binary operator but ^
+UNARY_PRIORITY = 12
 
 
 class Parser:
 
     def __init__(self, chunk):
+        # chunk is a str or a file object, its tokens are pulled one at a time
         self.lexer = Lexer(chunk)
-        self.cur_token = self.lexer.next_token()
+        self.tokens = self.lexer.gen_next_token()
+        self.cur_token = next(self.tokens)
 
     def error(self, s=""):
         print("Syntax Error: %s at line %d:%d %s" %
-              (s, self.lexer.line + 1, self.lexer.col + 1, self.lexer.chunk[self.lexer.line]))
+              (s, self.lexer.line + 1, self.lexer.col + 1, self.lexer.line_text()))
 
     def parse(self):
         block = self.block()
@@ -19,13 +43,13 @@ class Parser:
 
     def next_token(self, _type=None):
         if self.cur_token[0] != TOKEN.EOF:
-            self.cur_token = self.lexer.next_token()
+            self.cur_token = next(self.tokens)
             if _type is not None and self.cur_token[0] != _type:
                 self.error('illegal token %s' % self.cur_token[1])
 
     def block(self):
-        block = {'stats': self.stats(), 'ret_exps': self.ret_exps(), 'line': self.lexer.line}
-        return block
+        stats = self.stats()
+        return Block(stats, self.ret_exps(), self.lexer.line)
 
     def is_block_end(self):
         block_end_list = [TOKEN.RETURN, TOKEN.EOF, TOKEN.END, TOKEN.ELSE, TOKEN.ELSEIF, TOKEN.UNTIL]
@@ -63,7 +87,7 @@ class Parser:
     def stat(self):
         if self.cur_token[0] is TOKEN.SEP_SEMI:
             self.next_token()
-            return {'type': 'empty'}
+            return EmptyStat()
         if self.cur_token[0] is TOKEN.BREAK:
             return self.break_stat()
         if self.cur_token[0] is TOKEN.SEP_LABEL:
@@ -87,7 +111,7 @@ class Parser:
         return self.assign_or_func_call_stat()
 
     def break_stat(self):
-        stat = {'type': 'break', 'line': self.lexer.line}
+        stat = BreakStat(self.lexer.line)
         self.next_token()
         return stat
 
@@ -96,13 +120,13 @@ class Parser:
         _, name = self.cur_token
         self.next_token(TOKEN.SEP_LABEL)
         self.next_token()
-        return {'type': 'label', 'name': name}
+        return LabelStat(name)
 
     def goto_stat(self):
         self.next_token(TOKEN.IDENTIFIER)
         _, name = self.cur_token
         self.next_token()
-        return {'type': 'goto', 'name': name}
+        return GotoStat(name)
 
     def do_stat(self):
         self.next_token()
@@ -110,7 +134,7 @@ class Parser:
         if self.cur_token[0] is not TOKEN.END:
             self.error('do statement parse error: end missing')
         self.next_token()
-        return {'type': 'do', 'block': block}
+        return DoStat(block)
 
     def while_stat(self):
         self.next_token()
@@ -122,7 +146,7 @@ class Parser:
         if self.cur_token[0] is not TOKEN.END:
             self.error('while statement parse error: end missing')
         self.next_token()
-        return {'type': 'while', 'exp': exp, 'block': block}
+        return WhileStat(exp, block)
 
     def repeat_stat(self):
         self.next_token()
@@ -131,7 +155,7 @@ class Parser:
             self.error('repeat statement parse error: until missing')
         self.next_token()
         exp = self.exp()
-        return {'type': 'repeat', 'exp': exp, 'block': block}
+        return RepeatStat(exp, block)
 
     def if_stat(self):
         exps = []
@@ -151,12 +175,12 @@ class Parser:
             blocks.append(self.block())
         if self.cur_token[0] is TOKEN.ELSE:
             self.next_token()
-            exps.append({'exp_type': TOKEN.TRUE, 'line': self.lexer.line})
+            exps.append(TrueExp(self.lexer.line))
             blocks.append(self.block())
         if self.cur_token[0] is not TOKEN.END:
             self.error('if statement parse error: end missing')
         self.next_token()
-        return {'type': 'if', 'exps': exps, 'blocks': blocks}
+        return IfStat(exps, blocks)
 
     def for_stat(self):
         self.next_token(TOKEN.IDENTIFIER)
@@ -168,7 +192,7 @@ class Parser:
             if not 2 <= len(exps) <= 3:
                 self.error('for statement parse error: num for incorrect exp')
             if len(exps) == 2:
-                exps.append({'exp_type': TOKEN.NUMBER, 'content': 1})
+                exps.append(NumberExp(1))
             if self.cur_token[0] is not TOKEN.DO:
                 self.error('for statement parse error: do missing')
             self.next_token()
@@ -176,7 +200,7 @@ class Parser:
             if self.cur_token[0] is not TOKEN.END:
                 self.error('for statement parse error: end missing')
             self.next_token()
-            return {'type': 'for', 'name': name, 'num': True, 'exps': exps, 'block': block}
+            return ForNumStat(name, exps, block)
         else:
             names = [name]
             if self.cur_token[0] is TOKEN.SEP_COMMA:
@@ -194,7 +218,7 @@ class Parser:
             if self.cur_token[0] is not TOKEN.END:
                 self.error('for statement parse error: end missing')
             self.next_token()
-            return {'type': 'for', 'num': False, 'names': names, 'exps': exps, 'block': block, 'line': line}
+            return ForInStat(names, exps, block, line)
     
     def names(self):
         if self.cur_token[0] is not TOKEN.IDENTIFIER:
@@ -221,7 +245,7 @@ class Parser:
         name = self.cur_token[1]
         self.next_token()
         exp = self.func_def_exp()
-        return {'type': 'func', 'local': True, 'name': name, 'exp': exp}
+        return LocalFuncStat(name, exp)
 
     def local_var_stat(self):
         names = self.names()
@@ -230,18 +254,18 @@ class Parser:
             self.next_token()
             exps = self.exps()
         line = self.lexer.line
-        return {'type': 'var', 'local': True, 'names': names, 'exps': exps, 'line': line}
+        return LocalVarStat(names, exps, line)
 
     def func_def_stat(self):
         self.next_token()
-        name = self.func_name()
+        name, is_method = self.func_name()
         exp = self.func_def_exp()
-        if type(name) is dict and name.get('colon', False):
-            exp['params'] = ['self'] + exp['params']
-        # return {'type': 'func', 'local': False, 'name': name, 'exp': exp}
-        return {'op': 'assign', 'vars': [name], 'exps': [exp]}
+        if is_method:
+            exp.params = ['self'] + exp.params
+        return AssignStat([name], [exp], -1)
 
     def func_name(self):
+        # (name, True for a method defined with a colon)
         if self.cur_token[0] is not TOKEN.IDENTIFIER:
             self.error('func def error: incorrect func name')
         name = self.cur_token[1]
@@ -251,22 +275,23 @@ class Parser:
             self.next_token()
             if self.cur_token[0] is not TOKEN.IDENTIFIER:
                 self.error('func def error: incorrect func name')
-            name = {'op': 'access', '1': name, '2': self.cur_token[1], 'line': line}
+            name = AccessExp(name, self.cur_token[1], line)
             self.next_token()
         if self.cur_token[0] is TOKEN.SEP_COLON:
             line = self.lexer.line
             self.next_token()
             if self.cur_token[0] is not TOKEN.IDENTIFIER:
                 self.error('func def error: incorrect func name')
-            name = {'op': 'access', 'colon': True, '1': name, '2': self.cur_token[1], 'line': line}
+            name = AccessExp(name, self.cur_token[1], line)
             self.next_token()
-        return name
+            return name, True
+        return name, False
 
     def func_def_exp(self):
         if self.cur_token[0] is not TOKEN.SEP_LPAREN:
             self.error('func def error: left parenthesis missing')
         self.next_token()
-        params = self.params()
+        params, is_vararg = self.params()
         if self.cur_token[0] is not TOKEN.SEP_RPAREN:
             self.error('func def error: right parenthesis missing')
         self.next_token()
@@ -274,14 +299,14 @@ class Parser:
         if self.cur_token[0] is not TOKEN.END:
             self.error('func def error: end missing')
         self.next_token()
-        return {'op': 'def', 'params': params, 'block': block}
+        return FuncDefExp(params, is_vararg, block)
 
     def params(self):
         if self.cur_token[0] is TOKEN.VARARG:
             self.next_token()
-            return {'var': True, 'params': []}
+            return [], True
         elif self.cur_token[0] is TOKEN.SEP_RPAREN:
-            return {'var': False, 'params': []}
+            return [], False
         elif self.cur_token[0] is TOKEN.IDENTIFIER:
             names = [self.cur_token[1]]
             var = False
@@ -297,18 +322,18 @@ class Parser:
                     break
                 else:
                     self.error('func def error: incorrect parameter definition')
-            return {'var': var, 'params': names}
+            return names, var
         else:
             self.error('func def error: incorrect parameter definition')
 
     def assign_or_func_call_stat(self):
         prefix_exp = self.prefix_exp()
-        if type(prefix_exp) is dict and 'op' in prefix_exp and prefix_exp['op'] == 'call':
+        if type(prefix_exp) is CallExp:
             return prefix_exp
         else:
             var = []
             while 1:
-                if type(prefix_exp) is str or type(prefix_exp) is dict and 'op' in prefix_exp and prefix_exp['op'] == 'access':
+                if type(prefix_exp) is str or type(prefix_exp) is AccessExp:
                     pass
                 else:
                     self.error('illegal var')
@@ -322,139 +347,46 @@ class Parser:
         line = self.lexer.line
         self.next_token()
         exps = self.exps()
-        return {'op': 'assign', 'vars': var, 'exps': exps, 'line': line}
-
-    def exp(self):
-        return self.exp_or()
-
-    def exp_or(self):
-        exp1 = self.exp_and()
-        while self.cur_token[0] is TOKEN.OP_OR:
-            line = self.lexer.line
-            self.next_token()
-            exp2 = self.exp_and()
-            exp1 = {'op': TOKEN.OP_OR, '1': exp1, '2': exp2, 'line': line}
-        return exp1
-
-    def exp_and(self):
-        exp1 = self.exp_cmp()
-        while self.cur_token[0] is TOKEN.OP_AND:
-            line = self.lexer.line
-            self.next_token()
-            exp2 = self.exp_cmp()
-            exp1 = {'op': TOKEN.OP_AND, '1': exp1, '2': exp2, 'line': line}
-        return exp1
-
-    def exp_cmp(self):
-        exp1 = self.exp_bor()
-        cmp_list = [TOKEN.OP_LT, TOKEN.OP_LE, TOKEN.OP_GT, TOKEN.OP_GE, TOKEN.OP_EQ, TOKEN.OP_NE]
-        while self.cur_token[0] in cmp_list:
-            op = self.cur_token[0]
-            line = self.lexer.line
-            self.next_token()
-            exp2 = self.exp_bor()
-            exp1 = {'op': op, '1': exp1, '2': exp2, 'line': line}
-        return exp1
+        return AssignStat(var, exps, line)
 
-    def exp_bor(self):
-        exp1 = self.exp_bnot()
-        while self.cur_token[0] is TOKEN.OP_BOR:
+    def exp(self, limit=0):
+        # precedence climbing, parses the operators whose left priority is above limit
+        op = self.cur_token[0]
+        if op in unary_ops:
             line = self.lexer.line
             self.next_token()
-            exp2 = self.exp_bnot()
-            exp1 = {'op': TOKEN.OP_BOR, '1': exp1, '2': exp2, 'line': line}
-        return exp1
-
-    def exp_bnot(self):
-        exp1 = self.exp_band()
-        while self.cur_token[0] is TOKEN.OP_BNOT:
-            line = self.lexer.line
-            self.next_token()
-            exp2 = self.exp_band()
-            exp1 = {'op': TOKEN.OP_BNOT, '1': exp1, '2': exp2, 'line': line}
-        return exp1
-
-    def exp_band(self):
-        exp1 = self.exp_shift()
-        while self.cur_token[0] is TOKEN.OP_BAND:
-            line = self.lexer.line
-            self.next_token()
-            exp2 = self.exp_shift()
-            exp1 = {'op': TOKEN.OP_BAND, '1': exp1, '2': exp2, 'line': line}
-        return exp1
-
-    def exp_shift(self):
-        exp1 = self.exp_concat()
-        while self.cur_token[0] in [TOKEN.OP_SHR, TOKEN.OP_SHL]:
+            exp1 = UnopExp(op, self.exp(UNARY_PRIORITY), line)
+        else:
+            exp1 = self.exp0()
+        while 1:
             op = self.cur_token[0]
+            priority = binary_priority.get(op, None)
+            if priority is None or priority[0] <= limit:
+                return exp1
             line = self.lexer.line
-            self.next_token()
-            exp2 = self.exp_concat()
-            exp1 = {'op': op, '1': exp1, '2': exp2, 'line': line}
-        return exp1
-
-    def exp_concat(self):
-        exps = [self.exp_plus()]
-        if self.cur_token[0] is TOKEN.OP_CONCAT:
-            line = self.lexer.line
-            while self.cur_token[0] == TOKEN.OP_CONCAT:
+            if op is TOKEN.OP_CONCAT:
+                # a chain of .. is one node, its operands stop at the next ..
+                exps = [exp1]
+                while self.cur_token[0] is TOKEN.OP_CONCAT:
+                    self.next_token()
+                    exps.append(self.exp(priority[0]))
+                exp1 = ConcatExp(exps, line)
+            else:
                 self.next_token()
-                exps.append(self.exp_plus())
-            return {'op': TOKEN.OP_CONCAT, '1': exps, 'line': line}
-        return exps[0]
-
-    def exp_plus(self):
-        exp1 = self.exp_mul()
-        while self.cur_token[0] in [TOKEN.OP_ADD, TOKEN.OP_MINUS]:
-            op = self.cur_token[0]
-            line = self.lexer.line
-            self.next_token()
-            exp2 = self.exp_mul()
-            exp1 = {'op': op, '1': exp1, '2': exp2, 'line': line}
-        return exp1
-
-    def exp_mul(self):
-        exp1 = self.exp_unary()
-        while self.cur_token[0] in [TOKEN.OP_MUL, TOKEN.OP_DIV, TOKEN.OP_IDIV, TOKEN.OP_MOD]:
-            op = self.cur_token[0]
-            line = self.lexer.line
-            self.next_token()
-            exp2 = self.exp_unary()
-            exp1 = {'op': op, '1': exp1, '2': exp2, 'line': line}
-        return exp1
-
-    def exp_unary(self):
-        if self.cur_token[0] in [TOKEN.OP_NOT, TOKEN.OP_LEN, TOKEN.OP_MINUS, TOKEN.OP_WAVE]:
-            op = self.cur_token[0]
-            line = self.lexer.line
-            self.next_token()
-            exp1 = self.exp_unary()
-            exp1 = {'op': op, '1': exp1, 'line': line}
-        else:
-            exp1 = self.exp_pow()
-        return exp1
-
-    def exp_pow(self):
-        exp1 = self.exp0()
-        if self.cur_token[0] is TOKEN.OP_POW:
-            line = self.lexer.line
-            self.next_token()
-            exp2 = self.exp_unary()
-            exp1 = {'op': TOKEN.OP_POW, '1': exp1, '2': exp2, 'line': line}
-        return exp1
+                exp1 = BinopExp(op, exp1, self.exp(priority[1]), line)
 
     def exp0(self):
         line = self.lexer.line
         if self.cur_token[0] in [TOKEN.VARARG, TOKEN.NIL, TOKEN.TRUE, TOKEN.FALSE]:
-            res = {'exp_type': self.cur_token[0], 'line': line}
+            res = token_literals[self.cur_token[0]](line)
             self.next_token()
             return res
         if self.cur_token[0] is TOKEN.STRING:
-            res = {'exp_type': TOKEN.STRING, 'content': self.cur_token[1]}
+            res = StringExp(self.cur_token[1])
             self.next_token()
             return res
         if self.cur_token[0] is TOKEN.NUMBER:
-            res = {'exp_type': TOKEN.NUMBER, 'content': self.number()}
+            res = NumberExp(self.number())
             self.next_token()
             return res
         if self.cur_token[0] is TOKEN.SEP_LCURLY:
@@ -515,7 +447,7 @@ class Parser:
         if self.cur_token[0] is not TOKEN.SEP_RCURLY:
             self.error('illegal table construction: right curly bracket missing')
         self.next_token()
-        return {'op': 'table', 'keys': keys, 'values': values}
+        return TableExp(keys, values)
 
     def fields(self):
         fields = []
@@ -534,7 +466,7 @@ class Parser:
             else:
                 exp1 = self.exp()
                 if type(exp1) is str:
-                    exp1 = {'exp_type': TOKEN.STRING, 'content': exp1}
+                    exp1 = StringExp(exp1)
                 if self.cur_token[0] is TOKEN.OP_ASSIGN:
                     self.next_token()
                     exp2 = self.exp()
@@ -566,7 +498,7 @@ class Parser:
                 if self.cur_token[0] is not TOKEN.SEP_RBRACK:
                     self.error('illegal expression: right bracket missing')
                 self.next_token()
-                exp = {'op': 'access', '1': exp, '2': key, 'line': line}
+                exp = AccessExp(exp, key, line)
             elif self.cur_token[0] is TOKEN.SEP_DOT:
                 line = self.lexer.line
                 self.next_token()
@@ -574,7 +506,7 @@ class Parser:
                     self.error('illegal expression: identifier expected')
                 name = self.cur_token[1]
                 self.next_token()
-                exp = {'op': 'access', '1': exp, '2': name, 'line': line}
+                exp = AccessExp(exp, name, line)
 
             # function call
             elif self.cur_token[0] in [TOKEN.SEP_COLON, TOKEN.SEP_LPAREN, TOKEN.SEP_LCURLY, TOKEN.STRING]:
@@ -596,12 +528,12 @@ class Parser:
                 elif self.cur_token[0] is TOKEN.SEP_RCURLY:
                     args = [self.table()]
                 elif self.cur_token[0] is TOKEN.STRING:
-                    args = [{'exp_type': TOKEN.STRING, 'content': self.cur_token[1]}]
+                    args = [StringExp(self.cur_token[1])]
                     self.next_token()
                 else:
                     args = []
                     self.error('illegal function call')
-                exp = {'op': 'call', 'name': name, 'args': args, 'exp': exp}
+                exp = CallExp(exp, name, args)
 
             else:
                 return exp
@@ -613,5 +545,5 @@ class Parser:
         if self.cur_token[0] is not TOKEN.SEP_RPAREN:
             self.error('illegal statement: right parenthesis missing')
         self.next_token()
-        return {'op': 'parenthesis', '1': exp, 'line': line}
+        return ParenExp(exp, line)
 
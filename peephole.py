@@ -0,0 +1,306 @@
+from info import FuncInfo
+from opcodes import OP, encode, arith_tokens, compare_tokens, test_tokens
+from config import REG_LIMIT
+
+# register sets are bit masks, bit r for register r
+ALL = (1 << (REG_LIMIT + 1)) - 1
+
+# instructions that write register a and have no other effect
+pure_ops = [OP.MOVE, OP.LOAD_K, OP.LOAD_NIL, OP.LOAD_BOOL, OP.GET_UP_VAL]
+# instructions that write register a and nothing else
+single_ops = [OP.MOVE, OP.LOAD_K, OP.LOAD_BOOL, OP.GET_UP_VAL, OP.GET_TAB_UP, OP.GET_TABLE,
+              OP.NEW_TABLE, OP.CONCAT, OP.CLOSURE, OP.NOT, OP.LEN] + list(arith_tokens) + list(compare_tokens)
+# instructions that may skip the next one
+skip_ops = [OP.TEST, OP.TEST_SET] + list(test_tokens)
+branch_ops = [OP.JUMP, OP.FOR_PREP, OP.FOR_LOOP, OP.T_FOR_LOOP, OP.RETURN] + skip_ops
+# instructions whose b is a jump offset
+jump_ops = [OP.JUMP, OP.FOR_PREP, OP.FOR_LOOP, OP.T_FOR_LOOP]
+
+
+def regs(first, last):
+    # registers first..last
+    if last < first:
+        return 0
+    return ((1 << (last + 1)) - 1) ^ ((1 << first) - 1)
+
+
+def regs_from(first):
+    # registers from first up to the top
+    return ALL ^ ((1 << first) - 1)
+
+
+def reg_fields(op, a, b, c):
+    # indexes in (op, a, b, c) of the operands that read a single register
+    if op in [OP.MOVE, OP.UNM, OP.BNOT, OP.NOT, OP.LEN]:
+        fields = [2]
+    elif op in [OP.GET_TABLE, OP.SELF, OP.SET_TAB_UP] or op in arith_tokens or op in compare_tokens \
+            or op in test_tokens:
+        fields = [2, 3]
+    elif op == OP.GET_TAB_UP:
+        fields = [3]
+    elif op == OP.SET_TABLE:
+        fields = [1, 2, 3]
+    elif op in [OP.SET_UP_VAL, OP.TEST]:
+        fields = [1]
+    elif op == OP.TEST_SET:
+        fields = [2]
+    else:
+        return []
+    # operands above 0xff are constants
+    return [i for i in fields if (op, a, b, c)[i] <= 0xff]
+
+
+def effects(info, op, a, b, c):
+    # (read, written, always written) registers of an instruction in the
+    # encoding of the analyzer, a call may clobber every register above its function
+    inst = (op, a, b, c)
+    read = 0
+    for i in reg_fields(op, a, b, c):
+        read |= 1 << inst[i]
+    if op in single_ops:
+        kill = 1 << a
+        if op == OP.CONCAT:
+            read |= regs(b, c)
+        elif op == OP.CLOSURE:
+            for uv in info.sub_funcs[b].up_values.values():
+                if uv.local_var_slot >= 0:
+                    read |= 1 << uv.local_var_slot
+        return read, kill, kill
+    if op == OP.LOAD_NIL:
+        kill = regs(a, a + b)
+        return read, kill, kill
+    if op == OP.SELF:
+        kill = regs(a, a + 1)
+        return read, kill, kill
+    if op == OP.TEST_SET:
+        return read, 1 << a, 0
+    if op in [OP.CALL, OP.TAIL_CALL]:
+        read = regs(a, a + b) if b >= 0 else regs_from(a)
+        return read, regs_from(a), regs(a, a + c - 1)
+    if op == OP.RETURN:
+        return regs(a, a + b - 1) if b >= 0 else regs_from(a), 0, 0
+    if op == OP.VARARG:
+        if b < 0:
+            return 0, regs_from(a), 0
+        return 0, regs(a, a + b - 1), regs(a, a + b - 1)
+    if op == OP.SET_LIST:
+        if b == 0:
+            return regs_from(a), regs_from(a + 1), 0
+        return regs(a, a + b), 0, 0
+    if op == OP.FOR_PREP:
+        return regs(a, a + 2), regs(a, a + 1), 1 << a
+    if op == OP.FOR_LOOP:
+        return regs(a, a + 2), regs(a, a + 1) | 1 << (a + 3), 0
+    if op == OP.T_FOR_CALL:
+        return regs(a, a + 2), regs_from(a + 3), regs(a + 3, a + 2 + b)
+    if op == OP.T_FOR_LOOP:
+        return 1 << (a + 1), 1 << a, 0
+    return read, 0, 0
+
+
+class Peephole:
+    # rewrites the instructions of one function, the registers of the
+    # analyzer are reused for copy propagation and dead stores
+
+    def __init__(self, info: FuncInfo, thread_jumps=True):
+        self.info = info
+        self.thread_jumps = thread_jumps
+        self.names = [inst[0] for inst in info.ins]
+        self.sizes = [len(inst) for inst in info.ins]
+        self.code = [list(encode(inst)) for inst in info.ins]
+
+    def run(self):
+        while True:
+            changed = self.propagate()
+            removed = self.dead_stores() | self.jumps() | self.unreachable()
+            if not changed and not removed:
+                break
+        info = self.info
+        info.ins = [[name] + inst[1:size] for name, inst, size in zip(self.names, self.code, self.sizes)]
+
+    def targets(self):
+        code = self.code
+        return set(pc + 1 + inst[2] for pc, inst in enumerate(code) if inst[0] in jump_ops)
+
+    def bound(self, pc):
+        # True for the jump skipped by a test
+        return pc > 0 and self.code[pc - 1][0] in skip_ops
+
+    def successors(self, pc):
+        op, a, b, c = self.code[pc]
+        if op == OP.RETURN:
+            return []
+        if op in [OP.JUMP, OP.FOR_PREP]:
+            return [pc + 1 + b]
+        if op in [OP.FOR_LOOP, OP.T_FOR_LOOP]:
+            return [pc + 1, pc + 1 + b]
+        if op in skip_ops:
+            return [pc + 1, pc + 2]
+        if op == OP.LOAD_BOOL and c != 0:
+            return [pc + 2]
+        return [pc + 1]
+
+    def live_out(self):
+        # registers read after each instruction before they are written again
+        code = self.code
+        n = len(code)
+        info = self.info
+        effect = [effects(info, *inst) for inst in code]
+        succ = [[s for s in self.successors(pc) if s < n] for pc in range(n)]
+        live_in = [0] * n
+        out = [0] * n
+        changed = True
+        while changed:
+            changed = False
+            for pc in range(n - 1, -1, -1):
+                o = 0
+                for s in succ[pc]:
+                    o |= live_in[s]
+                read, _, kill = effect[pc]
+                i = read | (o & ~kill)
+                out[pc] = o
+                if i != live_in[pc]:
+                    live_in[pc] = i
+                    changed = True
+        return out
+
+    def propagate(self):
+        # replaces the reads of a register copied by move with the source of the move
+        changed = False
+        targets = self.targets()
+        copies = {}
+        for pc, inst in enumerate(self.code):
+            if pc in targets:
+                copies = {}
+            for i in reg_fields(*inst):
+                src = copies.get(inst[i])
+                if src is not None:
+                    inst[i] = src
+                    changed = True
+            op, a, b, c = inst
+            _, written, _ = effects(self.info, op, a, b, c)
+            if copies:
+                copies = {d: s for d, s in copies.items() if not (written >> d & 1 or written >> s & 1)}
+            if op == OP.MOVE and a != b:
+                copies[a] = b
+            elif op in branch_ops:
+                copies = {}
+        return changed
+
+    def dead_stores(self):
+        # removes moves and loads of registers that are not read, and moves the result
+        # of an instruction straight to the register it is copied to
+        code = self.code
+        out = self.live_out()
+        targets = self.targets()
+        dead = [False] * len(code)
+        for pc, (op, a, b, c) in enumerate(code):
+            if dead[pc] or self.bound(pc):
+                continue
+            if op == OP.MOVE and a == b:
+                dead[pc] = True
+                continue
+            if op in pure_ops and not (op == OP.LOAD_BOOL and c != 0):
+                _, _, kill = effects(self.info, op, a, b, c)
+                if not kill & out[pc]:
+                    dead[pc] = True
+                    continue
+            if op in single_ops and pc + 1 < len(code) and pc + 1 not in targets:
+                nop, na, nb, _ = code[pc + 1]
+                if nop == OP.MOVE and nb == a and na != a and not out[pc + 1] >> a & 1:
+                    code[pc][1] = na
+                    dead[pc + 1] = True
+        return self.remove(dead)
+
+    def jumps(self):
+        # removes jumps to the next instruction and tests of constants,
+        # and threads jumps to jumps
+        code = self.code
+        targets = self.targets()
+        dead = [False] * len(code)
+        for pc, (op, a, b, c) in enumerate(code):
+            if op == OP.JUMP and a == 0 and b == 0:
+                if pc > 0 and code[pc - 1][0] == OP.TEST and not self.bound(pc - 1):
+                    dead[pc - 1] = dead[pc] = True
+                elif not self.bound(pc):
+                    dead[pc] = True
+            elif op == OP.TEST and pc > 0 and pc not in targets and not self.bound(pc):
+                flag = self.truth_of(pc - 1, a)
+                if flag is None:
+                    continue
+                if flag == bool(b):
+                    # always jumps
+                    dead[pc] = True
+                elif pc + 1 not in targets:
+                    # never jumps
+                    dead[pc] = dead[pc + 1] = True
+            elif op == OP.JUMP and self.thread_jumps:
+                t = pc + 1 + b
+                seen = {pc}
+                while t < len(code) and t not in seen and code[t][0] == OP.JUMP and code[t][1] == 0:
+                    seen.add(t)
+                    t += 1 + code[t][2]
+                if t != pc + 1 + b and t not in seen:
+                    code[pc][2] = t - pc - 1
+        return self.remove(dead)
+
+    def truth_of(self, pc, r):
+        # truth of register r written by a load at pc, None when unknown
+        op, a, b, c = self.code[pc]
+        if op == OP.LOAD_BOOL and a == r and c == 0:
+            return bool(b)
+        if op == OP.LOAD_NIL and a <= r <= a + b:
+            return False
+        if op == OP.LOAD_K and a == r:
+            return True
+        return None
+
+    def unreachable(self):
+        code = self.code
+        seen = [False] * len(code)
+        todo = [0] if code else []
+        while todo:
+            pc = todo.pop()
+            if pc >= len(code) or seen[pc]:
+                continue
+            seen[pc] = True
+            todo.extend(self.successors(pc))
+        return self.remove([not s for s in seen])
+
+    def remove(self, dead):
+        # deletes the dead instructions and fixes the jump offsets,
+        # a jump to a removed instruction goes to the next one kept
+        if not any(dead):
+            return False
+        code = self.code
+        new_pc = []
+        n = 0
+        for d in dead:
+            new_pc.append(n)
+            if not d:
+                n += 1
+        new_pc.append(n)
+        for pc, inst in enumerate(code):
+            if not dead[pc] and inst[0] in jump_ops:
+                inst[2] = new_pc[pc + 1 + inst[2]] - new_pc[pc] - 1
+        self.code = [inst for inst, d in zip(code, dead) if not d]
+        self.names = [x for x, d in zip(self.names, dead) if not d]
+        self.sizes = [x for x, d in zip(self.sizes, dead) if not d]
+        return True
+
+
+def optimize(info: FuncInfo, thread_jumps=True):
+    # optimizes the instructions of info and its sub functions in place,
+    # returns the number of removed instructions
+    removed = sum(optimize(sub, thread_jumps) for sub in info.sub_funcs)
+    n = len(info.ins)
+    Peephole(info, thread_jumps).run()
+    info.removed = n - len(info.ins)
+    return removed + info.removed
+
+
+def report(info: FuncInfo, name='main'):
+    # prints the number of instructions removed from each function
+    print('%s: %d instructions, %d removed' % (name, len(info.ins), info.removed))
+    for i, sub in enumerate(info.sub_funcs):
+        report(sub, '%s.%d' % (name, i))
@@ -0,0 +1,584 @@
+import math
+from functools import partial
+from info import FuncInfo
+from lua_stack import Closure, UpVal
+from lua_table import Table, KeyCache, FieldCache, is_map_key
+from lua_utils import for_count
+from tokens import TOKEN
+from opcodes import OP, encode, arith_tokens, compare_tokens, test_tokens
+from config import FIELDS_PER_FLUSH
+
+# Python operators used when both operands are integers, the other cases
+# go through Stack.arith_v and Stack.compare_v like the VM
+int_arith = {
+    OP.ADD: '+',
+    OP.SUB: '-',
+    OP.MUL: '*',
+    OP.MOD: '%',
+    OP.IDIV: '//',
+    OP.BAND: '&',
+    OP.BOR: '|',
+    OP.BXOR: '^',
+}
+
+int_compare = {
+    OP.EQ: '==',
+    OP.NE: '!=',
+    OP.LT: '<',
+    OP.LE: '<=',
+    OP.GT: '>',
+    OP.GE: '>=',
+}
+# comparison of each compare and branch instruction
+test_compare = {OP.TEST_EQ: OP.EQ, OP.TEST_LT: OP.LT, OP.TEST_LE: OP.LE}
+
+
+class TranspileError(Exception):
+    pass
+
+
+# helpers called by the generated code, the ones taking vm or stack are bound
+# by Transpiler.namespace
+def call_value(vm, f, *args):
+    if type(f) is Closure and f.native is not None:
+        return f.native(*args)
+    return vm.call_value(f, args)
+
+
+def adjust(values, n):
+    if len(values) >= n:
+        return values[:n]
+    return list(values) + [None] * (n - len(values))
+
+
+def index(stack, t, k):
+    if type(t) is Table:
+        return t.get(k)
+    stack.error(repr(t) + ' not a table')
+
+
+def get_global(stack, t, cache):
+    # miss of the KeyCache of a GET_TAB_UP
+    if type(t) is Table:
+        return cache.get(t)
+    stack.error(repr(t) + ' not a table')
+
+
+def get_field(stack, t, cache):
+    # miss of the FieldCache of a GET_TABLE
+    if type(t) is Table:
+        return cache.get(t)
+    stack.error(repr(t) + ' not a table')
+
+
+def set_global(stack, t, k, v):
+    # SET_TAB_UP with a key accepted by is_map_key
+    if type(t) is Table:
+        t.put_key(k, v)
+    else:
+        stack.error(repr(t) + ' not a table')
+
+
+def length(stack, v):
+    if type(v) in [str, Table]:
+        return len(v)
+    stack.error('length error')
+
+
+def concat(stack, *values):
+    for v in values:
+        if type(v) not in [str, int, float]:
+            stack.error('illegal concat ' + repr(v))
+            return None
+    return ''.join([str(v) for v in values])
+
+
+def set_list(stack, t, idx, values):
+    for v in values:
+        idx += 1
+        stack._set_table(t, idx, v)
+
+
+def lua_for(stack, i, limit, step):
+    # values of the control variable of a numeric for
+    if step == 0:
+        stack.error("'for' step is zero")
+        return ()
+    if type(i) is int and type(step) is int:
+        return range(i, i + for_count(i, limit, step) * step, step)
+    return for_values(stack, i, limit, step)
+
+
+def for_values(stack, i, limit, step):
+    # same steps as for_prep and for_loop of the VM
+    op = TOKEN.OP_LE if step >= 0 else TOKEN.OP_GE
+    i = i - step
+    while 1:
+        i = i + step
+        if not stack.compare_v(i, limit, op):
+            return
+        yield i
+
+
+def open_up_value(open_uvs, slot, v):
+    uv = open_uvs.get(slot)
+    if uv is None:
+        uv = open_uvs[slot] = UpVal(v)
+    return uv
+
+
+def new_native(make, up_values):
+    c = Closure(None)
+    c.up_values = up_values
+    c.native = make(up_values)
+    return c
+
+
+def new_closure(prototype, up_values):
+    c = Closure(prototype)
+    c.up_values = up_values
+    return c
+
+
+def truthy(v):
+    return '%s is not None and %s is not False' % (v, v)
+
+
+def falsy(v):
+    return '%s is None or %s is False' % (v, v)
+
+
+def reg(r):
+    return 'r%d' % r
+
+
+def tuple_exp(values):
+    if len(values) == 1:
+        return '(%s,)' % values[0]
+    return '(%s)' % ', '.join(values)
+
+
+class Transpiler:
+    # generates the Python source of every function of a FuncInfo tree,
+    # the whole chunk is compiled once, a function that can not be
+    # structured runs on the VM instead
+
+    def __init__(self, vm, prototype):
+        self.vm = vm
+        # builds the VM prototype of a function that is not transpiled
+        self.prototype = prototype
+        self.lines = []
+        self.names = {}
+        self.n_funcs = 0
+        self.fallbacks = 0
+
+    def transpile(self, info: FuncInfo):
+        # returns the closure of the main chunk, info is the result of analyzer.intermediate
+        fid = self.add(info.sub_funcs[0])
+        self.source = '\n'.join(self.lines) + '\n'
+        namespace = self.namespace()
+        exec(compile(self.source, '<lua>', 'exec'), namespace)
+        make = namespace.get('make_f%d' % fid)
+        if make is None:
+            return Closure(namespace['P%d' % fid])
+        c = Closure(None, up_len=len(info.sub_funcs[0].up_values))
+        c.native = make(c.up_values)
+        return c
+
+    def add(self, info):
+        fid = self.n_funcs
+        self.n_funcs += 1
+        writer = FuncWriter(self, info, fid)
+        try:
+            self.lines.extend(writer.write())
+        except TranspileError:
+            self.names['P%d' % fid] = self.prototype(info)
+            self.fallbacks += 1
+        return fid
+
+    def constant(self, v):
+        # name of a constant that has no Python literal
+        name = 'k%d' % len(self.names)
+        self.names[name] = v
+        return name
+
+    def key_cache(self, k):
+        # name of a new KeyCache for one GET_TAB_UP instruction
+        name = 'gc%d' % len(self.names)
+        self.names[name] = KeyCache(k)
+        return name
+
+    def field_cache(self, k):
+        # name of a new FieldCache for one GET_TABLE or SET_TABLE instruction
+        name = 'fc%d' % len(self.names)
+        self.names[name] = FieldCache(k)
+        return name
+
+    def namespace(self):
+        vm = self.vm
+        stack = vm.stack
+        namespace = {
+            'Closure': Closure,
+            'UpVal': UpVal,
+            'Table': Table,
+            'TOKEN': TOKEN,
+            'call': partial(call_value, vm),
+            'adjust': adjust,
+            'index': partial(index, stack),
+            'settable': stack._set_table,
+            'get_global': partial(get_global, stack),
+            'get_field': partial(get_field, stack),
+            'set_global': partial(set_global, stack),
+            'arith': stack.arith_v,
+            'compare': stack.compare_v,
+            'length': partial(length, stack),
+            'concat': partial(concat, stack),
+            'set_list': partial(set_list, stack),
+            'lua_for': partial(lua_for, stack),
+            'open_up_value': open_up_value,
+            'new_native': new_native,
+            'new_closure': new_closure,
+        }
+        namespace.update(self.names)
+        return namespace
+
+
+class FuncWriter:
+    # writes one Lua function as a Python factory taking the up values,
+    # registers are the locals r0, r1, ... and the jumps of loops and if
+    # statements are turned back into while, for and if
+
+    def __init__(self, transpiler, info, fid):
+        self.transpiler = transpiler
+        self.info = info
+        self.fid = fid
+        self.code = [encode(inst) for inst in info.ins]
+        self.constants = [None] * len(info.constants)
+        for (_, k), v in info.constants.items():
+            self.constants[v] = k
+        self.lines = []
+        self.depth = 2
+        # register from which the values of a multi results call or vararg are in mr
+        self.multi = None
+        # loop start -> pcs of the jumps back to it, the outermost loop first
+        self.heads = {}
+        for pc, (op, a, b, c) in enumerate(self.code):
+            if op == OP.JUMP and b < 0:
+                self.heads.setdefault(pc + 1 + b, []).append(pc)
+        for jumps in self.heads.values():
+            jumps.sort(reverse=True)
+
+    def write(self):
+        info = self.info
+        # ids of the sub functions are needed by closure
+        self.subs = [self.transpiler.add(sub) for sub in info.sub_funcs]
+        params = ['r%d=None' % i for i in range(info.param_num)]
+        params.append('*va')
+        self.block(0, len(self.code), [])
+        head = ['def make_f%d(U):' % self.fid,
+                '    def f%d(%s):' % (self.fid, ', '.join(params))]
+        regs = [reg(r) for r in range(info.param_num, info.max_regs)]
+        if regs:
+            head.append('        %s = None' % ' = '.join(regs))
+        if any(uv.local_var_slot >= 0 for sub in info.sub_funcs for uv in sub.up_values.values()):
+            head.append('        ouv = {}')
+        return head + self.lines + ['    return f%d' % self.fid, '']
+
+    def line(self, s):
+        self.lines.append('    ' * self.depth + s)
+
+    def k(self, idx):
+        v = self.constants[idx]
+        if type(v) in [int, str] or type(v) is float and math.isfinite(v):
+            return repr(v)
+        return self.transpiler.constant(v)
+
+    def rk(self, x):
+        if x > 0xff:
+            return self.k(x & 0xff)
+        return reg(x)
+
+    def body(self, start, end, loops):
+        self.depth += 1
+        if start == end:
+            self.line('pass')
+        else:
+            self.block(start, end, loops)
+        self.depth -= 1
+
+    def block(self, start, end, loops):
+        # writes the instructions in [start, end), loops holds
+        # (continue pc, break pc, start pc of while loops) of the enclosing loops
+        code = self.code
+        pc = start
+        while pc < end:
+            op, a, b, c = code[pc]
+            jumps = self.heads.get(pc)
+            if jumps is not None:
+                opened = len([1 for loop in loops if loop[2] == pc])
+                if opened < len(jumps):
+                    j = jumps[opened]
+                    if j >= end:
+                        raise TranspileError('loop crosses block end')
+                    self.line('while True:')
+                    self.depth += 1
+                    self.block(pc, j + 1, loops + [(pc, j + 1, pc)])
+                    self.line('break')
+                    self.depth -= 1
+                    pc = j + 1
+                    continue
+            if op == OP.FOR_PREP:
+                x = pc + 1 + b
+                if x >= end or code[x][0] != OP.FOR_LOOP or x + 1 + code[x][2] != pc + 1:
+                    raise TranspileError('bad numeric for')
+                self.line('for %s in lua_for(%s, %s, %s):' % (reg(a + 3), reg(a), reg(a + 1), reg(a + 2)))
+                self.body(pc + 1, x, loops + [(x, x + 1, None)])
+                pc = x + 1
+            elif op == OP.JUMP and 0 < b and pc + 1 + b < end and code[pc + 1 + b][0] == OP.T_FOR_CALL:
+                x = pc + 1 + b
+                _, fa, fb, _ = code[x]
+                if code[x + 1][0] != OP.T_FOR_LOOP or x + 2 + code[x + 1][2] != pc + 1:
+                    raise TranspileError('bad generic for')
+                self.line('while True:')
+                self.depth += 1
+                self.call(fa + 3, [fa, fa + 1, fa + 2], fb)
+                self.line('if %s is None: break' % reg(fa + 3))
+                self.line('%s = %s' % (reg(fa + 2), reg(fa + 3)))
+                self.block(pc + 1, x, loops + [(x, x + 2, None)])
+                self.depth -= 1
+                pc = x + 2
+            elif op == OP.TEST or op == OP.TEST_SET or op in test_tokens:
+                pc = self.branch(pc, end, loops)
+            elif op == OP.JUMP:
+                self.jump(pc, end, loops)
+                pc += 1
+            else:
+                self.inst(op, a, b, c)
+                pc += 1
+
+    def branch(self, pc, end, loops):
+        # a test followed by a jump, returns the pc after the if statement
+        code = self.code
+        op, a, b, c = code[pc]
+        if pc + 1 >= end or code[pc + 1][0] != OP.JUMP:
+            raise TranspileError('test without jump')
+        if op in test_tokens:
+            # the jump is taken when the comparison is a
+            cond = self.compare(test_compare[op], b, c)
+            taken, enter, side = '(%s)' % cond, 'not (%s)' % cond, None
+            if not a:
+                taken, enter = enter, taken
+        else:
+            if op == OP.TEST:
+                v, flag, side = reg(a), b, None
+            else:
+                v, flag, side = reg(b), c, '%s = %s' % (reg(a), reg(b))
+            # the jump is taken when the truth of v is flag
+            taken, enter = (truthy(v), falsy(v)) if flag else (falsy(v), truthy(v))
+        t = pc + 2 + code[pc + 1][2]
+        if t <= pc:
+            # until of repeat
+            if not loops or loops[-1][0] != t:
+                raise TranspileError('jump back out of loop')
+            self.line('if %s:' % taken)
+            self.depth += 1
+            if side:
+                self.line(side)
+            self.line('continue')
+            self.depth -= 1
+            return pc + 2
+        if t > end:
+            raise TranspileError('jump out of block')
+        then_end, else_end = t, None
+        if t - 1 >= pc + 2:
+            lop, la, lb, lc = code[t - 1]
+            if lop == OP.JUMP and lb > 0 and t + lb <= end:
+                then_end, else_end = t - 1, t + lb
+        self.line('if %s:' % enter)
+        self.body(pc + 2, then_end, loops)
+        if side or else_end is not None:
+            self.line('else:')
+            self.depth += 1
+            if side:
+                self.line(side)
+            if else_end is not None:
+                self.block(t, else_end, loops)
+            self.depth -= 1
+        return t if else_end is None else else_end
+
+    def jump(self, pc, end, loops):
+        t = pc + 1 + self.code[pc][2]
+        if t == pc + 1:
+            return
+        if loops and t == loops[-1][1]:
+            self.line('break')
+        elif loops and t == loops[-1][0]:
+            self.line('continue')
+        elif t != end or pc != end - 1:
+            raise TranspileError('unstructured jump')
+
+    def args(self, first, n):
+        # registers from first, all values up to the top when n is -1
+        if n >= 0:
+            return [reg(r) for r in range(first, first + n)]
+        if self.multi is None:
+            raise TranspileError('no multiple results')
+        return [reg(r) for r in range(first, self.multi)] + ['*mr']
+
+    def call_exp(self, f, args):
+        args = ', '.join(args)
+        return '%s.native(%s) if type(%s) is Closure and %s.native is not None else call(%s%s)' % (
+            f, args, f, f, f, ', ' + args if args else '')
+
+    def results(self, a, n, exp):
+        # assigns n results of exp from register a, -1 for all of them
+        if n < 0:
+            self.line('mr = %s' % exp)
+            self.multi = a
+        elif n == 0:
+            self.line(exp)
+        elif n == 1:
+            self.line('t = %s' % exp)
+            self.line('%s = t[0] if t else None' % reg(a))
+        else:
+            self.line('%s = adjust(%s, %d)' % (', '.join(reg(r) for r in range(a, a + n)), exp, n))
+
+    def call(self, a, args, n):
+        self.results(a, n, self.call_exp(reg(args[0]), [reg(r) for r in args[1:]]))
+
+    def arith(self, op, a, b, c):
+        x, y = self.rk(b), self.rk(c)
+        tok = 'TOKEN.%s' % arith_tokens[op].name
+        slow = 'arith(%s, %s, %s)' % (tok, x, y)
+        checks = [v for i, v in [(b, x), (c, y)] if i <= 0xff]
+        fast = op in int_arith and all(type(self.constants[i & 0xff]) is int for i in [b, c] if i > 0xff)
+        if not fast:
+            self.line('%s = %s' % (reg(a), slow))
+        elif not checks:
+            self.line('%s = %s %s %s' % (reg(a), x, int_arith[op], y))
+        else:
+            cond = ' and '.join('type(%s) is int' % v for v in checks)
+            self.line('%s = %s %s %s if %s else %s' % (reg(a), x, int_arith[op], y, cond, slow))
+
+    def compare(self, op, b, c):
+        # expression of the comparison of the RK operands b and c
+        x, y = self.rk(b), self.rk(c)
+        slow = 'compare(%s, %s, TOKEN.%s)' % (x, y, compare_tokens[op].name)
+        if any(type(self.constants[i & 0xff]) is not int for i in [b, c] if i > 0xff):
+            return slow
+        fast = '%s %s %s' % (x, int_compare[op], y)
+        checks = [v for i, v in [(b, x), (c, y)] if i <= 0xff]
+        if not checks:
+            return fast
+        return '%s if %s is int else %s' % (fast, ' is '.join('type(%s)' % v for v in checks), slow)
+
+    def inst(self, op, a, b, c):
+        ra = reg(a)
+        if op == OP.MOVE:
+            self.line('%s = %s' % (ra, reg(b)))
+        elif op == OP.LOAD_K:
+            self.line('%s = %s' % (ra, self.k(b)))
+        elif op == OP.LOAD_NIL:
+            if b >= 0:
+                self.line('%s = None' % ' = '.join(reg(r) for r in range(a, a + b + 1)))
+        elif op == OP.LOAD_BOOL:
+            if c != 0:
+                raise TranspileError('load_bool with skip')
+            self.line('%s = %s' % (ra, bool(b)))
+        elif op == OP.GET_UP_VAL:
+            self.line('%s = U[%d].val' % (ra, b))
+        elif op == OP.SET_UP_VAL:
+            self.line('U[%d] = UpVal(%s)' % (b, ra))
+        elif op == OP.GET_TAB_UP:
+            if c > 0xff and is_map_key(self.constants[c & 0xff]):
+                gc = self.transpiler.key_cache(self.constants[c & 0xff])
+                self.line('%s = U[%d].val' % (ra, b))
+                self.line('%s = %s.value if %s is %s.table and %s.version == %s.version else get_global(%s, %s)'
+                          % (ra, gc, ra, gc, ra, gc, ra, gc))
+            else:
+                self.line('%s = index(U[%d].val, %s)' % (ra, b, self.rk(c)))
+        elif op == OP.SET_TAB_UP:
+            if b > 0xff and is_map_key(self.constants[b & 0xff]):
+                self.line('set_global(U[%d].val, %s, %s)' % (a, self.rk(b), self.rk(c)))
+            else:
+                self.line('settable(U[%d].val, %s, %s)' % (a, self.rk(b), self.rk(c)))
+        elif op == OP.GET_TABLE:
+            rb, k = reg(b), self.rk(c)
+            if c > 0xff and is_map_key(self.constants[c & 0xff]):
+                fc = self.transpiler.field_cache(self.constants[c & 0xff])
+                self.line('%s = %s.values[%s.index] if type(%s) is Table and %s.shape is %s.shape else get_field(%s, %s)'
+                          % (ra, rb, fc, rb, rb, fc, rb, fc))
+            else:
+                self.line('%s = %s.get(%s) if type(%s) is Table else index(%s, %s)' % (ra, rb, k, rb, rb, k))
+        elif op == OP.SET_TABLE:
+            k, v = self.rk(b), self.rk(c)
+            if b > 0xff and is_map_key(self.constants[b & 0xff]):
+                fc = self.transpiler.field_cache(self.constants[b & 0xff])
+                self.line('if type(%s) is Table: %s.put(%s, %s)' % (ra, fc, ra, v))
+            else:
+                self.line('if type(%s) is Table: %s.put(%s, %s)' % (ra, ra, k, v))
+            self.line('else: settable(%s, %s, %s)' % (ra, k, v))
+        elif op == OP.NEW_TABLE:
+            self.line('%s = Table()' % ra)
+        elif op == OP.SELF:
+            k = self.rk(c)
+            self.line('t = %s' % reg(b))
+            self.line('%s = t' % reg(a + 1))
+            self.line('%s = t.get(%s) if type(t) is Table else index(t, %s)' % (ra, k, k))
+        elif op in int_arith or op in [OP.POW, OP.DIV, OP.SHL, OP.SHR]:
+            self.arith(op, a, b, c)
+        elif op == OP.UNM or op == OP.BNOT:
+            x = self.rk(b)
+            self.line('%s = %s%s if type(%s) is int else arith(TOKEN.%s, %s, %s, True)' % (
+                ra, '-' if op == OP.UNM else '~', x, x, arith_tokens[op].name, x, x))
+        elif op == OP.NOT:
+            self.line('%s = %s' % (ra, falsy(reg(b))))
+        elif op == OP.LEN:
+            self.line('%s = length(%s)' % (ra, reg(b)))
+        elif op == OP.CONCAT:
+            self.line('%s = concat(%s)' % (ra, ', '.join(reg(r) for r in range(b, c + 1))))
+        elif op in int_compare:
+            self.line('%s = %s' % (ra, self.compare(op, b, c)))
+        elif op == OP.CALL:
+            self.results(a, c, self.call_exp(ra, self.args(a + 1, b)))
+        elif op == OP.TAIL_CALL:
+            # Python has no tail calls, the frame of the caller is kept
+            self.line('return %s' % self.call_exp(ra, self.args(a + 1, b)))
+            self.multi = a
+        elif op == OP.RETURN:
+            values = self.args(a, b)
+            if values == ['*mr']:
+                self.line('return mr')
+            else:
+                self.line('return %s' % tuple_exp(values))
+        elif op == OP.VARARG:
+            if b < 0:
+                self.line('mr = va')
+                self.multi = a
+            elif b == 1:
+                self.line('%s = va[0] if va else None' % ra)
+            elif b > 1:
+                self.line('%s = adjust(va, %d)' % (', '.join(reg(r) for r in range(a, a + b)), b))
+        elif op == OP.SET_LIST:
+            values = self.args(a + 1, b if b != 0 else -1)
+            self.line('set_list(%s, %d, %s)' % (ra, (c - 1) * FIELDS_PER_FLUSH, tuple_exp(values)))
+        elif op == OP.CLOSURE:
+            sub = self.info.sub_funcs[b]
+            up_values = [None] * len(sub.up_values)
+            for uv in sub.up_values.values():
+                if uv.local_var_slot >= 0:
+                    up_values[uv.idx] = 'open_up_value(ouv, %d, %s)' % (uv.local_var_slot, reg(uv.local_var_slot))
+                else:
+                    up_values[uv.idx] = 'U[%d]' % uv.up_value_idx
+            sid = self.subs[b]
+            if 'P%d' % sid in self.transpiler.names:
+                self.line('%s = new_closure(P%d, [%s])' % (ra, sid, ', '.join(up_values)))
+            else:
+                self.line('%s = new_native(make_f%d, [%s])' % (ra, sid, ', '.join(up_values)))
+        else:
+            raise TranspileError('unexpected %s' % OP(op).name)
+
+
+def transpile(info, vm, prototype):
+    t = Transpiler(vm, prototype)
+    return t.transpile(info)
@@ -1,8 +1,13 @@
+import sys
+import threading
+import operator
+from functools import partial
 from info import FuncInfo
-from analyzer import intermediate
 from lua_stack import Stack, Closure, UpVal
-from lua_table import Table
+from lua_table import Table, KeyCache, FieldCache, is_map_key
+from lua_utils import convert_to_boolean, for_count
 from tokens import TOKEN
+from opcodes import OP, encode, arith_tokens, compare_tokens, test_tokens
 from config import *
 
 
@@ -15,15 +20,15 @@ class ProtoUpValue:
 
 class Prototype:
 
-    def __init__(self, info: FuncInfo):
+    def __init__(self, info: FuncInfo, threaded=True):
         self.info = info
         self.num_params = info.param_num
         self.max_stack = info.max_regs
         self.is_vararg = self.info.is_vararg
-        self.code = info.ins
+        self.code = [encode(inst) for inst in info.ins]
 
         self.constants = [None] * len(info.constants)
-        for k, v in info.constants.items():
+        for (_, k), v in info.constants.items():
             self.constants[v] = k
         # up value is composed of a bool (1 for in stack) and an integer (index)
         self.up_values = [None] * len(info.up_values)
@@ -33,15 +38,26 @@ class Prototype:
             else:
                 self.up_values[v.idx] = ProtoUpValue(0, v.up_value_idx)
 
-        self.prototypes = [Prototype(sub) for sub in info.sub_funcs]
+        self.prototypes = [Prototype(sub, threaded) for sub in info.sub_funcs]
+        self.load(threaded)
+
+    def load(self, threaded=True):
+        # pre-decoded instruction stream, None to use the opcode dispatch of VM.execute
+        self.threaded = decode(self) if threaded else None
+        # executions left before each adaptive instruction is quickened
+        self.warmup = [QUICKEN_WARMUP] * len(self.code)
 
 
 class VM:
 
     def __init__(self):
-        self.stack = Stack(state=self)
+        # register file shared by the frames of all calls
+        self.slots = []
+        self.stack = Stack(self.slots, state=self)
+        self.free_stacks = []
         self.registry = Table()
         self.registry.put(LUA_GLOBALS, Table())
+        self.handlers = self.init_handlers()
 
     def error(self, s=""):
         print('vm compile error:', s)
@@ -49,12 +65,14 @@ class VM:
         print(self.stack.slots)
 
     def load(self, prototype):
-        c = Closure(prototype)
+        self.load_closure(Closure(prototype))
+        return 0
+
+    def load_closure(self, c):
         self.stack.push(c)
-        if len(prototype.up_values) > 0:
+        if len(c.up_values) > 0:
             env = self.registry.get(LUA_GLOBALS)
             c.up_values[0] = UpVal(env)
-        return 0
 
     def load_vararg(self, n):
         if n < 0:
@@ -78,66 +96,109 @@ class VM:
                 c.up_values[i] = self.stack.closure.up_values[uv.idx]
 
     def call(self, n_args, n_results):
-        val = self.stack.get(-n_args - 1)
+        # the function and arguments are on the top, they are replaced by n_results results
+        slots = self.slots
+        func = len(slots) - n_args - 1
+        val = slots[func]
         if type(val) is not Closure:
             self.error(repr(val) + ' is not a function')
-        if val.prototype is None:
-            self.call_py_closure(n_args, n_results, val)
+        if val.native is not None:
+            results = val.native(*slots[func + 1:])
+            del slots[func:]
+            slots.extend(results)
+        elif val.prototype is None:
+            self.call_py_closure(func, val)
+        else:
+            self.call_closure(func, n_args, val)
+        if n_results >= 0:
+            top = func + n_results
+            n = len(slots)
+            if n > top:
+                del slots[top:]
+            elif n < top:
+                slots.extend([None] * (top - n))
+
+    def call_value(self, f, args):
+        # calls f from Python code and returns all of its results
+        slots = self.slots
+        func = len(slots)
+        slots.append(f)
+        slots.extend(args)
+        self.call(len(args), -1)
+        results = slots[func:]
+        del slots[func:]
+        return results
+
+    def new_stack(self, closure, base):
+        if self.free_stacks:
+            stack = self.free_stacks.pop()
+            stack.closure = closure
+            stack.base = base
+            stack.pc = 0
         else:
-            self.call_closure(n_args, n_results, val)
-
-    def call_closure(self, n_args, n_results, c):
-        n_regs = c.prototype.max_stack
-        n_params = c.prototype.num_params
-        is_vararg = c.prototype.is_vararg
-        stack = Stack(closure=c, state=self)
-        func_and_args = self.stack.pop_n(n=n_args + 1)
-        stack.push_n(func_and_args[1:], n_params)
-        if n_args > n_params and is_vararg:
-            stack.varargs = func_and_args[n_params + 1:]
+            stack = Stack(self.slots, base, closure, state=self)
+        return stack
+
+    def free_stack(self, stack):
+        stack.closure = None
+        stack.varargs = ()
+        stack.open_uvs.clear()
+        self.free_stacks.append(stack)
+
+    def call_closure(self, func, n_args, c):
+        # arguments stay in place and become the first registers of the new frame,
+        # the results are moved down to the slot of the function by _return
+        stack = self.new_stack(c, func + 1)
+        stack.n_results = None
+        self.enter_frame(stack, n_args)
         self.push_stack(stack)
-        self.stack.set_top(n_regs)
         self.run_closure()
-        self.pop_stack()
-        if n_results != 0:
-            results = stack.pop_n(n=len(stack) - n_regs)
-            self.stack.push_n(results, n_results)
-
-    def call_py_closure(self, n_args, n_results, c):
-        stack = Stack(closure=c, state=self)
-        args = self.stack.pop_n(n=n_args)
-        stack.push_n(args, n_args)
-        self.stack.pop()
+
+    def enter_frame(self, stack, n_args):
+        # the arguments are the first registers of the frame
+        proto = stack.closure.prototype
+        last = stack.base + proto.num_params
+        if n_args > proto.num_params:
+            if proto.is_vararg:
+                stack.varargs = self.slots[last:]
+            del self.slots[last:]
+        stack.set_top(proto.max_stack)
+
+    def call_py_closure(self, func, c):
+        stack = self.new_stack(c, func + 1)
         self.push_stack(stack)
         r = c.py_func(self)
         self.pop_stack()
-        if n_results != 0:
-            results = stack.pop_n(r)
-            self.stack.push_n(results, n_results)
+        self.free_stack(stack)
+        slots = self.slots
+        if r:
+            del slots[func: len(slots) - r]
+        else:
+            del slots[func:]
 
     def run_closure(self):
+        # run until the frame on the top returns, calls and returns between Lua
+        # functions only switch frames inside this loop, handlers return True
+        # when the current frame is switched
+        stack = self.stack
+        bottom = stack.prev
+        code = stack.closure.prototype.threaded
+        if code is not None:
+            while 1:
+                h, a, b, c = code[stack.pc]
+                stack.pc += 1
+                if h(self, a, b, c):
+                    stack = self.stack
+                    if stack is bottom:
+                        break
+                    code = stack.closure.prototype.threaded
+            return
+        handlers = self.handlers
         while 1:
-            inst = self.fetch()
-            self.execute(inst)
-            if inst[0] == 'return':
+            op, a, b, c = self.fetch()
+            if handlers[op](a, b, c) and self.stack is bottom:
                 break
 
-    def push_func_and_args(self, a, b):
-        if b >= 1:
-            for i in range(a, a + b):
-                self.stack.push_value(i)
-            return b - 1
-        else:
-            self.fix_stack(a)
-            return len(self.stack) - self.register_count() - 1
-
-    def pop_results(self, a, c):
-        if c > 1:
-            for i in range(a + c - 2, a - 1, -1):
-                self.stack.replace(i)
-        elif c == 0:
-            self.stack.push(a)
-
     def register_count(self):
         return self.stack.closure.prototype.max_stack
 
@@ -161,13 +222,6 @@ class VM:
         self.stack = stack.prev
         stack.prev = None
 
-    def fix_stack(self, a):
-        x = self.stack.to_integer(-1)
-        self.stack.pop()
-        for i in range(a, x):
-            self.stack.push_value(i)
-        self.stack.rotate(self.register_count() + 1, x - a)
-
     def push_global_table(self):
         global_table = self.registry.get(LUA_GLOBALS)
         self.stack.push(global_table)
@@ -220,7 +274,7 @@ class VM:
         else:
             self.stack.push_value(rk + 1)
 
-    def move(self, a, b):
+    def move(self, a, b, c=0):
         a += 1
         b += 1
         self.stack.copy(b, a)
@@ -228,12 +282,12 @@ class VM:
     def _close_up_values(self, a):
         pass
 
-    def jump(self, a, b):
+    def jump(self, a, b, c=0):
         self.add_pc(b)
         if a != 0:
             self._close_up_values(a)
 
-    def load_nil(self, a, b):
+    def load_nil(self, a, b, c=0):
         a += 1
         for i in range(a, a + b + 1):
             self.stack.set(i, None)
@@ -244,12 +298,12 @@ class VM:
         if self.stack.get(c):
             self.stack.pc += 1
 
-    def load_k(self, a, b):
+    def load_k(self, a, b, c=0):
         a += 1
         self.get_const(b)
         self.stack.replace(a)
 
-    def _not(self, a, b):
+    def _not(self, a, b, c=0):
         a += 1
         b += 1
         self.stack.push(not self.stack.to_boolean(b))
@@ -263,37 +317,32 @@ class VM:
         else:
             self.stack.pc += 1
 
-    def _test(self, a, c):
-        if self.stack.to_boolean(a + 1) != bool(c):
+    def _test(self, a, b, c=0):
+        if self.stack.to_boolean(a + 1) != bool(b):
             self.stack.pc += 1
 
-    def for_prep(self, a, b):
-        a += 1
-        self.stack.set(a, self.stack.get(a) - self.stack.get(a + 2))
-        self.stack.pc += b
+    def for_prep(self, a, b, c=0):
+        t_for_prep(self, a, b, c)
 
-    def for_loop(self, a, b):
-        a += 1
-        self.stack.set(a, self.stack.get(a) + self.stack.get(a + 2))
-        positive = self.stack.to_number(a + 2) >= 0
-        if positive and self.stack.compare(a, a + 1, TOKEN.OP_LE) or \
-                not positive and self.stack.compare(a, a + 1, TOKEN.OP_GE):
-            self.stack.pc += b
-            self.stack.copy(a, a + 3)
-
-    def t_for_call(self, a, b):
-        a += 1
-        self.push_func_and_args(a, 3)
-        self.call(2, b)
-        self.pop_results(a + 3, b + 1)
+    def for_loop(self, a, b, c=0):
+        t_for_loop(self, a, b, c)
+
+    def t_for_call(self, a, b, c=0):
+        # the iterator is called with copies of the generator, state and control
+        # above them, so the results land in the loop variables
+        slots = self.slots
+        p = self.stack.base + a
+        del slots[p + 3:]
+        slots.extend(slots[p: p + 3])
+        return self._call(a + 3, 3, b + 1)
 
-    def t_for_loop(self, a, b):
+    def t_for_loop(self, a, b, c=0):
         a += 1
         if not self.stack.is_nil(a + 1):
             self.stack.copy(a + 1, a)
             self.add_pc(b)
 
-    def new_table(self, a):
+    def new_table(self, a, b=0, c=0):
         self.stack.create_table()
         self.stack.replace(a + 1)
 
@@ -313,56 +362,105 @@ class VM:
         idx = c * FIELDS_PER_FLUSH
         b_zero = b == 0
         if b_zero:
-            b = self.stack.to_integer(-1) - a - 1
-            self.stack.pop()
+            b = len(self.stack) - a
         for i in range(1, b + 1):
             idx += 1
             self.stack.push_value(a + i)
             self.stack.set_field(a, idx)
         if b_zero:
-            for j in range(self.register_count() + 1, len(self.stack) + 1):
-                idx += 1
-                self.stack.push_value(j)
-                self.stack.set_field(a, idx)
             self.stack.set_top(self.register_count())
 
-    def _closure(self, a, b):
+    def _closure(self, a, b, c=0):
         self.load_proto(b)
         self.stack.replace(a + 1)
 
     def _call(self, a, b, c):
-        a += 1
-        n_args = self.push_func_and_args(a, b)
-        self.call(n_args, c - 1)
-        self.pop_results(a, c)
+        # the function is in register a, followed by b - 1 arguments or
+        # by all values up to the top when b is 0
+        # returns True when a frame is pushed for a Lua function
+        slots = self.slots
+        func = self.stack.base + a
+        if b != 0:
+            del slots[func + b:]
+        val = slots[func]
+        if type(val) is Closure and val.prototype is not None:
+            stack = self.new_stack(val, func + 1)
+            stack.n_results = c - 1
+            self.enter_frame(stack, len(slots) - func - 1)
+            self.push_stack(stack)
+            return True
+        self.call(len(slots) - func - 1, c - 1)
+        if c != 0:
+            self.stack.set_top(self.register_count())
+
+    def tail_call(self, a, b):
+        # call the function in register a with the current frame,
+        # returns True when the frame is reused by a Lua function
+        stack = self.stack
+        slots = self.slots
+        func = stack.base + a
+        if b != 0:
+            del slots[func + b:]
+        val = slots[func]
+        if type(val) is not Closure or val.prototype is None:
+            # the results are left from register a to the top for the following return
+            self.call(len(slots) - func - 1, -1)
+            return False
+        n_args = len(slots) - func - 1
+        del slots[stack.base - 1: func]
+        stack.closure = val
+        stack.pc = 0
+        stack.varargs = ()
+        stack.open_uvs.clear()
+        self.enter_frame(stack, n_args)
+        return True
 
     def _return(self, a, b):
-        a += 1
-        if b > 1:
-            for i in range(a, a + b - 1):
-                self.stack.push_value(i)
-        elif b == 0:
-            self.fix_stack(a)
+        # move the results to the slot of the called function and pop the frame
+        slots = self.slots
+        stack = self.stack
+        base = stack.base
+        if b != 0:
+            del slots[base + a + b - 1:]
+        del slots[base - 1: base + a]
+        n_results = stack.n_results
+        self.pop_stack()
+        self.free_stack(stack)
+        if n_results is not None:
+            # called by an instruction of the caller, not by VM.call
+            if n_results >= 0:
+                top = base - 1 + n_results
+                n = len(slots)
+                if n > top:
+                    del slots[top:]
+                elif n < top:
+                    slots.extend([None] * (top - n))
+                self.stack.set_top(self.register_count())
+        return True
 
     def _vararg(self, a, b):
-        a += 1
-        if b != 1:
-            self.load_vararg(b - 1)
-            self.pop_results(a, b)
+        if b == 0:
+            self.stack.set_top(a)
+            self.slots.extend(self.stack.varargs)
+        else:
+            for i in range(b - 1):
+                if i < len(self.stack.varargs):
+                    self.stack.set(a + i + 1, self.stack.varargs[i])
+                else:
+                    self.stack.set(a + i + 1, None)
 
     def _self(self, a, b, c):
         a += 1
         b += 1
-        c += 1
         self.stack.copy(b, a + 1)
         self.get_rk(c)
         self.stack.get_table(b)
         self.stack.replace(a)
 
-    def get_up_val(self, a, b):
+    def get_up_val(self, a, b, c=0):
         self.stack.copy(self.up_value_index(b + 1), a + 1)
 
-    def set_up_val(self, a, b):
+    def set_up_val(self, a, b, c=0):
         self.stack.copy(a + 1, self.up_value_index(b + 1))
 
     def get_tab_up(self, a, b, c):
@@ -375,96 +473,103 @@ class VM:
         self.get_rk(c)
         self.stack.set_table(self.up_value_index(a + 1))
 
+    def arith(self, op, a, b, c):
+        self.get_rk(b)
+        self.get_rk(c)
+        self.stack.arith(op)
+        self.stack.replace(a + 1)
+
+    def unary_arith(self, op, a, b, c=0):
+        self.get_rk(b)
+        self.stack.arith(op, True)
+        self.stack.replace(a + 1)
+
+    def compare(self, op, a, b, c):
+        self.get_rk(b)
+        self.get_rk(c)
+        v = self.stack.compare(-2, -1, op)
+        self.stack.pop(2)
+        self.stack.set(a + 1, v)
+
+    def test_compare(self, op, a, b, c):
+        self.get_rk(b)
+        self.get_rk(c)
+        v = self.stack.compare(-2, -1, op)
+        self.stack.pop(2)
+        if v != bool(a):
+            self.stack.pc += 1
+
+    def length(self, a, b, c=0):
+        self.stack.length(b + 1)
+        self.stack.replace(a + 1)
+
+    def concat(self, a, b, c):
+        a += 1
+        b += 1
+        c += 1
+        for i in range(b, c + 1):
+            self.stack.push_value(i)
+        self.stack.concat(c - b + 1)
+        self.stack.replace(a)
+
+    def call_inst(self, a, b, c):
+        return self._call(a, b + 1, c + 1)
+
+    def tail_call_inst(self, a, b, c):
+        return self.tail_call(a, b + 1)
+
+    def return_inst(self, a, b, c=0):
+        return self._return(a, b + 1)
+
+    def vararg_inst(self, a, b, c=0):
+        self._vararg(a, b + 1)
+
+    def init_handlers(self):
+        # handler table indexed by opcode, every handler takes (a, b, c)
+        handlers = [None] * len(OP)
+        handlers[OP.MOVE] = self.move
+        handlers[OP.LOAD_K] = self.load_k
+        handlers[OP.LOAD_NIL] = self.load_nil
+        handlers[OP.LOAD_BOOL] = self.load_bool
+        handlers[OP.GET_UP_VAL] = self.get_up_val
+        handlers[OP.GET_TAB_UP] = self.get_tab_up
+        handlers[OP.GET_TABLE] = self.get_table
+        handlers[OP.SET_TAB_UP] = self.set_tab_up
+        handlers[OP.SET_UP_VAL] = self.set_up_val
+        handlers[OP.SET_TABLE] = self.set_table
+        handlers[OP.NEW_TABLE] = self.new_table
+        handlers[OP.SELF] = self._self
+        for op in [OP.ADD, OP.SUB, OP.MUL, OP.MOD, OP.POW, OP.DIV, OP.IDIV,
+                   OP.BAND, OP.BOR, OP.BXOR, OP.SHL, OP.SHR]:
+            handlers[op] = partial(self.arith, arith_tokens[op])
+        handlers[OP.UNM] = partial(self.unary_arith, arith_tokens[OP.UNM])
+        handlers[OP.BNOT] = partial(self.unary_arith, arith_tokens[OP.BNOT])
+        handlers[OP.NOT] = self._not
+        handlers[OP.LEN] = self.length
+        handlers[OP.CONCAT] = self.concat
+        handlers[OP.JUMP] = self.jump
+        for op in [OP.EQ, OP.NE, OP.LT, OP.LE, OP.GT, OP.GE]:
+            handlers[op] = partial(self.compare, compare_tokens[op])
+        handlers[OP.TEST] = self._test
+        for op in [OP.TEST_EQ, OP.TEST_LT, OP.TEST_LE]:
+            handlers[op] = partial(self.test_compare, test_tokens[op])
+        handlers[OP.TEST_SET] = self._test_set
+        handlers[OP.CALL] = self.call_inst
+        handlers[OP.TAIL_CALL] = self.tail_call_inst
+        handlers[OP.RETURN] = self.return_inst
+        handlers[OP.FOR_LOOP] = self.for_loop
+        handlers[OP.FOR_PREP] = self.for_prep
+        handlers[OP.T_FOR_CALL] = self.t_for_call
+        handlers[OP.T_FOR_LOOP] = self.t_for_loop
+        handlers[OP.SET_LIST] = self.set_list
+        handlers[OP.CLOSURE] = self._closure
+        handlers[OP.VARARG] = self.vararg_inst
+        return handlers
+
     def execute(self, inst):
         # print(inst)
-        op = inst[0]
-        params = inst[1:]
-        if op == 'move':
-            self.move(*params)
-        elif op == 'jump':
-            self.jump(*params)
-        elif op == 'load_nil':
-            self.load_nil(*(params[:2]))
-        elif op == 'load_bool':
-            self.load_bool(*params)
-        elif op == 'load_k':
-            self.load_k(*params)
-        elif op in [TOKEN.OP_ADD, TOKEN.OP_MINUS, TOKEN.OP_MUL, TOKEN.OP_MOD, TOKEN.OP_POW, TOKEN.OP_DIV,
-                    TOKEN.OP_IDIV, TOKEN.OP_BAND, TOKEN.OP_BOR, TOKEN.OP_BXOR, TOKEN.OP_SHL, TOKEN.OP_SHR]:
-            uni_op = len(params) == 2
-            if uni_op:
-                self.get_rk(params[-1])
-            else:
-                self.get_rk(params[-2])
-                self.get_rk(params[-1])
-            self.stack.arith(op, uni_op)
-            self.stack.replace(params[0] + 1)
-        elif op == TOKEN.OP_LEN:
-            a, b = params
-            self.stack.length(b + 1)
-            self.stack.replace(a + 1)
-        elif op == TOKEN.OP_CONCAT:
-            a, b, c = params
-            a += 1
-            b += 1
-            c += 1
-            for i in range(b, c + 1):
-                self.stack.push_value(i)
-            self.stack.concat(c - b + 1)
-            self.stack.replace(a)
-        elif op in [TOKEN.OP_LT, TOKEN.OP_GT, TOKEN.OP_EQ, TOKEN.OP_NE, TOKEN.OP_LE, TOKEN.OP_GE]:
-            a, b, c = params
-            self.stack.set(a + 1, self.stack.compare(b + 1, c + 1, op))
-        elif op == TOKEN.OP_NOT:
-            self._not(*params)
-        elif op == 'test_set':
-            self._test_set(*params)
-        elif op == 'test':
-            self._test(*params)
-        elif op == 'for_prep':
-            self.for_prep(*params)
-        elif op == 'for_loop':
-            self.for_loop(*params)
-        elif op == 't_for_call':
-            self.t_for_call(*params)
-        elif op == 't_for_loop':
-            self.t_for_loop(*params)
-        elif op == 'new_table':
-            self.new_table(params[0])
-        elif op == 'set_table':
-            self.set_table(*params)
-        elif op == 'get_table':
-            self.get_table(*params)
-        elif op == 'set_list':
-            self.set_list(*params)
-        elif op == 'closure':
-            self._closure(*params)
-        elif op == 'call':
-            a, b, c = params
-            b += 1
-            c += 1
-            self._call(a, b, c)
-        elif op == 'return':
-            a, b = params
-            b += 1
-            self._return(a, b)
-        elif op == 'vararg':
-            a, b = params
-            b += 1
-            self._vararg(a, b)
-        elif op == 'self':
-            self._self(*params)
-        elif op == 'get_up_val':
-            self.get_up_val(*params)
-        elif op == 'set_up_val':
-            self.set_up_val(*params)
-        elif op == 'get_tab_up':
-            self.get_tab_up(*params)
-        elif op == 'set_tab_up':
-            self.set_tab_up(*params)
-        else:
-            print(self.stack)
-            self.error('%s not support' % str(op))
+        op, a, b, c = inst
+        self.handlers[op](a, b, c)
 
     def compile(self):
         while self.stack.pc < len(self.stack.closure.prototype.prototypes[0].code):
@@ -473,9 +578,642 @@ class VM:
             self.stack.pc += 1
 
 
+# handlers of the pre-decoded instruction stream, operands are resolved by decode:
+# registers are offsets from the base of the frame and RK operands are split into
+# constants and registers
+def t_move(vm, a, b, c):
+    s = vm.slots
+    o = vm.stack.base
+    s[o + a] = s[o + b]
+
+
+def t_load_k(vm, a, b, c):
+    vm.slots[vm.stack.base + a] = b
+
+
+def t_load_nil(vm, a, b, c):
+    s = vm.slots
+    o = vm.stack.base
+    for i in range(o + a, o + b):
+        s[i] = None
+
+
+def t_load_bool(vm, a, b, c):
+    stack = vm.stack
+    vm.slots[stack.base + a] = b
+    if c:
+        stack.pc += 1
+
+
+def t_get_up_val(vm, a, b, c):
+    stack = vm.stack
+    vm.slots[stack.base + a] = stack.closure.up_values[b].val
+
+
+def t_set_up_val(vm, a, b, c):
+    stack = vm.stack
+    stack.closure.up_values[b] = UpVal(vm.slots[stack.base + a])
+
+
+def t_new_table(vm, a, b, c):
+    vm.slots[vm.stack.base + a] = Table()
+
+
+def t_not(vm, a, b, c):
+    s = vm.slots
+    o = vm.stack.base
+    s[o + a] = not convert_to_boolean(s[o + b])
+
+
+def t_jump(vm, a, b, c):
+    vm.stack.pc += b
+
+
+def t_test(vm, a, b, c):
+    stack = vm.stack
+    if convert_to_boolean(vm.slots[stack.base + a]) != b:
+        stack.pc += 1
+
+
+def t_test_set(vm, a, b, c):
+    stack = vm.stack
+    s = vm.slots
+    o = stack.base
+    if convert_to_boolean(s[o + b]) == c:
+        s[o + a] = s[o + b]
+    else:
+        stack.pc += 1
+
+
+def t_for_prep(vm, a, b, c):
+    # a loop with an integer start and step keeps the number of iterations left
+    # in place of its limit, other loops compare with the limit at every step
+    stack = vm.stack
+    s = vm.slots
+    a += stack.base
+    i = s[a]
+    step = s[a + 2]
+    if step == 0:
+        stack.error("'for' step is zero")
+        # an empty integer loop
+        s[a] = s[a + 1] = 0
+    elif type(i) is int and type(step) is int:
+        s[a + 1] = for_count(i, s[a + 1], step)
+        s[a] = i - step
+    else:
+        s[a] = i - step
+    stack.pc += b
+
+
+def t_for_loop(vm, a, b, c):
+    stack = vm.stack
+    s = vm.slots
+    a += stack.base
+    i = s[a]
+    if type(i) is int:
+        n = s[a + 1]
+        if n > 0:
+            s[a + 1] = n - 1
+            i += s[a + 2]
+            s[a] = i
+            s[a + 3] = i
+            stack.pc += b
+        return
+    step = s[a + 2]
+    i += step
+    s[a] = i
+    if stack.compare_v(i, s[a + 1], TOKEN.OP_LE if step >= 0 else TOKEN.OP_GE):
+        stack.pc += b
+        s[a + 3] = i
+
+
+def t_t_for_loop(vm, a, b, c):
+    stack = vm.stack
+    s = vm.slots
+    a += stack.base
+    if s[a + 1] is not None:
+        s[a] = s[a + 1]
+        stack.pc += b
+
+
+def t_return(vm, a, b, c):
+    return vm._return(a, b)
+
+
+def t_compare(op):
+    def rr(vm, a, b, c):
+        stack = vm.stack
+        s = vm.slots
+        o = stack.base
+        s[o + a] = stack.compare_v(s[o + b], s[o + c], op)
+
+    def rk(vm, a, b, c):
+        stack = vm.stack
+        s = vm.slots
+        o = stack.base
+        s[o + a] = stack.compare_v(s[o + b], c, op)
+
+    def kr(vm, a, b, c):
+        stack = vm.stack
+        s = vm.slots
+        o = stack.base
+        s[o + a] = stack.compare_v(b, s[o + c], op)
+
+    def kk(vm, a, b, c):
+        stack = vm.stack
+        vm.slots[stack.base + a] = stack.compare_v(b, c, op)
+    return rr, rk, kr, kk
+
+
+def t_test_compare(op):
+    # a is a bool, the next instruction is skipped when the comparison is not a
+    def rr(vm, a, b, c):
+        stack = vm.stack
+        s = vm.slots
+        o = stack.base
+        if stack.compare_v(s[o + b], s[o + c], op) != a:
+            stack.pc += 1
+
+    def rk(vm, a, b, c):
+        stack = vm.stack
+        if stack.compare_v(vm.slots[stack.base + b], c, op) != a:
+            stack.pc += 1
+
+    def kr(vm, a, b, c):
+        stack = vm.stack
+        if stack.compare_v(b, vm.slots[stack.base + c], op) != a:
+            stack.pc += 1
+
+    def kk(vm, a, b, c):
+        stack = vm.stack
+        if stack.compare_v(b, c, op) != a:
+            stack.pc += 1
+    return rr, rk, kr, kk
+
+
+def t_unary_arith(op):
+    def r(vm, a, b, c):
+        stack = vm.stack
+        s = vm.slots
+        o = stack.base
+        s[o + a] = stack.arith_v(op, s[o + b], s[o + b], True)
+
+    def k(vm, a, b, c):
+        stack = vm.stack
+        vm.slots[stack.base + a] = stack.arith_v(op, b, b, True)
+    return r, k
+
+
+def t_arith(op):
+    def rr(vm, a, b, c):
+        stack = vm.stack
+        s = vm.slots
+        o = stack.base
+        s[o + a] = stack.arith_v(op, s[o + b], s[o + c])
+
+    def rk(vm, a, b, c):
+        stack = vm.stack
+        s = vm.slots
+        o = stack.base
+        s[o + a] = stack.arith_v(op, s[o + b], c)
+
+    def kr(vm, a, b, c):
+        stack = vm.stack
+        s = vm.slots
+        o = stack.base
+        s[o + a] = stack.arith_v(op, b, s[o + c])
+
+    def kk(vm, a, b, c):
+        stack = vm.stack
+        vm.slots[stack.base + a] = stack.arith_v(op, b, c)
+    return rr, rk, kr, kk
+
+
+# quickening: an adaptive instruction does the generic work and, once warm, rewrites
+# itself in the threaded code to a variant for the types of its operands, a variant
+# whose guard fails does the generic work and rewrites itself back
+
+def quicken(stack, h):
+    # counts an execution of the running adaptive instruction and replaces its
+    # handler with h when warm, h is None when there is no variant for the operands
+    proto = stack.closure.prototype
+    pc = stack.pc - 1
+    n = proto.warmup[pc]
+    if n > 0:
+        proto.warmup[pc] = n - 1
+    elif h is not None:
+        code = proto.threaded
+        code[pc] = (h,) + code[pc][1:]
+
+
+def deopt(stack, h):
+    # puts back the adaptive handler h of the running instruction
+    proto = stack.closure.prototype
+    pc = stack.pc - 1
+    code = proto.threaded
+    code[pc] = (h,) + code[pc][1:]
+    proto.warmup[pc] = QUICKEN_BACKOFF
+
+
+int_ops = {
+    TOKEN.OP_ADD: operator.add,
+    TOKEN.OP_MINUS: operator.sub,
+    TOKEN.OP_MUL: operator.mul,
+    TOKEN.OP_IDIV: operator.floordiv,
+    TOKEN.OP_MOD: operator.mod,
+    TOKEN.OP_BAND: operator.and_,
+    TOKEN.OP_BOR: operator.or_,
+    TOKEN.OP_BXOR: operator.xor,
+}
+float_ops = {
+    TOKEN.OP_ADD: operator.add,
+    TOKEN.OP_MINUS: operator.sub,
+    TOKEN.OP_MUL: operator.mul,
+    TOKEN.OP_IDIV: operator.floordiv,
+    TOKEN.OP_MOD: operator.mod,
+    TOKEN.OP_DIV: operator.truediv,
+    TOKEN.OP_POW: operator.pow,
+}
+
+
+def is_float_arith(op, x, y):
+    # True when arith_v computes op of x and y with floats, that is for numbers
+    # of which one is a float that is not integral, or any numbers for / and ^
+    tx = type(x)
+    ty = type(y)
+    if not (tx is int or tx is float) or not (ty is int or ty is float):
+        return False
+    if op == TOKEN.OP_DIV or op == TOKEN.OP_POW:
+        return True
+    return tx is float and x % 1 != 0 or ty is float and y % 1 != 0
+
+
+def t_quick_arith(op, kb, kc):
+    # adaptive handler of a binary arith, kb and kc are 1 for constant operands
+    f_int = int_ops.get(op, None)
+    f_float = float_ops.get(op, None)
+
+    def adaptive(vm, a, b, c):
+        stack = vm.stack
+        s = vm.slots
+        o = stack.base
+        x = b if kb else s[o + b]
+        y = c if kc else s[o + c]
+        s[o + a] = stack.arith_v(op, x, y)
+        if f_int is not None and type(x) is int and type(y) is int:
+            quicken(stack, int_arith)
+        elif f_float is not None and is_float_arith(op, x, y):
+            quicken(stack, float_arith)
+        else:
+            quicken(stack, None)
+
+    def int_arith(vm, a, b, c):
+        stack = vm.stack
+        s = vm.slots
+        o = stack.base
+        x = b if kb else s[o + b]
+        y = c if kc else s[o + c]
+        if type(x) is int and type(y) is int:
+            s[o + a] = f_int(x, y)
+        else:
+            s[o + a] = stack.arith_v(op, x, y)
+            deopt(stack, adaptive)
+
+    def float_arith(vm, a, b, c):
+        stack = vm.stack
+        s = vm.slots
+        o = stack.base
+        x = b if kb else s[o + b]
+        y = c if kc else s[o + c]
+        if is_float_arith(op, x, y):
+            s[o + a] = f_float(float(x), float(y))
+        else:
+            s[o + a] = stack.arith_v(op, x, y)
+            deopt(stack, adaptive)
+    return adaptive
+
+
+def t_table_get(stack, t, k):
+    if type(t) is Table:
+        return t.get(k)
+    stack.error(repr(t) + ' not a table')
+
+
+def t_table_put(stack, t, k, v):
+    if type(t) is Table:
+        t.put(k, v)
+    else:
+        stack.error(repr(t) + ' not a table')
+
+
+def t_get_table_adaptive(vm, a, b, c):
+    stack = vm.stack
+    s = vm.slots
+    o = stack.base
+    t = s[o + b]
+    k = s[o + c]
+    s[o + a] = t_table_get(stack, t, k)
+    quicken(stack, t_get_table_int if type(t) is Table and type(k) is int else None)
+
+
+def t_get_table_int(vm, a, b, c):
+    # GET_TABLE quickened for a table and an integer key
+    stack = vm.stack
+    s = vm.slots
+    o = stack.base
+    t = s[o + b]
+    k = s[o + c]
+    if type(t) is Table and type(k) is int:
+        arr = t.arr
+        s[o + a] = arr[k - 1] if 0 < k <= len(arr) else t.map.get(k, None)
+    else:
+        s[o + a] = t_table_get(stack, t, k)
+        deopt(stack, t_get_table_adaptive)
+
+
+def t_get_table_k(vm, a, b, c):
+    stack = vm.stack
+    s = vm.slots
+    o = stack.base
+    s[o + a] = t_table_get(stack, s[o + b], c)
+
+
+def t_get_field(vm, a, b, cache):
+    # GET_TABLE with a constant string key, c is the FieldCache of the instruction
+    stack = vm.stack
+    s = vm.slots
+    o = stack.base
+    t = s[o + b]
+    if type(t) is Table:
+        if t.shape is cache.shape:
+            s[o + a] = t.values[cache.index]
+        else:
+            s[o + a] = cache.get(t)
+    else:
+        stack.error(repr(t) + ' not a table')
+
+
+def t_get_tab_up_r(vm, a, b, c):
+    stack = vm.stack
+    s = vm.slots
+    o = stack.base
+    s[o + a] = t_table_get(stack, stack.closure.up_values[b].val, s[o + c])
+
+
+def t_get_tab_up_k(vm, a, b, c):
+    stack = vm.stack
+    vm.slots[stack.base + a] = t_table_get(stack, stack.closure.up_values[b].val, c)
+
+
+def t_get_global(vm, a, b, cache):
+    # GET_TAB_UP with a constant string key, c is the KeyCache of the instruction
+    stack = vm.stack
+    t = stack.closure.up_values[b].val
+    if t is cache.table and t.version == cache.version:
+        vm.slots[stack.base + a] = cache.value
+    elif type(t) is Table:
+        vm.slots[stack.base + a] = cache.get(t)
+    else:
+        stack.error(repr(t) + ' not a table')
+
+
+def t_self_r(vm, a, b, c):
+    stack = vm.stack
+    s = vm.slots
+    o = stack.base
+    t = s[o + b]
+    s[o + a + 1] = t
+    s[o + a] = t_table_get(stack, t, s[o + c])
+
+
+def t_self_k(vm, a, b, c):
+    stack = vm.stack
+    s = vm.slots
+    o = stack.base
+    t = s[o + b]
+    s[o + a + 1] = t
+    s[o + a] = t_table_get(stack, t, c)
+
+
+def t_set_table(fetch_b, fetch_c):
+    def h(vm, a, b, c):
+        stack = vm.stack
+        s = vm.slots
+        o = stack.base
+        t_table_put(stack, s[o + a], fetch_b(s, o, b), fetch_c(s, o, c))
+    return h
+
+
+def t_set_field(fetch_c):
+    # SET_TABLE with a constant string key, b is the FieldCache of the instruction
+    def h(vm, a, cache, c):
+        stack = vm.stack
+        s = vm.slots
+        o = stack.base
+        t = s[o + a]
+        if type(t) is Table:
+            cache.put(t, fetch_c(s, o, c))
+        else:
+            stack.error(repr(t) + ' not a table')
+    return h
+
+
+def t_quick_set_table(fetch_c):
+    # adaptive SET_TABLE with a register key
+    def adaptive(vm, a, b, c):
+        stack = vm.stack
+        s = vm.slots
+        o = stack.base
+        t = s[o + a]
+        k = s[o + b]
+        t_table_put(stack, t, k, fetch_c(s, o, c))
+        quicken(stack, set_int if type(t) is Table and type(k) is int else None)
+
+    def set_int(vm, a, b, c):
+        # quickened for a table and an integer key
+        stack = vm.stack
+        s = vm.slots
+        o = stack.base
+        t = s[o + a]
+        k = s[o + b]
+        v = fetch_c(s, o, c)
+        if type(t) is Table and type(k) is int:
+            arr = t.arr
+            kind = t.kind
+            if 0 < k <= len(arr) and (v is not None if kind is None else type(v) is kind):
+                try:
+                    arr[k - 1] = v
+                except OverflowError:
+                    t.put(k, v)
+            else:
+                t.put(k, v)
+        else:
+            t_table_put(stack, t, k, v)
+            deopt(stack, adaptive)
+    return adaptive
+
+
+def t_set_tab_up(fetch_b, fetch_c):
+    def h(vm, a, b, c):
+        stack = vm.stack
+        s = vm.slots
+        o = stack.base
+        t_table_put(stack, stack.closure.up_values[a].val, fetch_b(s, o, b), fetch_c(s, o, c))
+    return h
+
+
+def t_set_global(fetch_c):
+    # SET_TAB_UP with a constant string key, skips the integer key checks of Table.put
+    def h(vm, a, b, c):
+        stack = vm.stack
+        t = stack.closure.up_values[a].val
+        if type(t) is Table:
+            t.put_key(b, fetch_c(vm.slots, stack.base, c))
+        else:
+            stack.error(repr(t) + ' not a table')
+    return h
+
+
+def fetch_r(s, o, r):
+    return s[o + r]
+
+
+def fetch_k(s, o, k):
+    return k
+
+
+t_arith_handlers = {}
+for _op, _tok in arith_tokens.items():
+    if _op in [OP.UNM, OP.BNOT]:
+        t_arith_handlers[_op] = t_unary_arith(_tok)
+    else:
+        t_arith_handlers[_op] = t_arith(_tok)
+# adaptive handlers of rr, rk and kr binary arith, shifts are not quickened
+t_quick_arith_handlers = {_op: [t_quick_arith(_tok, kb, kc) for kb, kc in [(0, 0), (0, 1), (1, 0)]]
+                          for _op, _tok in arith_tokens.items() if _tok in float_ops or _tok in int_ops}
+t_compare_handlers = {_op: t_compare(_tok) for _op, _tok in compare_tokens.items()}
+t_test_compare_handlers = {_op: t_test_compare(_tok) for _op, _tok in test_tokens.items()}
+t_set_table_handlers = [[t_set_table(fb, fc) for fc in [fetch_r, fetch_k]] for fb in [fetch_r, fetch_k]]
+t_quick_set_table_handlers = [t_quick_set_table(fc) for fc in [fetch_r, fetch_k]]
+t_set_field_handlers = [t_set_field(fc) for fc in [fetch_r, fetch_k]]
+t_set_tab_up_handlers = [[t_set_tab_up(fb, fc) for fc in [fetch_r, fetch_k]] for fb in [fetch_r, fetch_k]]
+t_set_global_handlers = [t_set_global(fc) for fc in [fetch_r, fetch_k]]
+
+
+def decode(proto):
+    # turn the encoded instructions of a Prototype into (handler, a, b, c) tuples
+    constants = proto.constants
+
+    def rk(x):
+        # (1, constant) or (0, register)
+        if x > 0xff:
+            return 1, constants[x & 0xff]
+        return 0, x
+
+    code = []
+    for op, a, b, c in proto.code:
+        if op == OP.MOVE:
+            inst = (t_move, a, b, c)
+        elif op == OP.LOAD_K:
+            inst = (t_load_k, a, constants[b], c)
+        elif op == OP.LOAD_NIL:
+            inst = (t_load_nil, a, a + b + 1, c)
+        elif op == OP.LOAD_BOOL:
+            inst = (t_load_bool, a, bool(b), c)
+        elif op == OP.GET_UP_VAL:
+            inst = (t_get_up_val, a, b, c)
+        elif op == OP.SET_UP_VAL:
+            inst = (t_set_up_val, a, b, c)
+        elif op == OP.NEW_TABLE:
+            inst = (t_new_table, a, b, c)
+        elif op == OP.NOT:
+            inst = (t_not, a, b, c)
+        elif op == OP.JUMP and a == 0:
+            inst = (t_jump, a, b, c)
+        elif op == OP.TEST:
+            inst = (t_test, a, bool(b), c)
+        elif op == OP.TEST_SET:
+            inst = (t_test_set, a, b, bool(c))
+        elif op == OP.FOR_PREP:
+            inst = (t_for_prep, a, b, c)
+        elif op == OP.FOR_LOOP:
+            inst = (t_for_loop, a, b, c)
+        elif op == OP.T_FOR_LOOP:
+            inst = (t_t_for_loop, a, b, c)
+        elif op == OP.RETURN:
+            inst = (t_return, a, b + 1, c)
+        elif op in t_compare_handlers:
+            kb, b = rk(b)
+            kc, c = rk(c)
+            inst = (t_compare_handlers[op][kb * 2 + kc], a, b, c)
+        elif op in t_test_compare_handlers:
+            kb, b = rk(b)
+            kc, c = rk(c)
+            inst = (t_test_compare_handlers[op][kb * 2 + kc], bool(a), b, c)
+        elif op in [OP.UNM, OP.BNOT]:
+            kb, b = rk(b)
+            inst = (t_arith_handlers[op][kb], a, b, c)
+        elif op in t_arith_handlers:
+            kb, b = rk(b)
+            kc, c = rk(c)
+            if op in t_quick_arith_handlers and not (kb and kc):
+                inst = (t_quick_arith_handlers[op][kb * 2 + kc], a, b, c)
+            else:
+                inst = (t_arith_handlers[op][kb * 2 + kc], a, b, c)
+        elif op == OP.GET_TABLE:
+            kc, c = rk(c)
+            if kc and is_map_key(c):
+                inst = (t_get_field, a, b, FieldCache(c))
+            else:
+                inst = (t_get_table_k if kc else t_get_table_adaptive, a, b, c)
+        elif op == OP.GET_TAB_UP:
+            kc, c = rk(c)
+            if kc and is_map_key(c):
+                inst = (t_get_global, a, b, KeyCache(c))
+            else:
+                inst = (t_get_tab_up_k if kc else t_get_tab_up_r, a, b, c)
+        elif op == OP.SELF:
+            kc, c = rk(c)
+            inst = (t_self_k if kc else t_self_r, a, b, c)
+        elif op == OP.SET_TABLE:
+            kb, b = rk(b)
+            kc, c = rk(c)
+            if kb and is_map_key(b):
+                inst = (t_set_field_handlers[kc], a, FieldCache(b), c)
+            elif kb:
+                inst = (t_set_table_handlers[kb][kc], a, b, c)
+            else:
+                inst = (t_quick_set_table_handlers[kc], a, b, c)
+        elif op == OP.SET_TAB_UP:
+            kb, b = rk(b)
+            kc, c = rk(c)
+            if kb and is_map_key(b):
+                inst = (t_set_global_handlers[kc], a, b, c)
+            else:
+                inst = (t_set_tab_up_handlers[kb][kc], a, b, c)
+        else:
+            # calls, concat, closures and the rest go through the generic handlers
+            inst = (generic_handlers[op], a, b, c)
+        code.append(inst)
+    return code
+
+# unbound generic handlers of VM, called as h(vm, a, b, c)
+generic_handlers = {
+    OP.JUMP: VM.jump,
+    OP.LEN: VM.length,
+    OP.CONCAT: VM.concat,
+    OP.CALL: VM.call_inst,
+    OP.TAIL_CALL: VM.tail_call_inst,
+    OP.T_FOR_CALL: VM.t_for_call,
+    OP.SET_LIST: VM.set_list,
+    OP.CLOSURE: VM._closure,
+    OP.VARARG: VM.vararg_inst,
+}
+
+
 # py functions in Lua language
 def lua_print(state: VM):
-    print(*state.stack.slots)
+    print(*state.stack.slots[state.stack.base:])
 
 
 def lua_next(state: VM):
@@ -510,17 +1248,69 @@ def i_pairs(state: VM):
     return 3
 
 
-def run(code, file=False):
-    if file:
-        with open(code, 'r') as f:
-            code = ' '.join(f.readlines())
+def load_source(vm, code, threaded=True, engine='vm'):
+    # compiles code, a str or a text file, and loads its main function on vm,
+    # the compilers are imported here so that running a binary chunk does not load them
+    if engine == 'vm':
+        import compile_cache
+        cache = compile_cache.active
+        proto = None
+        if cache is not None:
+            key = compile_cache.source_key(code)
+            proto = cache.load(key, threaded)
+        if proto is None:
+            from analyzer import intermediate
+            proto = Prototype(intermediate(code), threaded).prototypes[0]
+            if cache is not None:
+                cache.store(key, proto)
+        # print(proto.code)
+        vm.load(proto)
+    elif engine == 'python':
+        from analyzer import intermediate
+        from transpiler import transpile
+        vm.load_closure(transpile(intermediate(code, thread_jumps=False), vm, partial(Prototype, threaded=threaded)))
+    else:
+        from ast_compiler import compile_chunk
+        vm.load_closure(compile_chunk(code, vm))
+
+
+def run(code, file=False, threaded=True, engine='vm'):
+    # engine is 'vm' to run the bytecode, 'python' to run the chunk transpiled to Python,
+    # 'ast' to run the syntax tree compiled to Python closures, a binary chunk made by
+    # luac.dump always runs on the vm
+    from luac import SIGNATURE, undump
     vm = VM()
     vm.register('print', lua_print)
     vm.register('next', lua_next)
     vm.register('pairs', pairs)
     vm.register('ipairs', i_pairs)
-    proto = Prototype(intermediate(code)).prototypes[0]
-    # print(proto.code)
-    vm.load(proto)
-    vm.call(0, 0)
-
+    if file:
+        with open(code, 'rb') as f:
+            if f.read(len(SIGNATURE)) == SIGNATURE:
+                f.seek(0)
+                code, file = f.read(), False
+    if file:
+        # the source is lexed as it is read
+        with open(code, 'r') as f:
+            load_source(vm, f, threaded, engine)
+    elif type(code) is bytes:
+        vm.load(undump(code, threaded))
+        engine = 'vm'
+    else:
+        load_source(vm, code, threaded, engine)
+    if engine == 'vm':
+        vm.call(0, 0)
+        return
+    # Lua calls are Python calls in the transpiled or compiled code, they run
+    # on a thread with a stack big enough for deep recursion
+    limit = sys.getrecursionlimit()
+    size = threading.stack_size()
+    sys.setrecursionlimit(max(limit, MAX_STACK))
+    threading.stack_size(THREAD_STACK_SIZE)
+    try:
+        t = threading.Thread(target=vm.call, args=(0, 0))
+        t.start()
+        t.join()
+    finally:
+        threading.stack_size(size)
+        sys.setrecursionlimit(limit)